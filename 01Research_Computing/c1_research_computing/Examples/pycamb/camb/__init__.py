@@ -3,34 +3,63 @@
 
 Python CAMB interface (http://camb.info)
 
+Submodules, and the CAMB shared library, are only loaded when first used (on python 3.7+), so e.g.
+camb.correlations and camb.bbn can be imported quickly, and without the compiled library.
+
 """
 __author__ = "Antony Lewis"
 __contact__ = "antony at cosmologist dot info"
 __status__ = "beta"
 __version__ = "0.1.4"
 
+import sys
+import importlib
 from .baseconfig import dll_import
-from .camb import CAMBdata, MatterTransferData, get_results, get_transfer_functions, get_background, \
-    get_age, get_zre_from_tau, set_z_outputs, set_feedback_level, set_params, get_matter_power_interpolator
-from . import model
-from . import initialpower
-from . import reionization
-from .nonlinear import set_halofit_version
-from .model import CAMBparams, TransferParams
-from .reionization import ReionizationParams
-from .initialpower import InitialPowerParams
-from .bispectrum import threej
 from ctypes import c_int, c_double, c_bool
 
-ThreadNum = dll_import(c_int, "modelparams", "threadnum")
-# ThreadNum.value = 0
+# names exported by the package, and the submodules that define them
+_module_attributes = {
+    'camb': ['CAMBdata', 'MatterTransferData', 'MatterPowerInterpolator', 'get_results', 'get_transfer_functions',
+             'get_background', 'get_age', 'get_zre_from_tau', 'set_z_outputs', 'set_feedback_level', 'set_params',
+             'get_matter_power_interpolator', 'ResultCache', 'set_result_cache', 'get_result_cache'],
+    'nonlinear': ['set_halofit_version'],
+    'model': ['CAMBparams', 'TransferParams'],
+    'reionization': ['ReionizationParams'],
+    'initialpower': ['InitialPowerParams'],
+    'bispectrum': ['threej']}
+
+_attribute_modules = dict((name, module) for module, names in _module_attributes.items() for name in names)
+
+_submodules = ['baseconfig', 'bbn', 'bispectrum', 'camb', 'constants', 'correlations', 'emulate', 'fisher', 'grid',
+               'initialpower', 'lensing', 'limber', 'model', 'nonlinear', 'recombination', 'reionization', 'store']
+
+_dll_variables = {
+    'ThreadNum': (c_int, "modelparams", "threadnum"),  # ThreadNum.value = 0
+    # Variables from module GaugeInterface
+    'DoTensorNeutrinos': (c_bool, "gaugeinterface", "dotensorneutrinos"),  # DoTensorNeutrinos.value = True
+    'Magnetic': (c_double, "gaugeinterface", "magnetic"),  # Magnetic.value = 0.
+    'vec_sig0': (c_double, "gaugeinterface", "vec_sig0")  # vec_sig0.value = 1.
+}
+
+
+def __getattr__(name):
+    if name in _attribute_modules:
+        value = getattr(importlib.import_module('.' + _attribute_modules[name], __name__), name)
+    elif name in _dll_variables:
+        value = dll_import(*_dll_variables[name])
+    elif name in _submodules:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    globals()[name] = value
+    return value
+
 
-# Variables from module GaugeInterface
-DoTensorNeutrinos = dll_import(c_bool, "gaugeinterface", "dotensorneutrinos")
-# DoTensorNeutrinos.value = True
+def __dir__():
+    return sorted(set(globals()) | set(_attribute_modules) | set(_dll_variables) | set(_submodules))
 
-Magnetic = dll_import(c_double, "gaugeinterface", "magnetic")
-# Magnetic.value = 0.
 
-vec_sig0 = dll_import(c_double, "gaugeinterface", "vec_sig0")
-# vec_sig0.value = 1.
+if sys.version_info < (3, 7):
+    # no module __getattr__, so load everything now
+    for _name in list(_attribute_modules) + list(_dll_variables):
+        __getattr__(_name)
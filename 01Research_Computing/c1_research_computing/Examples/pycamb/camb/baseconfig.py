@@ -2,6 +2,7 @@ import os.path as osp
 import sys
 import os
 import six
+import hashlib
 import platform
 
 BASEDIR = osp.abspath(osp.dirname(__file__))
@@ -30,9 +31,31 @@ if not mock_load:
             return res
 
 
-    if not osp.isfile(CAMBL): sys.exit(
-        '%s does not exist.\nPlease remove any old installation and install again.' % DLLNAME)
-    camblib = ctypes.LibraryLoader(ifort_gfortran_loader).LoadLibrary(CAMBL)
+    class _LazyLibrary(object):
+        # The CAMB shared library, loaded when a symbol is first used, so that modules that do not call the
+        # Fortran code (e.g. correlations, bbn) can be imported quickly, or without the library at all
+
+        def __init__(self):
+            self._lib = None
+
+        def load(self):
+            if self._lib is None:
+                if not osp.isfile(CAMBL):
+                    raise ImportError(
+                        '%s does not exist.\nPlease remove any old installation and install again.' % DLLNAME)
+                lib = ctypes.LibraryLoader(ifort_gfortran_loader).LoadLibrary(CAMBL)
+                set_filelocs(lib)
+                self._lib = lib
+            return self._lib
+
+        def __getattr__(self, name):
+            return getattr(self.load(), name)
+
+        def __getitem__(self, name_or_ordinal):
+            return self.load()[name_or_ordinal]
+
+
+    camblib = _LazyLibrary()
 # camblib = ctypes.cdll.LoadLibrary(CAMBL)
 else:
     # This is just so readthedocs build will work without CAMB binary library
@@ -64,35 +87,73 @@ else:
     import ctypes
 
 
-def dll_import(tp, module, func):
-    try:
-        # gfortran
-        return tp.in_dll(camblib, "__%s_MOD_%s" % (module, func))
-    except:
-        # ifort
-        return tp.in_dll(camblib, "%s_mp_%s_" % (module, func))
+_dll_imports = {}
 
 
-def set_filelocs():
+def dll_import(tp, module, func):
+    # variables are looked up once, then the same ctypes object is returned
+    key = (tp, module, func)
+    if key not in _dll_imports:
+        lib = camblib.load()
+        try:
+            # gfortran
+            _dll_imports[key] = tp.in_dll(lib, "__%s_MOD_%s" % (module, func))
+        except:
+            # ifort
+            _dll_imports[key] = tp.in_dll(lib, "%s_mp_%s_" % (module, func))
+    return _dll_imports[key]
+
+
+def set_filelocs(lib=None):
     HighLExtrapTemplate = osp.join(BASEDIR, "HighLExtrapTemplate_lenspotentialCls.dat")
     if not osp.exists(HighLExtrapTemplate):
         HighLExtrapTemplate = osp.abspath(osp.join(BASEDIR, "../..", "HighLExtrapTemplate_lenspotentialCls.dat"))
     HighLExtrapTemplate = six.b(HighLExtrapTemplate)
-    func = camblib.__handles_MOD_set_cls_template
+    func = (lib or camblib).__handles_MOD_set_cls_template
     func.argtypes = [ctypes.c_char_p, ctypes.c_long]
     s = ctypes.create_string_buffer(HighLExtrapTemplate)
     func(s, ctypes.c_long(len(HighLExtrapTemplate)))
 
 
-if not mock_load:
-    set_filelocs()
-
-
 class CAMBError(Exception):
     pass
 
 
 class CAMB_Structure(Structure):
+    # fields calculated internally from the other parameters, not included in canonical_key
+    _derived_fields_ = ()
+
+    def _canonical_skip(self):
+        return self._derived_fields_
+
+    def canonical_key(self):
+        """
+        Get a hashable tuple of (name, value) for all fields (recursively for sub-structures), excluding fields
+        that are calculated internally, so that structures with the same input parameters have equal keys.
+
+        :return: tuple of field names and values
+        """
+        skip = self._canonical_skip()
+        key = []
+        for field_name, field_type in self._fields_:
+            if field_name in skip:
+                continue
+            obj = getattr(self, field_name)
+            if isinstance(obj, CAMB_Structure):
+                obj = obj.canonical_key()
+            elif isinstance(obj, ctypes.Array):
+                obj = tuple(obj)
+            key.append((field_name, obj))
+        return tuple(key)
+
+    def canonical_hash(self):
+        """
+        Get a hash string of :meth:`canonical_key`, which is the same in different sessions and platforms.
+
+        :return: hex digest string
+        """
+        return hashlib.sha1(six.b(repr(self.canonical_key()))).hexdigest()
+
     def __str__(self):
         s = ''
         for field_name, field_type in self._fields_:
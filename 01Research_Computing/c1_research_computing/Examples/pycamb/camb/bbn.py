@@ -89,55 +89,88 @@ def runBBNplot():
     sys.exit()
 
 
-if __name__ == "__main__":
-    # Make interpolation table
-
-    ombh2s = np.hstack((np.linspace(0.005, 0.02, num=int((0.02 - 0.005) / 0.001), endpoint=False),
-                        np.linspace(0.020, 0.024, num=16, endpoint=False),
-                        np.linspace(0.024, 0.04, num=int((0.04 - 0.024) / 0.001) + 1, endpoint=True)))
-
-    DeltaNs = [-3, -2, -1, -0.5, 0, 0.5, 1, 2, 3, 4, 5, 6, 7]
-
-    lines = []
-    for DeltaN in DeltaNs:
-        # this is fiducial mass fraction. For low ombh2 has no effect, for subsequent steps use previous value
-        Yp_fid = 0.2;
-        for ombh2 in ombh2s:
-            rho_b = ombh2 * omegafac;
-            if not alterBBN:
-                YBBN = yhe_fit(ombh2, DeltaN, tau_n)
-                Yp_fid = ypBBN_to_yhe(YBBN)
-            n_baryon = (4 * Yp_fid / m_He + (1 - Yp_fid) / m_H) * rho_b
-            eta = n_baryon / n_photon
-            if alterBBN:
-
-                outtxt = runBBN(eta, DeltaN)
-
-                (YBBN, D, He3, Li7, Li6, Be7) = [float(s.strip()) for s in outtxt.split('\n')[7].split()[1:]]
-                (sigYBBN, sigdD, sigHe3, sigLi7, sigLi6, sigBe7) = [float(s.strip()) for s in
-                                                                    outtxt.split('\n')[8].split()[2:]]
-
-                actual_ombh2 = eta * n_photon * (YBBN * m_He / 4 + (1 - YBBN) * m_H) / omegafac
-                Yp = (eta * n_photon / actual_ombh2 / omegafac - 1 / m_H) / (4 / m_He - 1 / m_H)
-                Yp_fid = Yp
-                #        print ombh2, DeltaN, eta, YBBN, actual_ombh2, Yp
-                line = (('%12.5f ') * 6 + ('%12.3e %12.2e') * 3) % (
-                    actual_ombh2, eta * 1e10, DeltaN, Yp, YBBN, sigYBBN, D, sigdD, He3, sigHe3, Li7, sigLi7)
-                lines += [line]
-            else:
-                D = dh_fit(ombh2, DeltaN, tau_n) * 1e-5
-                Yp = Yp_fid
-                # Yp error already includes tau_n error??
-                sigdD = 6e-7  # np.sqrt(4.e-07**2 + ((dh_fit(ombh2,DeltaN,tau_n+1.1)-dh_fit(ombh2,DeltaN,tau_n-1.1))/2*1e-5)**2 +  (0.002*D)**2)
-                sigYBBN = 0.0003  # np.sqrt(0.0003**2 + ((yhe_fit(ombh2,DeltaN,tau_n+1.1)-yhe_fit(ombh2,DeltaN,tau_n-1.1))/2)**2 + (0.002*Yp)**2)
-                line = (('%12.5f ') * 6 + ('%12.3e %12.2e')) % (ombh2, eta * 1e10, DeltaN, Yp, YBBN, sigYBBN, D, sigdD)
-                lines += [line]
-            print(line)
-        lines += ['']
-
-    if alterBBN:
-        f = open('BBN_full_alterBBN_' + str(tau_n) + '.dat', 'w')
-        f.write('''#BBN prediction of the primordial Helium abundance $Y_p$ as 
+default_ombh2s = np.hstack((np.linspace(0.005, 0.02, num=int((0.02 - 0.005) / 0.001), endpoint=False),
+                            np.linspace(0.020, 0.024, num=16, endpoint=False),
+                            np.linspace(0.024, 0.04, num=int((0.04 - 0.024) / 0.001) + 1, endpoint=True)))
+
+default_DeltaNs = [-3, -2, -1, -0.5, 0, 0.5, 1, 2, 3, 4, 5, 6, 7]
+
+
+def _table_column(args):
+    # table rows for one DeltaN; each step uses the previous helium fraction to get eta
+    ombh2s, DeltaN, tau, alter_bbn, prog = args
+    # this is fiducial mass fraction. For low ombh2 has no effect, for subsequent steps use previous value
+    Yp_fid = 0.2
+    rows = []
+    for ombh2 in ombh2s:
+        rho_b = ombh2 * omegafac
+        if not alter_bbn:
+            YBBN = yhe_fit(ombh2, DeltaN, tau)
+            Yp_fid = ypBBN_to_yhe(YBBN)
+        n_baryon = (4 * Yp_fid / m_He + (1 - Yp_fid) / m_H) * rho_b
+        eta = n_baryon / n_photon
+        if alter_bbn:
+            outtxt = runBBN(eta, DeltaN, tau, prog)
+            if not isinstance(outtxt, str):
+                outtxt = outtxt.decode()
+            (YBBN, D, He3, Li7, Li6, Be7) = [float(s.strip()) for s in outtxt.split('\n')[7].split()[1:]]
+            (sigYBBN, sigdD, sigHe3, sigLi7, sigLi6, sigBe7) = [float(s.strip()) for s in
+                                                                outtxt.split('\n')[8].split()[2:]]
+
+            actual_ombh2 = eta * n_photon * (YBBN * m_He / 4 + (1 - YBBN) * m_H) / omegafac
+            Yp = (eta * n_photon / actual_ombh2 / omegafac - 1 / m_H) / (4 / m_He - 1 / m_H)
+            Yp_fid = Yp
+            rows.append([actual_ombh2, eta * 1e10, DeltaN, Yp, YBBN, sigYBBN, D, sigdD, He3, sigHe3, Li7, sigLi7])
+        else:
+            D = dh_fit(ombh2, DeltaN, tau) * 1e-5
+            Yp = Yp_fid
+            # Yp error already includes tau_n error??
+            sigdD = 6e-7  # np.sqrt(4.e-07**2 + ((dh_fit(ombh2,DeltaN,tau_n+1.1)-dh_fit(ombh2,DeltaN,tau_n-1.1))/2*1e-5)**2 +  (0.002*D)**2)
+            sigYBBN = 0.0003  # np.sqrt(0.0003**2 + ((yhe_fit(ombh2,DeltaN,tau_n+1.1)-yhe_fit(ombh2,DeltaN,tau_n-1.1))/2)**2 + (0.002*Yp)**2)
+            rows.append([ombh2, eta * 1e10, DeltaN, Yp, YBBN, sigYBBN, D, sigdD])
+    return np.array(rows)
+
+
+def make_table(ombh2s=default_ombh2s, DeltaNs=default_DeltaNs, tau=tau_n, alter_bbn=False,
+               prog='./alter_etannutau.x', processes=None):
+    """
+    Make a BBN table of predictions as a function of ombh2 and DeltaN, from the Parthenelope fitting formulae
+    or by running AlterBBN. Each DeltaN is calculated in a separate process.
+
+    :param ombh2s: array of ombh2 values
+    :param DeltaNs: array of DeltaN values
+    :param tau: neutron lifetime in seconds
+    :param alter_bbn: if True run AlterBBN (prog) for each point, otherwise use the fitting formulae
+    :param prog: AlterBBN executable
+    :param processes: number of processes to use (default: number of CPUs if alter_bbn, otherwise 1)
+    :return: list of arrays of table rows for each DeltaN, with columns
+        ombh2, eta10, DeltaN, Yp, YBBN, sigma_Yp, D/H, err D/H [, He3/H, err He3/H, Li7, sig Li7]
+    """
+    jobs = [(ombh2s, DeltaN, tau, alter_bbn, prog) for DeltaN in DeltaNs]
+    if processes is None:
+        processes = None if alter_bbn else 1
+    if processes == 1:
+        return [_table_column(job) for job in jobs]
+    from multiprocessing import Pool
+    pool = Pool(processes)
+    try:
+        return pool.map(_table_column, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def write_table(filename, columns, tau=tau_n, alter_bbn=False):
+    """
+    Write a BBN table made by :func:`make_table` in the standard text format.
+
+    :param filename: file to write
+    :param columns: list of arrays of table rows, as returned by :func:`make_table`
+    :param tau: neutron lifetime used for the table
+    :param alter_bbn: whether the table was calculated with AlterBBN
+    """
+    if alter_bbn:
+        header = """#BBN prediction of the primordial Helium abundance $Y_p$ as 
 #function of the baryon density $\omega_b h^2$ and number of 
 #extra radiation degrees of freedom $\Delta N$.
 #Calculated with AlterBBN v1.4 [http://superiso.in2p3.fr/relic/alterbbn/] for a 
@@ -146,13 +179,10 @@ if __name__ == "__main__":
     
 #      ombh2        eta10       DeltaN           Yp       Yp^BBN     sigma_Yp          D/H     err D/H       He3/H    err He3/H         Li7      sig Li7
      
-    ''' % (tau_n, TCMB))
-        f.write("\n".join(lines))
-        f.close()
-
+    """
+        fmt = ('%12.5f ') * 6 + ('%12.3e %12.2e') * 3
     else:
-        f = open('BBN_full_Parthenelope_' + str(tau_n) + '.dat', 'w')
-        f.write('''#BBN prediction of the primordial Helium abundance $Y_p$ as 
+        header = """#BBN prediction of the primordial Helium abundance $Y_p$ as 
 #function of the baryon density $\omega_b h^2$ and number of 
 #extra radiation degrees of freedom $\Delta N$.
 #Calculated from Parthenelope fitting function Dec 2014. Errors are guesstimates. 
@@ -161,6 +191,132 @@ if __name__ == "__main__":
     
 #      ombh2        eta10       DeltaN           Yp       Yp^BBN     sigma_Yp          D/H     err D/H
 
-''' % (tau_n, TCMB))
+"""
+        fmt = ('%12.5f ') * 6 + ('%12.3e %12.2e')
+    lines = []
+    for rows in columns:
+        lines += [fmt % tuple(row) for row in rows] + ['']
+    with open(filename, 'w') as f:
+        f.write(header % (tau, TCMB))
         f.write("\n".join(lines))
-        f.close()
+
+
+class BBNPredictor(object):
+    """
+    BBN predictions as a function of ombh2 and DeltaN = N_eff - 3.046, interpolated from a table with a 2D spline.
+    All functions accept numpy arrays of ombh2 and DeltaN (broadcast together).
+
+    The table is read from a file in the format written by :func:`write_table`, or made
+    with :func:`make_table`. Tables with irregular ombh2 values (from AlterBBN) are first interpolated onto
+    a regular grid in ombh2 for each DeltaN.
+
+    :param table: filename of a BBN table, or None to make a table from the fitting formulae
+    :param tau: neutron lifetime in seconds, for making a new table (must match a table read from file)
+    :param processes: number of processes to use if making the table
+    """
+
+    def __init__(self, table=None, tau=tau_n, processes=None):
+        from scipy.interpolate import RectBivariateSpline, InterpolatedUnivariateSpline
+
+        self.tau = tau
+        if table is None:
+            data = np.vstack(make_table(tau=tau, processes=processes))
+        else:
+            data = np.loadtxt(table)
+        self.DeltaNs = np.unique(data[:, 2])
+        columns = [data[data[:, 2] == DeltaN] for DeltaN in self.DeltaNs]
+        self.ombh2s = columns[0][:, 0]
+        self.ombh2_range = (max(col[0, 0] for col in columns), min(col[-1, 0] for col in columns))
+        self.ombh2s = self.ombh2s[(self.ombh2s >= self.ombh2_range[0]) & (self.ombh2s <= self.ombh2_range[1])]
+        self.splines = {}
+        for name, ix in [('Y_He', 3), ('Y_BBN', 4), ('DH', 6)]:
+            values = np.empty((self.ombh2s.size, self.DeltaNs.size))
+            for i, col in enumerate(columns):
+                values[:, i] = InterpolatedUnivariateSpline(col[:, 0], col[:, ix])(self.ombh2s)
+            self.splines[name] = RectBivariateSpline(self.ombh2s, self.DeltaNs, values)
+
+    def _interpolate(self, name, ombh2, delta_neff):
+        ombh2, delta_neff = np.broadcast_arrays(np.asarray(ombh2, dtype=np.float64),
+                                                np.asarray(delta_neff, dtype=np.float64))
+        if np.any((ombh2 < self.ombh2_range[0]) | (ombh2 > self.ombh2_range[1])) or \
+                np.any((delta_neff < self.DeltaNs[0]) | (delta_neff > self.DeltaNs[-1])):
+            raise ValueError('ombh2 or DeltaN outside range of BBN table')
+        res = self.splines[name].ev(ombh2.ravel(), delta_neff.ravel()).reshape(ombh2.shape)
+        return res if res.ndim else float(res)
+
+    def Y_He(self, ombh2, delta_neff=0.):
+        """
+        Helium mass fraction, as used by CMB codes (YHe)
+
+        :param ombh2: physical baryon density
+        :param delta_neff: additional effective number of neutrinos
+        :return: YHe
+        """
+        return self._interpolate('Y_He', ombh2, delta_neff)
+
+    def Y_BBN(self, ombh2, delta_neff=0.):
+        """
+        BBN-standard nucleon number fraction of Helium
+
+        :param ombh2: physical baryon density
+        :param delta_neff: additional effective number of neutrinos
+        :return: Yp^BBN
+        """
+        return self._interpolate('Y_BBN', ombh2, delta_neff)
+
+    def DH(self, ombh2, delta_neff=0.):
+        """
+        Deuterium abundance D/H
+
+        :param ombh2: physical baryon density
+        :param delta_neff: additional effective number of neutrinos
+        :return: D/H
+        """
+        return self._interpolate('DH', ombh2, delta_neff)
+
+
+_predictors = {}
+_default_predictor = None
+
+
+def get_predictor(table=None, tau=tau_n):
+    """
+    Get a :class:`BBNPredictor`, made the first time it is needed and then cached.
+
+    :param table: filename of a BBN table, or None to use the fitting formulae
+    :param tau: neutron lifetime in seconds
+    :return: :class:`BBNPredictor` instance
+    """
+    key = (table, tau)
+    if key not in _predictors:
+        _predictors[key] = BBNPredictor(table, tau)
+    return _predictors[key]
+
+
+def set_default_predictor(predictor):
+    """
+    Set a :class:`BBNPredictor` to be used by :meth:`.model.CAMBparams.set_bbn_helium` (and hence set_cosmology),
+    e.g. to use a table from AlterBBN. If None (default) the fitting formula :func:`yhe_fit` is used directly.
+
+    :param predictor: :class:`BBNPredictor` instance or None
+    """
+    global _default_predictor
+    _default_predictor = predictor
+
+
+def get_default_predictor():
+    """
+    Get the :class:`BBNPredictor` set by :func:`set_default_predictor`
+
+    :return: :class:`BBNPredictor` instance, or None
+    """
+    return _default_predictor
+
+
+if __name__ == "__main__":
+    # Make interpolation table
+    columns = make_table(alter_bbn=alterBBN)
+    if alterBBN:
+        write_table('BBN_full_alterBBN_' + str(tau_n) + '.dat', columns, alter_bbn=True)
+    else:
+        write_table('BBN_full_Parthenelope_' + str(tau_n) + '.dat', columns)
@@ -1,12 +1,12 @@
 from .baseconfig import camblib, CAMBError, CAMB_Structure, dll_import
 import ctypes
 from ctypes import c_float, c_int, c_double, c_bool, POINTER, byref
-from . import model, constants, initialpower, lensing
+from . import model, constants, initialpower, lensing, nonlinear
 import numpy as np
-from numpy import ctypeslib as nplib
 from numpy.ctypeslib import ndpointer
 import logging
 import sys
+from collections import OrderedDict
 from inspect import ismethod, getargspec
 import six
 
@@ -170,8 +170,44 @@ CAMB_TimeEvolution.argtypes = [int_arg, numpy_1d, int_arg, numpy_1d,
 CAMB_BackgroundEvolution = camblib.__thermodata_MOD_getbackgroundevolution
 CAMB_BackgroundEvolution.argtypes = [int_arg, numpy_1d, numpy_2d]
 
+# Array arguments of background functions with more than this many elements are evaluated from a cubic spline
+# in log(a) with background_spline_steps nodes per unit log(a), instead of calculating every element individually
+background_spline_min_size = 1000
+background_spline_steps = 100
 
-class MatterTransferData(object):
+# Incremented whenever the background or power spectra are recalculated, so cached background splines and
+# cached results can be checked for validity (the native background and power spectrum functions use the
+# parameters of the most recent calculation with any CAMBdata instance)
+_background_version = 0
+
+
+def _background_changed():
+    global _background_version
+    _background_version += 1
+
+
+class _ResultArrays(object):
+    """
+    Base class for result data holding numpy arrays, which may be copies or read-only views of CAMB's memory.
+    Can be used as a context manager, releasing the arrays (and any views) on exit.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def release(self):
+        """
+        Remove references to all stored arrays, e.g. so views no longer hold the source :class:`CAMBdata`
+        """
+        for name, value in list(self.__dict__.items()):
+            if isinstance(value, np.ndarray):
+                setattr(self, name, None)
+
+
+class MatterTransferData(_ResultArrays):
     """
     MatterTransferData is the base class for storing matter power transfer function data for various q values.
     In a flat universe q=k, in a closed universe q is quantised.
@@ -214,7 +250,7 @@ class MatterTransferData(object):
         return self.transfer_data[model.transfer_names.index(name), :, z_index]
 
 
-class ClTransferData(object):
+class ClTransferData(_ResultArrays):
     """
     ClTransferData is the base class for storing CMB power transfer functions, as a function of q and l.
     To get an instance of this data, call :meth:`camb.CAMBdata.get_cmb_transfer_data`
@@ -246,7 +282,33 @@ def set_default_params(P):
     return P
 
 
-def fortran_array(c_pointer, shape, dtype=np.float64, order='F', own_data=True):
+class _ArrayOwner(object):
+    # Exposes a view of CAMB memory to numpy, as the base of the view array, holding a reference to the owner
+    # (e.g. CAMBdata) so that the memory is not freed while the view exists
+
+    def __init__(self, arr, owner):
+        self.__array_interface__ = arr.__array_interface__
+        self._arr = arr
+        self.owner = owner
+        owner._views += 1
+
+    def __del__(self):
+        self.owner._release_view()
+
+
+def fortran_array(c_pointer, shape, dtype=np.float64, order='F', own_data=True, owner=None):
+    """
+    Get numpy array for Fortran array data at given pointer.
+
+    :param c_pointer: ctypes pointer to the data
+    :param shape: shape of the array
+    :param dtype: numpy type of the data
+    :param order: 'F' for Fortran-ordered data
+    :param own_data: if True return a copy of the data, otherwise a read-only view of the memory
+    :param owner: for views, object owning the memory, with _views counter and _release_view method
+        (see :class:`CAMBdata`). The returned array holds a reference to the owner.
+    :return: numpy array
+    """
     if not hasattr(shape, '__len__'):
         shape = np.atleast_1d(shape)
     arr_size = np.prod(shape[:]) * np.dtype(dtype).itemsize
@@ -262,10 +324,28 @@ def fortran_array(c_pointer, shape, dtype=np.float64, order='F', own_data=True):
     arr = np.ndarray(tuple(shape[:]), dtype, buffer, order=order)
     if own_data and not arr.flags.owndata:
         return arr.copy()
+    elif owner is not None:
+        return np.asarray(_ArrayOwner(arr, owner))
     else:
         return arr
 
 
+def _c_double_loop(func, *args):
+    # call func with pointers to double for each element of the broadcast array arguments
+    args = np.broadcast_arrays(*[np.asarray(arg, dtype=np.float64) for arg in args])
+    res = np.empty(args[0].shape)
+    for i, values in enumerate(zip(*[arg.ravel() for arg in args])):
+        res.flat[i] = func(*[byref(c_double(value)) for value in values])
+    return res
+
+
+def _log_spline(logmin, logmax, calc):
+    # cubic spline of log(calc(x)) in log(x) over the range logmin to logmax
+    from scipy.interpolate import InterpolatedUnivariateSpline
+    nodes = np.linspace(logmin, logmax, max(int(np.ceil((logmax - logmin) * background_spline_steps)) + 1, 8))
+    return InterpolatedUnivariateSpline(nodes, np.log(calc(np.exp(nodes))))
+
+
 def set_z_outputs(z_outputs):
     """
     Set the redshifts for calculating BAO parameters at
@@ -286,6 +366,10 @@ class CAMBdata(object):
 
     To quickly make a fully calculated CAMBdata instance for a set of parameters you can call :func:`get_results`.
 
+    Transfer data can be returned as read-only views of the calculated results (copy=False) rather than copies.
+    Views hold a reference to the CAMBdata instance; calling :meth:`free` while they exist only frees the results
+    once the views are deleted, and transfer functions cannot be re-calculated until they are.
+
     :ivar Params: the :class:`.model.CAMBparams` parameters being used
 
     """
@@ -295,6 +379,10 @@ class CAMBdata(object):
         CAMBdata_new(byref(self._key))
         self.Params = self.get_params()
         self._one = c_int(1)
+        self._redshift_spline = None
+        self._log_splines = {}
+        self._views = 0
+        self._free_pending = False
 
     def __enter__(self):
         return self
@@ -306,10 +394,22 @@ class CAMBdata(object):
         self.free()
 
     def free(self):
-        if self._key:
+        if self._views:
+            self._free_pending = True
+        elif self._key:
             CAMBdata_free(byref(self._key))
             self._key = None
 
+    def _release_view(self):
+        self._views -= 1
+        if self._free_pending and not self._views:
+            self.free()
+
+    def _check_no_views(self):
+        if self._views:
+            raise CAMBError('Cannot re-calculate while %s read-only views of results exist; '
+                            'delete or release them (or get copies)' % self._views)
+
     def set_params(self, params):
         """
         Set parameters from params
@@ -374,6 +474,7 @@ class CAMBdata(object):
 
         :param params:  :class:`.model.CAMBparams` instance to use
         """
+        _background_changed()
         CAMB_SetParamsForBackground(self._key, byref(params))
 
     def calc_background(self, params):
@@ -382,6 +483,7 @@ class CAMBdata(object):
         e.g. call this if you want to get derived parameters and call background functions
         :param params:  :class:`.model.CAMBparams` instance to use
         """
+        _background_changed()
         res = CAMB_CalcBackgroundTheory(self._key, byref(params))
         if res:
             raise CAMBError('Error %s in calc_background' % res)
@@ -394,8 +496,10 @@ class CAMBdata(object):
         :param only_transfers: only calculate transfer functions, no power spectra
         :return: non-zero if error, zero if OK
         """
+        self._check_no_views()
         opt = c_bool()
         opt.value = only_transfers
+        _background_changed()
         return CAMBdata_gettransfers(self._key, byref(params), byref(opt))
 
     def calc_power_spectra(self, params=None):
@@ -410,6 +514,7 @@ class CAMBdata(object):
             if result != 0:
                 raise CAMBError('Error getting transfer functions: %u' % result)
         else:
+            _background_changed()
             CAMBdata_transferstopowers(self._key)
 
     def power_spectra_from_transfer(self, initial_power_params):
@@ -423,8 +528,202 @@ class CAMBdata(object):
         if initial_power_params.has_tensors() and not self.Params.WantTensors:
             raise CAMBError('r>0 but params.WantTensors = F')
         self.get_params().set_initial_power(initial_power_params)
+        _background_changed()
         CAMBdata_transferstopowers(self._key)
 
+    def get_power_spectra_batch(self, initial_powers, lmax=None,
+                                spectra=['total', 'unlensed_scalar', 'unlensed_total', 'lensed_scalar', 'tensor',
+                                         'lens_potential'], matter_power=False, exact=False):
+        """
+        Get CMB power spectra (and optionally linear matter power spectra) for many sets of initial power
+        spectrum parameters, re-using the transfer functions.
+
+        Must have calculated transfer functions (e.g. using :func:`get_transfer_functions` or
+        :func:`get_results`), with params.WantTensors set if any sets have r>0.
+
+        By default (exact=False) the CMB spectra are a fast approximation, much faster than native calculations
+        for large numbers of sets. The C_l are calculated by a single matrix product of the stored CMB transfer
+        functions with all the primordial power spectra, and interpolated in L with a second matrix product.
+        The normalization in L is calibrated using the native result for the current initial power parameters,
+        and lensing is calculated using :func:`.correlations.lensed_cls_batch` as a change relative to the native
+        lensed result. Results are therefore exact for the current parameters, with errors that grow with the
+        distance from them: fractional differences from the native result are typically below 1e-4 for nearby
+        parameters (e.g. as sampled in fast-slow MCMC), but can reach ~1e-3 for large changes in the shape of
+        the primordial spectrum. Linear matter power spectra are exact.
+
+        If exact=True, the spectra for each set are instead calculated in turn using
+        :meth:`power_spectra_from_transfer` and :meth:`get_cmb_power_spectra`, giving the native results
+        (but no faster than doing that directly).
+
+        :param initial_powers: list of :class:`.initialpower.InitialPowerParams` or tabulated
+            :class:`.initialpower.SplinedInitialPower` instances, or of dictionaries of
+            arguments for :meth:`.initialpower.InitialPowerParams.set_params` (e.g. As, ns, nrun, r)
+        :param lmax: maximum L
+        :param spectra: list of names of spectra to get, as for :meth:`get_cmb_power_spectra`
+        :param matter_power: if True, also get linear matter power spectra as for
+            :meth:`get_linear_matter_power_spectrum`
+        :param exact: if True, calculate native spectra for each set rather than the fast approximation
+        :return: dictionary of arrays CL[i, 0:lmax+1, ix] for each set i, indexed by names of requested spectra.
+            If matter_power, also 'kh', 'z' and 'matter_power' with PK[i, z_index, k_index]
+        """
+        import copy
+        from . import correlations
+
+        powers = []
+        for power in initial_powers:
+            if isinstance(power, dict):
+                power = initialpower.InitialPowerParams().set_params(**power)
+            powers.append(power)
+        want_tensors = any(power.has_tensors() for power in powers)
+        if want_tensors and not self.Params.WantTensors:
+            raise CAMBError('r>0 but params.WantTensors = F')
+        unknown = set(spectra) - {'total', 'unlensed_scalar', 'unlensed_total', 'lensed_scalar', 'tensor',
+                                  'lens_potential'}
+        if unknown:
+            raise CAMBError('Unknown spectra %s' % unknown)
+        if exact:
+            return self._power_spectra_batch_exact(powers, lmax, spectra, matter_power)
+
+        # native result for the reference parameters, with tensors so their normalization can be calibrated
+        ref_power = copy.deepcopy(self.Params.InitPower)
+        cal_power = copy.deepcopy(ref_power)
+        want_tensors = want_tensors or self.Params.WantTensors and ref_power.has_tensors()
+        if want_tensors and not cal_power.has_tensors():
+            cal_power.rat[0] = 1
+        self.power_spectra_from_transfer(cal_power)
+        try:
+            powers.insert(0, cal_power)
+
+            lmax_unlensed = self.Params.max_l
+            if self.Params.DoLensing:
+                lmax_calc = model.lmax_lensed.value
+            else:
+                lmax_calc = lmax_unlensed
+            if lmax is None:
+                lmax = lmax_calc
+            elif lmax > lmax_calc:
+                logging.warning('getting CMB power spectra to higher L than calculated, may be innacurate/zeroed.')
+
+            res = {}
+            scalar = np.zeros((len(powers), lmax_unlensed + 1, 4))
+            lens_potential = np.zeros((len(powers), lmax_unlensed + 1, 3))
+            if self.Params.WantScalars:
+                ref = np.hstack((self.get_unlensed_scalar_cls(lmax_unlensed),
+                                 self.get_lens_potential_cls(lmax_unlensed)))
+                # TT, EE, TE, PP, PT, PE
+                cols = [0, 1, 3, 4, 5, 6]
+                cls = self._cl_projection_batch('scalar', [(0, 0), (1, 1), (0, 1), (2, 2), (2, 0), (2, 1)],
+                                                powers, lmax_unlensed, ref[:, cols], [(2, 0, 1), (4, 3, 0), (5, 3, 1)])
+                scalar[:, :, [0, 1, 3]] = cls[:, :, :3]
+                lens_potential[:] = cls[:, :, 3:]
+            tensor = np.zeros(scalar.shape)
+            if want_tensors:
+                tensor[:] = self._cl_projection_batch('tensor', [(0, 0), (1, 1), (2, 2), (0, 1)], powers,
+                                                      lmax_unlensed, self.get_tensor_cls(lmax_unlensed), [(3, 0, 1)])
+            if 'total' in spectra or 'lensed_scalar' in spectra:
+                if self.Params.DoLensing:
+                    lensed_ref = self.get_lensed_scalar_cls(lmax_calc)
+                    delta = correlations.lensed_cls_batch(scalar, lens_potential[:, :, 0], lmax_lensed=lmax_calc,
+                                                          delta_cls=True)
+                    lensed = scalar[:, :lmax_calc + 1, :] + delta
+                    lensed += lensed_ref - lensed[0]
+                else:
+                    lensed = scalar[:, :lmax_calc + 1, :]
+                lensed_scalar = np.zeros((len(powers), lmax + 1, 4))
+                lensed_scalar[:, :min(lmax, lmax_calc) + 1, :] = lensed[:, :lmax + 1, :]
+
+            for spectrum in spectra:
+                if spectrum == 'lensed_scalar':
+                    cls = lensed_scalar
+                elif spectrum == 'total':
+                    cls = lensed_scalar + tensor[:, :lmax + 1, :]
+                else:
+                    cls = {'unlensed_scalar': scalar, 'unlensed_total': scalar + tensor, 'tensor': tensor,
+                           'lens_potential': lens_potential}[spectrum]
+                if cls.shape[1] < lmax + 1:
+                    cls = np.concatenate((cls, np.zeros((cls.shape[0], lmax + 1 - cls.shape[1], cls.shape[2]))), axis=1)
+                res[spectrum] = cls[1:, :lmax + 1, :]
+
+            if matter_power:
+                kh, z, pk = self.get_linear_matter_power_spectrum(have_power_spectra=True)
+                primordial = self._primordial_power_batch(powers, kh * (self.Params.H0 / 100), 0)
+                res['kh'], res['z'] = kh, z
+                res['matter_power'] = pk[np.newaxis, :, :] * (primordial[:, 1:] / primordial[:, :1]).T[:, np.newaxis, :]
+        finally:
+            # restore the native result for the reference parameters, also if there is an error
+            if cal_power.canonical_key() != ref_power.canonical_key():
+                self.power_spectra_from_transfer(ref_power)
+        return res
+
+    def _power_spectra_batch_exact(self, powers, lmax, spectra, matter_power):
+        # native spectra for each set of initial power parameters in turn, as get_power_spectra_batch
+        import copy
+        ref_power = copy.deepcopy(self.Params.InitPower)
+        res = {}
+        try:
+            for i, power in enumerate(powers):
+                self.power_spectra_from_transfer(power)
+                cls = self.get_cmb_power_spectra(lmax=lmax, spectra=spectra)
+                if matter_power:
+                    cls['kh'], cls['z'], cls['matter_power'] = \
+                        self.get_linear_matter_power_spectrum(have_power_spectra=True)
+                for name, value in cls.items():
+                    if name in ['kh', 'z']:
+                        res[name] = value
+                    else:
+                        res.setdefault(name, np.empty((len(powers),) + value.shape))[i] = value
+        finally:
+            self.power_spectra_from_transfer(ref_power)
+        return res
+
+    def _primordial_power_batch(self, powers, k, ix):
+        # primordial power P[k, i] for each of a list of InitialPowerParams or SplinedInitialPower
+        return initialpower.primordial_power_batch(powers, k, ix, self.Params.curv).T
+
+    def _cl_projection_batch(self, tp, pairs, powers, lmax, ref, crosses):
+        # C_L for each pair of sources and each primordial power, normalized to match ref (for powers[0])
+        # using auto-spectrum ratios; crosses is list of (cross, auto1, auto2) pair indices, with the cross-spectrum
+        # normalization the geometric mean of the auto-spectrum normalizations
+        from scipy.interpolate import InterpolatedUnivariateSpline
+        with self.get_cmb_transfer_data(tp, copy=False) as trans:
+            q = trans.q
+            dq = np.empty(q.shape)
+            dq[1:-1] = (q[2:] - q[:-2]) / 2
+            dq[0] = (q[1] - q[0]) / 2
+            dq[-1] = (q[-1] - q[-2]) / 2
+            pairs = [(i, j) for i, j in pairs if max(i, j) < trans.NumSources]
+            kernel = np.empty((len(pairs), trans.l.shape[0], q.shape[0]))
+            for ix, (i, j) in enumerate(pairs):
+                np.multiply(trans.delta_p_l_k[i], trans.delta_p_l_k[j], kernel[ix])
+            kernel *= dq / q
+            ls = np.array(trans.l, dtype=np.float64)
+            q = q.copy()
+        primordial = self._primordial_power_batch(powers, q, 2 if tp == 'tensor' else 0)
+        projected = np.dot(kernel.reshape(-1, q.shape[0]), primordial).reshape(len(pairs), ls.shape[0], -1)
+        # cubic spline interpolation in L is linear, so apply as a matrix
+        ls = ls[ls <= lmax]
+        L = np.arange(ls[0], ls[-1] + 1)
+        interp = np.empty((L.shape[0], ls.shape[0]))
+        for ix, unit in enumerate(np.eye(ls.shape[0])):
+            interp[:, ix] = InterpolatedUnivariateSpline(ls, unit)(L)
+        cls = np.zeros((len(powers), lmax + 1, len(pairs)))
+        cls[:, int(ls[0]):int(ls[-1]) + 1, :] = np.tensordot(projected[:, :ls.shape[0], :], interp,
+                                                             axes=(1, 1)).transpose(1, 2, 0)
+        norms = np.zeros((lmax + 1, len(pairs)))
+        for ix, (i, j) in enumerate(pairs):
+            if i == j:
+                valid = cls[0, :, ix] > 0
+                norms[valid, ix] = ref[valid, ix] / cls[0, valid, ix]
+        for cross, auto1, auto2 in crosses:
+            if cross < len(pairs):
+                norms[:, cross] = np.sqrt(norms[:, auto1] * norms[:, auto2])
+                if np.dot(norms[:, cross] * cls[0, :, cross], ref[:, cross]) < 0:
+                    norms[:, cross] *= -1
+        cls *= norms
+        if len(pairs) < ref.shape[1]:
+            cls = np.concatenate((cls, np.zeros(cls.shape[:2] + (ref.shape[1] - len(pairs),))), axis=2)
+        return cls
+
     def get_cmb_power_spectra(self, params=None, lmax=None,
                               spectra=['total', 'unlensed_scalar', 'unlensed_total', 'lensed_scalar', 'tensor',
                                        'lens_potential']):
@@ -485,73 +784,131 @@ class CAMBdata(object):
         else:
             return correlations.cl2corr(cls, xvals, lmax=lmax)
 
-    def get_cmb_transfer_data(self, tp='scalar'):
+    def get_cmb_transfer_data(self, tp='scalar', copy=True):
         """
         Get C_l transfer functions
 
-        :return: class:`.ClTransferData` instance holding output arrays (copies, not pointers)
+        :param tp: 'scalar', 'vector' or 'tensor'
+        :param copy: if False, arrays are read-only views of the results rather than copies, e.g.::
+
+            with results.get_cmb_transfer_data(copy=False) as trans:
+                delta = trans.delta_p_l_k[0, :, :].copy()
+
+        :return: class:`.ClTransferData` instance holding output arrays (copies, not pointers, unless copy=False)
         """
         cdata = _ClTransferData()
         CAMBdata_cltransferdata(self._key, byref(cdata), byref(c_int(['scalar', 'vector', 'tensor'].index(tp))))
         data = ClTransferData()
         data.NumSources = cdata.NumSources
-        data.q = fortran_array(cdata.q, cdata.q_size)
-        data.l = fortran_array(cdata.l, cdata.l_size, dtype=c_int)
-        data.delta_p_l_k = fortran_array(cdata.delta_p_l_k, cdata.delta_size)
+        data.q = fortran_array(cdata.q, cdata.q_size, own_data=copy, owner=self)
+        data.l = fortran_array(cdata.l, cdata.l_size, dtype=c_int, own_data=copy, owner=self)
+        data.delta_p_l_k = fortran_array(cdata.delta_p_l_k, cdata.delta_size, own_data=copy, owner=self)
         return data
 
-    def get_time_evolution(self, q, eta, vars=model.evolve_names, lAccuracyBoost=4):
+    def get_time_evolution(self, q, eta, vars=model.evolve_names, lAccuracyBoost=4, k_chunk=None, out=None,
+                           n_workers=1):
         """
         Get the mode evolution as a function of conformal time for some k values.
 
+        For large numbers of k and times, set k_chunk to calculate the modes in chunks, and out to an array or
+        file name to write the results into (a .npy file is written as a memory-mapped array), so that
+        memory use is only that of the output and one chunk. With n_workers > 1, the chunks are calculated in
+        separate processes using :func:`.grid.run_grid`, each calculating the background for the current parameters.
+
         :param q: wavenumber values to calculate (or array of k values)
         :param eta: array of requested conformal times to output
         :param vars: list of variable names to output
+        :param lAccuracyBoost: boost factor for ell accuracy (e.g. to get nice smooth curves for plotting)
+        :param k_chunk: number of k values to calculate at once (default: all)
+        :param out: optional array of shape size(q) x size(times) x len(vars) to hold the result,
+            or name of a .npy file to save it to as a memory-mapped array
+        :param n_workers: number of processes to calculate the chunks in parallel
         :return: nd array, A_{qti}, size(q) x size(times) x len(vars), or 2d array if q is scalar
         """
-
-        try:
-            old_boost = model._lAccuracyBoost.value
-            model._lAccuracyBoost.value = lAccuracyBoost
-            unknown = set(vars) - set(model.evolve_names)
-            if unknown:
-                raise CAMBError('Unknown names %s; valid names are %s' % (unknown, model.evolve_names))
-            if np.isscalar(q):
-                k = np.array([q], dtype=np.float64)
-            else:
-                k = np.array(q, dtype=np.float64)
-            if not isinstance(vars, (tuple, list)):
-                variables = [vars]
-            else:
-                variables = vars
-            times = np.array(eta, dtype=np.float64)
-            indices = np.argsort(times)  # times must be in increasing order
-            nvars = model.Transfer_max + 8
-            outputs = np.empty((k.shape[0], times.shape[0], nvars))
-
-            if CAMB_TimeEvolution(byref(c_int(k.shape[0])), k, byref(c_int(times.shape[0])), times[indices],
-                                  byref(c_int(nvars)), outputs): raise CAMBError('Error in evolution')
-            ix = np.array([model.evolve_names.index(var) for var in variables])
-            i_rev = np.zeros(times.shape, dtype=int)
-            i_rev[indices] = np.arange(times.shape[0])
-            outputs = outputs[:, i_rev, :]
-        finally:
-            model._lAccuracyBoost.value = old_boost
-        if np.isscalar(q):
-            return outputs[0, :, :][:, ix]
+        scalar = np.isscalar(q)
+        k = np.atleast_1d(np.array(q, dtype=np.float64))
+        if not isinstance(vars, (tuple, list)):
+            variables = [vars]
         else:
-            return outputs[:, :, ix]
+            variables = vars
+        shape = (k.shape[0], np.size(eta), len(variables))
+        if isinstance(out, six.string_types):
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64, shape=shape)
+        elif out is None:
+            out = np.empty(shape)
+        elif out.shape != shape:
+            raise CAMBError('out array must have shape %s' % (shape,))
+        chunks = self.iter_time_evolution(k, eta, variables, lAccuracyBoost, k_chunk or k.shape[0], n_workers)
+        for k_slice, evolution in chunks:
+            out[k_slice] = evolution
+        if scalar:
+            return out[0]
+        else:
+            return out
+
+    def iter_time_evolution(self, q, eta, vars=model.evolve_names, lAccuracyBoost=4, k_chunk=64, n_workers=1):
+        """
+        Generator calculating the mode evolution as a function of conformal time in chunks of k values,
+        see :meth:`get_time_evolution`.
 
-    def get_redshift_evolution(self, q, z, vars=model.evolve_names, lAccuracyBoost=4):
+        :param q: array of k values
+        :param eta: array of requested conformal times to output
+        :param vars: list of variable names to output
+        :param lAccuracyBoost: boost factor for ell accuracy
+        :param k_chunk: number of k values to calculate at once
+        :param n_workers: number of processes to calculate the chunks in parallel
+            (chunks are then generated in the order they finish)
+        :return: generator of (k_slice, A_{qti}) tuples, where A is the evolution for the k values q[k_slice]
+        """
+        unknown = set(vars) - set(model.evolve_names)
+        if unknown:
+            raise CAMBError('Unknown names %s; valid names are %s' % (unknown, model.evolve_names))
+        k = np.atleast_1d(np.array(q, dtype=np.float64))
+        times = np.array(eta, dtype=np.float64)
+        slices = [slice(i, min(i + k_chunk, k.shape[0])) for i in range(0, k.shape[0], k_chunk)]
+        if n_workers > 1 and len(slices) > 1:
+            from . import grid
+            params = model.CAMBparams.from_buffer_copy(self.Params)
+            jobs = ((params, k[k_slice], times, list(vars), lAccuracyBoost) for k_slice in slices)
+            for res in grid.run_grid(jobs, _time_evolution_job, processes=n_workers, ordered=False,
+                                     initializer=set_result_cache, initargs=(1,)):
+                if res.error:
+                    raise CAMBError('Error in evolution: %s' % res.error)
+                yield slices[res.index], res.result
+            return
+        # outputs are calculated for times in increasing order, with all variables
+        indices = np.argsort(times)
+        i_rev = np.zeros(times.shape, dtype=int)
+        i_rev[indices] = np.arange(times.shape[0])
+        ix = np.array([model.evolve_names.index(var) for var in vars])
+        nvars = model.Transfer_max + 8
+        outputs = np.empty((min(k_chunk, k.shape[0]), times.shape[0], nvars))
+        for k_slice in slices:
+            nk = k_slice.stop - k_slice.start
+            try:
+                old_boost = model._lAccuracyBoost.value
+                model._lAccuracyBoost.value = lAccuracyBoost
+                if CAMB_TimeEvolution(byref(c_int(nk)), k[k_slice], byref(c_int(times.shape[0])), times[indices],
+                                      byref(c_int(nvars)), outputs[:nk]): raise CAMBError('Error in evolution')
+            finally:
+                model._lAccuracyBoost.value = old_boost
+            yield k_slice, outputs[:nk, i_rev[:, np.newaxis], ix]
+
+    def get_redshift_evolution(self, q, z, vars=model.evolve_names, lAccuracyBoost=4, k_chunk=None, out=None,
+                               n_workers=1):
         """
         Get the mode evolution as a function of redshift for some k values.
 
         :param q: wavenumber values to calculate (or array of k values)
         :param z: array of redshifts to output
         :param vars: list of variable names to output
+        :param lAccuracyBoost: boost factor for ell accuracy
+        :param k_chunk: number of k values to calculate at once, see :meth:`get_time_evolution`
+        :param out: optional output array or .npy file name, see :meth:`get_time_evolution`
+        :param n_workers: number of processes to calculate the chunks in parallel
         :return: nd array, A_{qti}, size(q) x size(times) x len(vars), or 2d array if q is scalar
         """
-        return self.get_time_evolution(q, self.conformal_time(z), vars, lAccuracyBoost)
+        return self.get_time_evolution(q, self.conformal_time(z), vars, lAccuracyBoost, k_chunk, out, n_workers)
 
     def get_background_time_evolution(self, eta, vars=model.background_names, format='dict'):
         """
@@ -592,11 +949,16 @@ class CAMBdata(object):
 
         return self.get_background_time_evolution(self.conformal_time(z), vars, format)
 
-    def get_matter_transfer_data(self):
+    def get_matter_transfer_data(self, copy=True):
         """
         Get matter transfer function data and sigma8 for calculated results.
 
-        :return: :class:`.MatterTransferData` instance holding output arrays (copies, not pointers)
+        :param copy: if False, arrays are read-only views of the results rather than copies, e.g.::
+
+            with results.get_matter_transfer_data(copy=False) as trans:
+                delta_cdm = trans.transfer_z('delta_cdm')
+
+        :return: :class:`.MatterTransferData` instance holding output arrays (copies, not pointers, unless copy=False)
         """
         if not self.Params.WantTransfer:
             raise CAMBError("must have Params.WantTransfer to get matter transfers and power")
@@ -605,10 +967,12 @@ class CAMBdata(object):
         CAMBdata_mattertransferdata(self._key, byref(cdata))
         data = MatterTransferData()
         data.nq = cdata.num_q_trans
-        data.q = nplib.as_array(cdata.q_trans, shape=(data.nq,))
-        data.sigma_8 = fortran_array(cdata.sigma_8, cdata.sigma_8_size)
-        data.sigma2_vdelta_8 = fortran_array(cdata.sigma2_vdelta_8, cdata.sigma2_vdelta_8_size)
-        data.transfer_data = fortran_array(cdata.TransferData, cdata.TransferData_size, dtype=np.float32)
+        data.q = fortran_array(cdata.q_trans, data.nq, own_data=copy, owner=self)
+        data.sigma_8 = fortran_array(cdata.sigma_8, cdata.sigma_8_size, own_data=copy, owner=self)
+        data.sigma2_vdelta_8 = fortran_array(cdata.sigma2_vdelta_8, cdata.sigma2_vdelta_8_size, own_data=copy,
+                                             owner=self)
+        data.transfer_data = fortran_array(cdata.TransferData, cdata.TransferData_size, dtype=np.float32,
+                                           own_data=copy, owner=self)
         return data
 
     def _transfer_var(self, var1, var2):
@@ -714,6 +1078,35 @@ class CAMBdata(object):
         z.reverse()
         return minkh * np.exp(np.arange(npoints) * dlnkh), z, PK
 
+    def get_matter_power_interpolator(self, nonlinear=True, var1=None, var2=None, hubble_units=True, k_hunit=True,
+                                      return_z_k=False, log_interp=True):
+        """
+        Get a :class:`MatterPowerInterpolator` for the matter power spectrum at the calculated redshifts and k values,
+        without recalculating. Must have already calculated power spectra (e.g. with :func:`get_results` for
+        parameters with redshifts set by :meth:`.model.CAMBparams.set_matter_power`).
+
+        :param nonlinear: include non-linear correction from halo model
+        :param var1: variable i (index, or name of variable; default delta_tot)
+        :param var2: variable j (index, or name of variable; default delta_tot)
+        :param hubble_units: if true, output power spectrum in (Mpc/h)^{-3} units, otherwise Mpc^{-3}
+        :param k_hunit: if true, matter power is a function of k/h, if false, just k (both Mpc^{-1} units)
+        :param return_z_k: if true, return interpolator, z, k where z, k are the grid used
+        :param log_interp: if true, interpolate log of power spectrum (unless any values are negative in which case
+            ignored)
+        :return: :class:`MatterPowerInterpolator` PK, or if return_z_k=True, PK, z, k
+        """
+        if not self.Params.WantTransfer or self.Params.Transfer.PK_num_redshifts < 2:
+            raise CAMBError('Need matter power spectra at two or more redshifts for interpolation')
+        kh, z, pk = self.get_linear_matter_power_spectrum(var1, var2, hubble_units, have_power_spectra=True,
+                                                          nonlinear=nonlinear)
+        if not k_hunit:
+            kh *= self.Params.H0 / 100
+        res = MatterPowerInterpolator(z, kh, pk, log_interp)
+        if return_z_k:
+            return res, z, kh
+        else:
+            return res
+
     def get_total_cls(self, lmax):
         """
         Get lensed-scalar + tensor CMB power spectra. Must have already calculated power spectra.
@@ -817,9 +1210,9 @@ class CAMBdata(object):
         if np.isscalar(z):
             return AngularDiameterDistance(byref(c_double(z)))
         else:
-            z = np.asarray(z)
+            z = np.ascontiguousarray(z, dtype=np.float64)
             arr = np.empty(z.shape)
-            AngularDiameterDistanceArr(arr, z, byref(c_int(z.shape[0])))
+            AngularDiameterDistanceArr(arr, z, byref(c_int(z.size)))
             return arr
 
     def angular_diameter_distance2(self, z1, z2):
@@ -830,13 +1223,21 @@ class CAMBdata(object):
 
         Must have called calc_background, calc_background_no_thermo or calculated transfer functions or power spectra.
 
-        :param z1: redshift 1
-        :param z2: redshift 2
-        :return: result
-        """
-        if not np.isscalar(z1) or not np.isscalar(z2):
-            raise CAMBError('vector z not supported yet')
-        return AngularDiameterDistance2(byref(c_double(z1)), byref(c_double(z2)))
+        :param z1: redshift 1, or array of redshifts
+        :param z2: redshift 2, or array of redshifts (broadcast against z1)
+        :return: result, scalar or array of the broadcast shape of z1 and z2
+        """
+        if np.isscalar(z1) and np.isscalar(z2):
+            return AngularDiameterDistance2(byref(c_double(z1)), byref(c_double(z2)))
+        z1, z2 = np.broadcast_arrays(np.asarray(z1, dtype=np.float64), np.asarray(z2, dtype=np.float64))
+        if z1.size <= background_spline_min_size:
+            return _c_double_loop(AngularDiameterDistance2, z1, z2)
+        chi = self.conformal_time_a1_a2(1 / (1 + z2), 1 / (1 + z1))
+        omk = self.Params.get_omega_k()
+        if np.abs(omk) > 5e-7:
+            r = constants.c / 1e3 / self.Params.H0 / np.sqrt(np.abs(omk))
+            chi = r * (np.sinh(chi / r) if omk > 0 else np.sin(chi / r))
+        return chi / (1 + z2)
 
     def comoving_radial_distance(self, z):
         """
@@ -844,7 +1245,7 @@ class CAMBdata(object):
 
         Must have called calc_background, calc_background_no_thermo or calculated transfer functions or power spectra.
 
-        :param z: redshift
+        :param z: redshift or array of redshifts
         :return: comoving radial distance (Mpc)
         """
         if not np.isscalar(z):
@@ -852,26 +1253,49 @@ class CAMBdata(object):
         else:
             return ComovingRadialDistance(byref(c_double(z)))
 
-    def redshift_at_comoving_radial_distance(self, chi, nz_step=150, zmax=10000):
+    def redshift_at_comoving_radial_distance(self, chi, nz_step=150, zmax=10000, tol=1e-6):
         """
         Convert comoving radial distance array to redshift array.
-        This is not calculated directly, but fit from a spline to a forward calculation of chi from z
-        This is a utility routine, not optimized to be fast (though it can work on a large vector efficiently)
+        This is not calculated directly, but from a spline of log(1+z) as a function of chi, fit to a forward
+        calculation of chi from z. The grid in z is refined until the spline has fractional error in 1+z
+        less than tol at the mid-points of the grid.
+        The spline is calculated once and re-used until the background is re-calculated
+        (or nz_step, zmax or tol are changed), so repeated calls are fast.
 
         :param chi: comoving radial distance (in Mpc), scalar or array
-        :param nz_step: number of redshifts calculated internally for solving grid
+        :param nz_step: number of redshifts in the initial solving grid
         :param zmax: maximum redshift in internal solving grid
+        :param tol: required fractional accuracy of 1+z
         :return: redshift at chi, scalar or array
         """
 
-        zs = np.exp(np.log(zmax + 1) * np.linspace(0, 1, nz_step)) - 1
-        chis = self.conformal_time(0) - self.conformal_time(zs)
-        from scipy.interpolate import UnivariateSpline
-        f = UnivariateSpline(chis, zs, s=0)
+        key = (_background_version, nz_step, zmax, tol)
+        if self._redshift_spline is None or self._redshift_spline[0] != key:
+            self._redshift_spline = (key, self._redshift_distance_spline(nz_step, zmax, tol))
+        res = np.expm1(self._redshift_spline[1](chi))
         if np.isscalar(chi):
-            return np.asscalar(f(chi))
+            return float(res)
         else:
-            return f(chi)
+            return res
+
+    def _redshift_distance_spline(self, nz_step, zmax, tol, max_refine=12):
+        # spline of log(1+z) as a function of chi, refined at grid mid-points where error is larger than tol
+        from scipy.interpolate import InterpolatedUnivariateSpline
+        eta0 = self.conformal_time(0)
+        logzs = np.log(zmax + 1) * np.linspace(0, 1, nz_step)
+        chis = eta0 - self.conformal_time(np.expm1(logzs))
+        for _ in range(max_refine):
+            spline = InterpolatedUnivariateSpline(chis, logzs)
+            mid_logzs = (logzs[1:] + logzs[:-1]) / 2
+            mid_chis = eta0 - self.conformal_time(np.expm1(mid_logzs))
+            bad = np.abs(spline(mid_chis) - mid_logzs) > tol
+            if not np.any(bad):
+                return spline
+            indices = np.argsort(np.concatenate((logzs, mid_logzs[bad])), kind='mergesort')
+            logzs = np.concatenate((logzs, mid_logzs[bad]))[indices]
+            chis = np.concatenate((chis, mid_chis[bad]))[indices]
+        logging.warning('redshift_at_comoving_radial_distance did not reach tolerance %s' % tol)
+        return InterpolatedUnivariateSpline(chis, logzs)
 
     def luminosity_distance(self, z):
         """
@@ -891,12 +1315,13 @@ class CAMBdata(object):
 
         Must have called calc_background, calc_background_no_thermo or calculated transfer functions or power spectra.
 
-        :param z: redshift
+        :param z: redshift or array of redshifts
         :return: H(z)
         """
-        if not np.isscalar(z):
-            raise CAMBError('vector z not supported yet')
-        return Hofz(byref(c_double(z)))
+        if np.isscalar(z):
+            return Hofz(byref(c_double(z)))
+        return self._log_spline_eval(Hofz, 1 + np.asarray(z, dtype=np.float64),
+                                     lambda x: _c_double_loop(Hofz, x - 1))
 
     def hubble_parameter(self, z):
         """
@@ -904,7 +1329,7 @@ class CAMBdata(object):
 
         Must have called calc_background, calc_background_no_thermo or calculated transfer functions or power spectra.
 
-        :param z: redshift
+        :param z: redshift or array of redshifts
         :return: H(z)/[km/s/Mpc]
         """
         return constants.c * self.h_of_z(z) / 1e3
@@ -915,35 +1340,66 @@ class CAMBdata(object):
 
         Must have called calc_background, calc_background_no_thermo or calculated transfer functions or power spectra.
 
-        :param a1: scale factor 1
-        :param a2: scale factor 2
+        :param a1: scale factor 1, or array of scale factors
+        :param a2: scale factor 2, or array of scale factors (broadcast against a1)
         :return: (age(a2)-age(a1))/Gigayear
         """
-        if not np.isscalar(a1) or not np.isscalar(a2):
-            raise CAMBError('vector inputs not supported yet')
-        return DeltaPhysicalTimeGyr(byref(c_double(a1)), byref(c_double(a2)), None)
+        if np.isscalar(a1) and np.isscalar(a2):
+            return DeltaPhysicalTimeGyr(byref(c_double(a1)), byref(c_double(a2)), None)
+        return self._time_a1_a2(DeltaPhysicalTimeGyr, a1, a2)
 
     def physical_time(self, z):
         """
         Get physical time from hot big bang to redshift z in Gigayears.
 
-        :param z:  redshift
+        :param z:  redshift or array of redshifts
         :return: t(z)/Gigayear
         """
-        return self.physical_time_a1_a2(0, 1.0 / (1 + z))
+        return self.physical_time_a1_a2(0, 1.0 / (1 + np.asarray(z)))
 
     def conformal_time_a1_a2(self, a1, a2):
         """
         Get conformal time between two scale factors (=comoving radial distance travelled by light on light cone)
 
-        :param a1: scale factor 1
-        :param a2: scale factor 2
+        :param a1: scale factor 1, or array of scale factors
+        :param a2: scale factor 2, or array of scale factors (broadcast against a1)
         :return: eta(a2)-eta(a1) = chi(a1)-chi(a2) in Megaparsec
         """
 
-        if not np.isscalar(a1) or not np.isscalar(a2):
-            raise CAMBError('vector inputs not supported yet')
-        return DeltaTime(byref(c_double(a1)), byref(c_double(a2)), None)
+        if np.isscalar(a1) and np.isscalar(a2):
+            return DeltaTime(byref(c_double(a1)), byref(c_double(a2)), None)
+        return self._time_a1_a2(DeltaTime, a1, a2)
+
+    def _time_a1_a2(self, delta_time, a1, a2):
+        # delta_time(a1, a2) for broadcast arrays, from a spline of delta_time(0, a) if the arrays are large
+        a1, a2 = np.broadcast_arrays(np.asarray(a1, dtype=np.float64), np.asarray(a2, dtype=np.float64))
+        if a1.size <= background_spline_min_size:
+            return _c_double_loop(lambda x1, x2: delta_time(x1, x2, None), a1, a2)
+        a = np.concatenate((a1.ravel(), a2.ravel()))
+        times = np.zeros(a.shape)
+        nonzero = a > 0
+        times[nonzero] = self._log_spline_eval(delta_time, a[nonzero], lambda x: _c_double_loop(
+            lambda x1, x2: delta_time(x1, x2, None), 0., x))
+        return (times[a1.size:] - times[:a1.size]).reshape(a1.shape)
+
+    def _log_spline_eval(self, name, x, calc):
+        # calc(x) for array x > 0, from a cubic spline in log(x) if x is large. The spline for each name is
+        # re-used until the background is re-calculated, and re-calculated over a wider range if x is outside it.
+        x = np.asarray(x, dtype=np.float64)
+        if x.size <= background_spline_min_size:
+            return calc(x)
+        logx = np.log(x)
+        logmin, logmax = np.min(logx), np.max(logx)
+        cached = self._log_splines.get(name)
+        if cached is not None and cached[0] == _background_version:
+            if cached[1] <= logmin and logmax <= cached[2]:
+                return np.exp(cached[3](logx))
+            logmin, logmax = min(logmin, cached[1]), max(logmax, cached[2])
+        if logmax == logmin:
+            return np.full(x.shape, calc(x.ravel()[:1])[0])
+        spline = _log_spline(logmin, logmax, calc)
+        self._log_splines[name] = (_background_version, logmin, logmax, spline)
+        return np.exp(spline(logx))
 
     def conformal_time(self, z):
         """
@@ -957,7 +1413,7 @@ class CAMBdata(object):
         else:
             redshifts = np.array(z, dtype=np.float64)
         eta = np.empty(redshifts.shape)
-        TimeOfzArr(byref(c_int(eta.shape[0])), redshifts, eta)
+        TimeOfzArr(byref(c_int(eta.size)), redshifts, eta)
         if np.isscalar(z):
             return eta[0]
         else:
@@ -972,6 +1428,12 @@ class CAMBdata(object):
         return CosmomcTheta()
 
 
+def _time_evolution_job(job):
+    # calculate a chunk of CAMBdata.get_time_evolution in a worker process
+    params, k, times, variables, lAccuracyBoost = job
+    return get_background(params).get_time_evolution(k, times, variables, lAccuracyBoost)
+
+
 def get_results(params):
     """
     Calculate results for specified parameters and return :class:`CAMBdata` instance for getting results.
@@ -979,6 +1441,8 @@ def get_results(params):
     :param params: :class:`.model.CAMBparams` instance
     :return: :class:`CAMBdata` instance
     """
+    if _result_cache is not None:
+        return _result_cache.get(params, 'results')
     res = CAMBdata()
     res.calc_power_spectra(params)
     return res
@@ -993,6 +1457,8 @@ def get_transfer_functions(params):
     :return: :class:`CAMBdata` instance
     """
 
+    if _result_cache is not None:
+        return _result_cache.get(params, 'transfers')
     res = CAMBdata()
     res.calc_transfers(params)
     return res
@@ -1008,6 +1474,8 @@ def get_background(params, no_thermo=False):
     :return: :class:`CAMBdata` instance
     """
 
+    if _result_cache is not None:
+        return _result_cache.get(params, 'background_no_thermo' if no_thermo else 'background')
     res = CAMBdata()
     if no_thermo:
         res.calc_background_no_thermo(params)
@@ -1016,6 +1484,173 @@ def get_background(params, no_thermo=False):
     return res
 
 
+def _global_settings_key():
+    # global settings that affect results but are not stored in CAMBparams
+    w_lam = dll_import(c_double, "lambdageneral", "w_lam")
+    cs2_lam = dll_import(c_double, "lambdageneral", "cs2_lam")
+    return tuple(var.value for var in
+                 [model._AccuracyBoost, model._lSampleBoost, model._lAccuracyBoost, model._DoLateRadTruncation,
+                  nonlinear.halofit_version, lensing.lensing_method, lensing.ALens, lensing.ALens_Fiducial,
+                  lensing.lensing_includes_tensors, w_lam, cs2_lam])
+
+
+def _results_nbytes(data):
+    # approximate memory used by the stored transfer functions in data
+    nbytes = 0
+    if data.Params.WantTransfer:
+        cdata = _MatterTransferData()
+        CAMBdata_mattertransferdata(data._key, byref(cdata))
+        nbytes += np.prod(cdata.TransferData_size[:]) * 4
+    if data.Params.WantCls:
+        for tp, want in enumerate([data.Params.WantScalars, data.Params.WantVectors, data.Params.WantTensors]):
+            if want:
+                cdata = _ClTransferData()
+                CAMBdata_cltransferdata(data._key, byref(cdata), byref(c_int(tp)))
+                nbytes += np.prod(cdata.delta_size[:]) * 8
+    return int(nbytes)
+
+
+class ResultCache(object):
+    """
+    Least-recently-used cache of :class:`CAMBdata` results, indexed by the canonical key of the parameters
+    (see :meth:`.baseconfig.CAMB_Structure.canonical_key`) and global accuracy and model settings.
+    Enable using :func:`set_result_cache`, after which :func:`get_results`, :func:`get_transfer_functions` and
+    :func:`get_background` return cached results for repeated parameters.
+
+    Results are stored per calculation stage: 'background_no_thermo', 'background', 'transfers' and
+    'results' (power spectra). Cached transfer functions are re-used to calculate power spectra for 'results'.
+    The native background and power spectrum functions use the most recently calculated model, so when another
+    model has been calculated since, a hit re-calculates the background ('background' stages) or power spectra
+    from the stored transfer functions ('results').
+
+    Cached :class:`CAMBdata` instances are shared between calls, so should not be modified or freed
+    (results that have been freed are discarded, and power spectra re-calculated for other initial power
+    parameters are re-calculated for the cached parameters when next used).
+
+    :ivar max_entries: maximum number of stored results
+    :ivar max_bytes: maximum approximate memory of stored transfer functions
+    :ivar hits: dictionary of number of cache hits for each stage
+    :ivar misses: dictionary of number of cache misses for each stage
+    :ivar reused_transfers: number of 'results' calculated from cached transfer functions
+    """
+    stages = ['background_no_thermo', 'background', 'transfers', 'results']
+
+    def __init__(self, max_entries=32, max_bytes=2 ** 30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = dict((stage, 0) for stage in self.stages)
+        self.misses = dict((stage, 0) for stage in self.stages)
+        self.reused_transfers = 0
+
+    def clear(self):
+        """
+        Remove all stored results (results still referenced elsewhere are not freed)
+        """
+        self._entries.clear()
+
+    @property
+    def nbytes(self):
+        return sum(entry[3] for entry in self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        :return: dictionary of hits and misses for each stage, number of stored results and their memory
+        """
+        return {'hits': dict(self.hits), 'misses': dict(self.misses), 'reused_transfers': self.reused_transfers,
+                'entries': len(self), 'nbytes': self.nbytes}
+
+    def _calculate(self, params, stage, data=None):
+        data = data or CAMBdata()
+        if stage == 'background_no_thermo':
+            data.calc_background_no_thermo(params)
+        elif stage == 'background':
+            data.calc_background(params)
+        elif stage == 'transfers':
+            result = data.calc_transfers(params)
+            if result != 0:
+                raise CAMBError('Error getting transfer functions: %u' % result)
+        else:
+            data.calc_power_spectra(params)
+        return data
+
+    def get(self, params, stage='results'):
+        """
+        Get results for params, calculating if not already cached.
+
+        :param params: :class:`.model.CAMBparams` instance
+        :param stage: 'background_no_thermo', 'background', 'transfers' or 'results'
+        :return: :class:`CAMBdata` instance
+        """
+        if stage not in self.stages:
+            raise CAMBError('Unknown stage %s; must be one of %s' % (stage, self.stages))
+        params_key = params.canonical_key()
+        background = stage.startswith('background')
+        key = (params_key, _global_settings_key(), stage if background else 'transfers')
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry_stage, data, version, nbytes = entry
+            if not data._key:
+                entry = None
+        if entry is None:
+            self.misses[stage] += 1
+            data = self._calculate(params, stage)
+            nbytes = 0 if background else _results_nbytes(data)
+        else:
+            self.hits[stage] += 1
+            if background:
+                if version != _background_version:
+                    self._calculate(params, stage, data)
+            elif stage == 'results' and (entry_stage == 'transfers' or version != _background_version):
+                if entry_stage == 'transfers':
+                    self.reused_transfers += 1
+                    stage = 'results'
+                # also restores the initial power if changed by power_spectra_from_transfer
+                data.power_spectra_from_transfer(params.InitPower)
+            else:
+                stage = entry_stage
+        self._entries[key] = (stage, data, _background_version, nbytes)
+        while len(self._entries) > max(self.max_entries, 1) or \
+                len(self._entries) > 1 and self.nbytes > self.max_bytes:
+            self._entries.popitem(last=False)
+        return data
+
+
+_result_cache = None
+
+
+def set_result_cache(max_entries=32, max_bytes=2 ** 30):
+    """
+    Enable (or disable) caching of results from :func:`get_results`, :func:`get_transfer_functions` and
+    :func:`get_background` for repeated parameters. See :class:`ResultCache`.
+
+    :param max_entries: maximum number of stored results, or None or zero to disable the cache
+    :param max_bytes: maximum approximate memory of stored transfer functions
+    :return: the :class:`ResultCache` instance, or None if disabled
+    """
+    global _result_cache
+    if max_entries:
+        _result_cache = ResultCache(max_entries, max_bytes)
+    else:
+        _result_cache = None
+    return _result_cache
+
+
+def get_result_cache():
+    """
+    Get the result cache, e.g. to get hit and miss statistics using its stats() method.
+
+    :return: :class:`ResultCache` instance, or None if caching is not enabled
+    """
+    return _result_cache
+
+
 def get_age(params):
     """
     Get age of universe for given set of parameters
@@ -1023,6 +1658,7 @@ def get_age(params):
     :param params:  :class:`.model.CAMBparams` instance
     :return: age of universe in gigayears
     """
+    _background_changed()
     return CAMB_GetAge(byref(params))
 
 
@@ -1035,6 +1671,7 @@ def get_zre_from_tau(params, tau):
     :return: reionization redshift
     """
     cTau = c_double(tau)
+    _background_changed()
     return CAMB_GetZreFromTau(byref(params), byref(cTau))
 
 
@@ -1115,6 +1752,146 @@ def set_params(cp=None, verbose=False, **params):
     return cp
 
 
+class MatterPowerInterpolator(object):
+    """
+    Interpolation of the matter power spectrum as a function of z and k (or k/h), as returned by
+    :func:`get_matter_power_interpolator` and :meth:`CAMBdata.get_matter_power_interpolator`.
+
+    Calling the object as PK(z, log(k)) evaluates the RectBivariateSpline of (log) power, made when first needed.
+    Unlike the object returned by older versions, this is not a RectBivariateSpline subclass, but other
+    RectBivariateSpline methods and attributes (e.g. get_knots, integral, partial_derivative) are passed on to
+    :attr:`spline`.
+    Use :meth:`P` to get the power spectrum for grids of z and k, or for arrays of (z, k) pairs.
+    For very many evaluations, :meth:`make_table` makes a dense regular table in z and log k, which :meth:`P`
+    then uses for fast linear or cubic Hermite interpolation.
+
+    :ivar z: z values of the input grid
+    :ivar logk: log k values of the input grid
+    :ivar islog: True if interpolating the log of the power spectrum
+    """
+
+    def __init__(self, z, k, pk, log_interp=True):
+        self.z = np.asarray(z, dtype=np.float64)
+        self.logk = np.log(k)
+        self.islog = bool(log_interp) and not np.any(pk <= 0)
+        self.values = np.log(pk) if self.islog else np.array(pk, dtype=np.float64)
+        self._spline = None
+        self._table = None
+
+    @property
+    def spline(self):
+        """
+        scipy RectBivariateSpline of (log) power as a function of z and log k
+        """
+        if self._spline is None:
+            from scipy.interpolate import RectBivariateSpline
+            self._spline = RectBivariateSpline(self.z, self.logk, self.values)
+        return self._spline
+
+    def __call__(self, z, logk, dx=0, dy=0, grid=True):
+        return self.spline(z, logk, dx=dx, dy=dy, grid=grid)
+
+    def ev(self, z, logk):
+        return self.spline.ev(z, logk)
+
+    def __getattr__(self, name):
+        # only called for attributes not defined here
+        from scipy.interpolate import RectBivariateSpline
+        if name in ['tck', 'fp', 'degrees'] or not name.startswith('_') and hasattr(RectBivariateSpline, name):
+            return getattr(self.spline, name)
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+
+    def make_table(self, nz=None, nk=None, method='linear'):
+        """
+        Make a dense lookup table of the (log) power spectrum on a regular grid in z and log k.
+        :meth:`P` then interpolates the table in constant time per point, rather than evaluating the spline.
+        Points outside the range of the input grid are evaluated at the nearest edge.
+
+        :param nz: number of z points (default 4 times the number in the input grid)
+        :param nk: number of k points (default 4 times the number in the input grid)
+        :param method: 'linear', or 'cubic' for cubic Hermite interpolation using derivatives of the spline
+        :return: self
+        """
+        if method not in ['linear', 'cubic']:
+            raise CAMBError('Unknown table interpolation method %s' % method)
+        nz = nz or 4 * self.z.size
+        nk = nk or 4 * self.logk.size
+        z, dz = np.linspace(self.z[0], self.z[-1], nz, retstep=True)
+        logk, dlogk = np.linspace(self.logk[0], self.logk[-1], nk, retstep=True)
+        table = {'z0': z[0], 'dz': dz, 'logk0': logk[0], 'dlogk': dlogk, 'method': method, 'shape': (nz, nk)}
+        if method == 'linear':
+            table['f'] = self.spline(z, logk).ravel()
+        else:
+            # values and derivatives (in units of the grid spacing) at each point, for Hermite interpolation
+            table['f'] = np.stack([self.spline(z, logk), self.spline(z, logk, dx=1) * dz,
+                                   self.spline(z, logk, dy=1) * dlogk,
+                                   self.spline(z, logk, dx=1, dy=1) * dz * dlogk], axis=-1).reshape(-1, 4)
+        self._table = table
+        return self
+
+    def clear_table(self):
+        """
+        Remove the table made by :meth:`make_table`, to use the spline directly.
+        """
+        self._table = None
+
+    def _table_points(self, z, logk):
+        table = self._table
+        f = table['f']
+        nz, nk = table['shape']
+        x = np.clip((z - table['z0']) / table['dz'], 0, nz - 1)
+        y = np.clip((logk - table['logk0']) / table['dlogk'], 0, nk - 1)
+        ix = np.minimum(x.astype(int), nz - 2)
+        iy = np.minimum(y.astype(int), nk - 2)
+        tx = x - ix
+        ty = y - iy
+        index = ix * nk + iy
+        if table['method'] == 'linear':
+            return (1 - tx) * ((1 - ty) * f.take(index) + ty * f.take(index + 1)) + \
+                   tx * ((1 - ty) * f.take(index + nk) + ty * f.take(index + nk + 1))
+        # Hermite basis functions for values and derivatives at the two ends of the interval
+        values_x = [(1 + 2 * tx) * (1 - tx) ** 2, tx ** 2 * (3 - 2 * tx)]
+        derivs_x = [tx * (1 - tx) ** 2, tx ** 2 * (tx - 1)]
+        values_y = [(1 + 2 * ty) * (1 - ty) ** 2, ty ** 2 * (3 - 2 * ty)]
+        derivs_y = [ty * (1 - ty) ** 2, ty ** 2 * (ty - 1)]
+        res = 0
+        for i in [0, 1]:
+            for j in [0, 1]:
+                corner = f.take(index + i * nk + j, axis=0)
+                res = res + values_x[i] * (values_y[j] * corner[..., 0] + derivs_y[j] * corner[..., 2]) + \
+                      derivs_x[i] * (values_y[j] * corner[..., 1] + derivs_y[j] * corner[..., 3])
+        return res
+
+    def P(self, z, k, grid=None):
+        """
+        Get the power spectrum at z and k (or k/h, depending on how the interpolator was made).
+
+        :param z: redshift, or array of redshifts
+        :param k: k value (or k/h), or array of values
+        :param grid: if True, evaluate on the grid of z and k values, giving result of shape (len(z), len(k)),
+            otherwise evaluate for z, k pairs (broadcast together). Default is grid unless z or k is a scalar.
+        :return: matter power
+        """
+        if grid is None:
+            grid = not np.isscalar(z) and not np.isscalar(k)
+        if grid:
+            if self._table is None:
+                res = self(z, np.log(k), grid=True)
+            else:
+                z, logk = np.meshgrid(z, np.log(k), indexing='ij')
+                res = self._table_points(z, logk)
+        else:
+            z, k = np.broadcast_arrays(np.asarray(z, dtype=np.float64), np.asarray(k, dtype=np.float64))
+            if self._table is None:
+                res = self.spline.ev(z.ravel(), np.log(k).ravel()).reshape(z.shape)
+            else:
+                res = self._table_points(z, np.log(k))
+        if self.islog:
+            return np.exp(res)
+        else:
+            return res
+
+
 def get_matter_power_interpolator(params, zmin=0, zmax=10, nz_step=100, zs=None, kmax=10, nonlinear=True,
                                   var1=None, var2=None, hubble_units=True, k_hunit=True,
                                   return_z_k=False, k_per_logint=None, log_interp=True):
@@ -1137,40 +1914,14 @@ def get_matter_power_interpolator(params, zmin=0, zmax=10, nz_step=100, zs=None,
     :param k_hunit: if true, matter power is a function of k/h, if false, just k (both Mpc^{-1} units)
     :param return_z_k: if true, return interpolator, z, k where z, k are the grid used
     :param log_interp: if true, interpolate log of power spectrum (unless any values are negative in which case ignored)
-    :return: RectBivariateSpline object PK, that can be called with PK(z,log(kh)) to get log matter power values.
-        if return_z_k=True, instead return interpolator, z, k where z, k are the grid used
+    :return: :class:`MatterPowerInterpolator` object PK, that can be called with PK(z,log(kh)) to get log matter
+        power values. if return_z_k=True, instead return interpolator, z, k where z, k are the grid used
     """
-    import copy
-    from scipy.interpolate import RectBivariateSpline
-
-    pars = copy.deepcopy(params)
+    # copy of the parameter structure, so the input params are not changed
+    pars = model.CAMBparams.from_buffer_copy(params)
     if zs is None:
         zs = zmin + np.exp(np.log(zmax - zmin + 1) * np.linspace(0, 1, nz_step)) - 1
     pars.set_matter_power(redshifts=zs, kmax=kmax, k_per_logint=k_per_logint, silent=True)
     pars.NonLinear = model.NonLinear_none
     results = get_results(pars)
-
-    class PKInterpolator(RectBivariateSpline):
-
-        def P(self, z, kh, grid=None):
-            if grid is None:
-                grid = not np.isscalar(z) and not np.isscalar(kh)
-            if self.islog:
-                return np.exp(self(z, np.log(kh), grid=grid))
-            else:
-                return self(z, np.log(kh), grid=grid)
-
-    kh, z, pk = results.get_linear_matter_power_spectrum(var1, var2, hubble_units, nonlinear=nonlinear)
-    if not k_hunit:
-        kh *= pars.H0 / 100
-    if log_interp and np.any(pk <= 0):
-        log_interp = False
-    if log_interp:
-        res = PKInterpolator(z, np.log(kh), np.log(pk))
-    else:
-        res = PKInterpolator(z, np.log(kh), pk)
-    res.islog = log_interp
-    if return_z_k:
-        return res, z, kh
-    else:
-        return res
+    return results.get_matter_power_interpolator(nonlinear, var1, var2, hubble_units, k_hunit, return_z_k, log_interp)
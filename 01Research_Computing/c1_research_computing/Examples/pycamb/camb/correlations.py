@@ -13,71 +13,242 @@ A. Lewis December 2016
 
 import numpy as np
 import os
+import hashlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
-try:
-    from .baseconfig import camblib
-    from numpy.ctypeslib import ndpointer
-    import ctypes
-
-    gauss_legendre = camblib.__gauss_legendre
-    gauss_legendre.argtypes = [ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
-                               ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
-                               ctypes.POINTER(ctypes.c_int)]
-except:
-    # use np.polynomial.legendre if can't load fast native (so can use module without compiling camb)
-    # Fortran version is much faster than current np.polynomial
-    gauss_legendre = None
-
-if not os.environ.get('READTHEDOCS', None):
-    from scipy.special import lpn as legendreP
-else:
+import ctypes
+
+# fast native Gauss-Legendre routine, looked up when first needed; None if the CAMB library can't be loaded,
+# in which case python Newton iteration is used (so can use module without compiling camb)
+_native_gauss_legendre = False
+
+
+def _get_native_gauss_legendre():
+    global _native_gauss_legendre
+    if _native_gauss_legendre is False:
+        try:
+            from .baseconfig import camblib
+            from numpy.ctypeslib import ndpointer
+
+            func = camblib.__gauss_legendre
+            func.argtypes = [ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+                             ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+                             ctypes.POINTER(ctypes.c_int)]
+            _native_gauss_legendre = func
+        except Exception:
+            _native_gauss_legendre = None
+    return _native_gauss_legendre
+
+
+if os.environ.get('READTHEDOCS', None):
     np.pi = 3.1415927  # needed to get docs right for np.pi/32 default argument
 
+# Memory budgets (bytes) used to choose how many x values are processed together.
+# The L recursion is vectorized over blocks of x holding up to _recursion_block_bytes of P and dP values;
+# the spin functions and anything built from them are then evaluated in sub-blocks that fit in cache.
+_recursion_block_bytes = 2 ** 26
+_cache_block_bytes = 2 ** 22
+# maximum number of separately-summed chunks of x values when reducing contributions to lensed cls
+_max_reduction_chunks = 64
+# maximum memory for the d functions and correlation derivatives for chunks of x in lensed C_L derivatives
+_derivative_x_block_bytes = 2 ** 28
+
+# On-disk cache of Gauss-Legendre points and weights, shared (read-only, memory mapped) between processes.
+# Set gauss_legendre_cache_dir to a directory to use, or to '' to disable the disk cache; the default is under
+# $CAMB_CACHE_DIR, or the user cache directory if that is not set. When the total size of cached files exceeds
+# gauss_legendre_cache_max_bytes the least recently used files are deleted.
+gauss_legendre_cache_dir = None
+gauss_legendre_cache_max_bytes = 2 ** 30
+# change if the method or format of the stored points changes, so old files are not used
+_gauss_legendre_cache_version = 1
 
 _gauss_legendre_cache = {}
 
+
+def _gauss_legendre_newton(npoints):
+    # Gauss-Legendre points and weights from Newton iteration starting from Tricomi's asymptotic approximation
+    # to the roots. Each iteration is O(npoints) for each root (vectorized over roots), and the initial guesses are
+    # accurate enough that two or three iterations reach machine precision.
+    n = npoints
+    k = np.arange(1, n // 2 + 1, dtype=np.float64)  # roots with x > 0
+    theta = np.pi * (4 * k - 1) / (4 * n + 2)
+    x = (1 - (n - 1) / (8. * n ** 3) - (39 - 28 / np.sin(theta) ** 2) / (384. * n ** 4)) * np.cos(theta)
+    for _ in range(10):
+        P0 = np.ones(x.shape)
+        P = x.copy()
+        dP = np.ones(x.shape)
+        for L in range(2, n + 1):
+            dP *= x
+            dP += L * P
+            P0 *= -(L - 1.) / L
+            P0 += (2 * L - 1.) / L * x * P
+            P, P0 = P0, P
+        dx = P / dP
+        x -= dx
+        if not len(x) or np.max(np.abs(dx)) < 1e-15:
+            break
+    weights = 2 / ((1 - x ** 2) * dP ** 2)
+    if n % 2:
+        # zero is also a root
+        P = 1.
+        for L in range(2, n + 1, 2):
+            P *= -(L - 1.) / L
+        x = np.hstack((x, [0.]))
+        weights = np.hstack((weights, [2 / (n * P) ** 2]))
+    return np.hstack((-x, x[::-1][n % 2:])), np.hstack((weights, weights[::-1][n % 2:]))
+
+
+def _gauss_legendre_cache_file(npoints):
+    directory = gauss_legendre_cache_dir
+    if directory is None:
+        directory = os.environ.get('CAMB_CACHE_DIR') or \
+                    os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                 'camb')
+    if not directory:
+        return None
+    key = hashlib.sha1(('gauss_legendre_v%s_%s' % (_gauss_legendre_cache_version, npoints)).encode()).hexdigest()
+    return os.path.join(directory, 'gauss_legendre_%s_%s.npy' % (npoints, key[:16]))
+
+
+def _evict_gauss_legendre_cache(directory, keep):
+    # delete least recently used files until the total is within gauss_legendre_cache_max_bytes
+    files = []
+    for name in os.listdir(directory):
+        if name.startswith('gauss_legendre_') and name.endswith('.npy'):
+            stat = os.stat(os.path.join(directory, name))
+            files.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in files)
+    for _, size, name in sorted(files):
+        if total <= gauss_legendre_cache_max_bytes:
+            break
+        if name != keep:
+            os.remove(os.path.join(directory, name))
+            total -= size
+
+
+def _disk_cached_gauss_legendre(npoints, calc):
+    # Load read-only memory-mapped points and weights for npoints, or calculate with calc() and save them.
+    # Any problem with the cache directory just means the points are recalculated.
+    filename = _gauss_legendre_cache_file(npoints)
+    if filename is None:
+        return calc()
+    try:
+        points = np.load(filename, mmap_mode='r')
+        if points.shape == (2, npoints) and points.dtype == np.float64:
+            try:
+                # mark as recently used, unless the cache is read-only
+                os.utime(filename, None)
+            except OSError:
+                pass
+            return points[0], points[1]
+    except (IOError, OSError, ValueError):
+        pass
+    xvals, weights = calc()
+    try:
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write to a temporary file and rename, so other processes never see a partly-written file
+        tmp_file = '%s.%s.tmp' % (filename, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.save(f, np.vstack((xvals, weights)))
+        os.rename(tmp_file, filename)
+        _evict_gauss_legendre_cache(directory, os.path.basename(filename))
+        points = np.load(filename, mmap_mode='r')
+        return points[0], points[1]
+    except (IOError, OSError, ValueError):
+        return xvals, weights
+
+
+def _calc_gauss_legendre(npoints):
+    gauss_legendre = _get_native_gauss_legendre()
+    if gauss_legendre is not None:
+        xvals = np.empty(npoints)
+        weights = np.empty(npoints)
+        gauss_legendre(xvals, weights, ctypes.c_int(npoints))
+    else:
+        xvals, weights = _gauss_legendre_newton(npoints)
+    xvals.flags.writeable = False
+    weights.flags.writeable = False
+    return xvals, weights
+
+
 def _cached_gauss_legendre(npoints, cache=True):
     if cache and npoints in _gauss_legendre_cache:
         return _gauss_legendre_cache[npoints]
     else:
-        if gauss_legendre is not None:
-            xvals = np.empty(npoints)
-            weights = np.empty(npoints)
-            gauss_legendre(xvals, weights, ctypes.c_int(npoints))
-            xvals.flags.writeable = False
-            weights.flags.writeable = False
-        else:
-            xvals, weights = np.polynomial.legendre.leggauss(npoints)
         if cache:
+            xvals, weights = _disk_cached_gauss_legendre(npoints, lambda: _calc_gauss_legendre(npoints))
             _gauss_legendre_cache[npoints] = xvals, weights
+        else:
+            xvals, weights = _calc_gauss_legendre(npoints)
         return xvals, weights
 
 
-def legendre_funcs(lmax, x, m=[0, 2], lfacs=None, lfacs2=None, lrootfacs=None):
+def _block_size(lmax, nbytes, narrays=1):
+    # number of x values for which narrays arrays of lmax+1 doubles fit into nbytes
+    return max(1, int(nbytes // (8 * (lmax + 1) * narrays)))
+
+
+def _x_blocks(nx, block):
+    # split range(nx) into consecutive slices of at most block values, sized as evenly as possible
+    nblocks = -(-nx // block)
+    for i in range(nblocks):
+        yield slice(i * nx // nblocks, (i + 1) * nx // nblocks)
+
+
+def _rowdot(a, b):
+    return np.einsum('ij,ij->i', a, b)
+
+
+def _legendre_P_dP(lmax, x):
     """
-    Utility function to return array of Legendre and d_{mn} functions for all L up to lmax.
-    Note that d_{mn} arrays start at L_min = max(m,n), so returned arrays are different sizes
+    Legendre polynomials P_L(x) and derivatives dP_L/dx for all L up to lmax, from the upward
+    three-term recursion vectorized over the array of x values.
 
     :param lmax: maximum L
-    :param x: scalar value of cos(theta) at which to evaluate
-    :param m: m values to calculate d_{m,n}, etc as relevant
-    :param lfacs: optional pre-computed L(L+1) float array
-    :param lfacs2: optional pre-computed (L+2)*(L-1) float array
-    :param lrootfacs: optional pre-computed sqrt(lfacs*lfacs2) array
-    :return: (P,dP),(d11,dm11), (d20, d22, d2m2) as requested, where P starts at L=0, but spin functions start at L=Lmin
+    :param x: 1D array of cos(theta) values
+    :return: P, dP; 2D arrays [ix, L] (transposed views of C-contiguous [L, ix] arrays)
     """
-    allP, alldP = legendreP(lmax, x)
-    # Polarization functions all start at L=2
-    fac1 = 1 - x
-    fac2 = 1 + x
+    nx = x.shape[0]
+    P = np.empty((lmax + 1, nx))
+    dP = np.empty((lmax + 1, nx))
+    tmp = np.empty(nx)
+    P[0] = 1
+    dP[0] = 0
+    if lmax > 0:
+        P[1] = x
+        dP[1] = 1
+    ls = np.arange(lmax + 1, dtype=np.float64)
+    ls[0] = 1
+    # L P_L = (2L-1) x P_{L-1} - (L-1) P_{L-2}, starting from P_L = (2L-1)/L x for all L at once;
+    # dP_L = dP_{L-2} + (2L-1) P_{L-1}
+    np.multiply(((2 * ls[2:] - 1) / ls[2:])[:, np.newaxis], x, out=P[2:])
+    Pfacs = (ls - 1) / ls
+    dPfacs = 2 * ls - 1
+    for L in range(2, lmax + 1):
+        P[L] *= P[L - 1]
+        np.multiply(P[L - 2], Pfacs[L], out=tmp)
+        P[L] -= tmp
+        np.multiply(P[L - 1], dPfacs[L], out=dP[L])
+        dP[L] += dP[L - 2]
+    return np.ascontiguousarray(P.T), np.ascontiguousarray(dP.T)
+
+
+def _spin_funcs(lmax, x, allP, alldP, m, lfacs=None, lfacs2=None, lrootfacs=None):
+    # d_{mn} functions from the Legendre functions allP, alldP[ix, L] evaluated at the 1D array x
+    xcol = x[:, np.newaxis]
+    fac1 = 1 - xcol
+    fac2 = 1 + xcol
     res = []
     if 0 in m: res.append((allP, alldP))
 
     if 1 in m:
         lfacs1 = np.arange(1, lmax + 1, dtype=np.float64)
         lfacs1 *= (1 + lfacs1)
-        d11 = fac1 * alldP[1:] / lfacs1 + allP[1:]
-        dm11 = fac2 * alldP[1:] / lfacs1 - allP[1:]
+        d11 = fac1 * alldP[:, 1:] / lfacs1 + allP[:, 1:]
+        dm11 = fac2 * alldP[:, 1:] / lfacs1 - allP[:, 1:]
         res.append((d11, dm11))
 
     if 2 in m:
@@ -86,29 +257,98 @@ def legendre_funcs(lmax, x, m=[0, 2], lfacs=None, lfacs2=None, lrootfacs=None):
             lfacs = ls * (ls + 1)
             lfacs2 = (ls + 2) * (ls - 1)
             lrootfacs = np.sqrt(lfacs * lfacs2)
-        P = allP[2:]
-        dP = alldP[2:]
+        P = allP[:, 2:]
+        dP = alldP[:, 2:]
 
         fac = fac1 / fac2
-        d22 = (((4 * x - 8) / fac2 + lfacs) * P
-               + 4 * fac * (fac2 + (x - 2) / lfacs) * dP) / lfacs2
-        if x > 0.998:
+        d22 = (((4 * xcol - 8) / fac2 + lfacs) * P
+               + 4 * fac * (fac2 + (xcol - 2) / lfacs) * dP) / lfacs2
+        d2m2 = ((lfacs - (4 * xcol + 8) / fac1) * P
+                + 4 / fac * (-fac1 + (xcol + 2) / lfacs) * dP) / lfacs2
+        small = np.nonzero(x > 0.998)[0]
+        if len(small):
             # for stability use series at small angles (thanks Pavel Motloch)
-            d2m2 = np.empty(lmax - 1)
-            indser = int(np.sqrt((400.0 + 3 / (1 - x ** 2)) / 150)) - 1
-            d2m2[indser:] = ((lfacs[indser:] - (4 * x + 8) / fac1) * P[indser:]
-                             + 4 / fac * (-fac1 + (x + 2) / lfacs[indser:]) * dP[indser:]) / lfacs2[indser:]
-            sin2 = 1 - x ** 2
-            d2m2[:indser] = lfacs[:indser] * lfacs2[:indser] * sin2 ** 2 / 7680 * (20 + sin2 * (16 - lfacs[:indser]))
-        else:
-            d2m2 = ((lfacs - (4 * x + 8) / fac1) * P
-                    + 4 / fac * (-fac1 + (x + 2) / lfacs) * dP) / lfacs2
-        d20 = (2 * x * dP - lfacs * P) / lrootfacs
+            sin2 = 1 - x[small] ** 2
+            indser = (np.sqrt((400.0 + 3 / sin2) / 150)).astype(int) - 1
+            nser = min(np.max(indser), lmax - 1)
+            if nser > 0:
+                sin2 = sin2[:, np.newaxis]
+                series = lfacs[:nser] * lfacs2[:nser] * sin2 ** 2 / 7680 * (20 + sin2 * (16 - lfacs[:nser]))
+                use = np.arange(nser) < indser[:, np.newaxis]
+                d2m2[small, :nser] = np.where(use, series, d2m2[small, :nser])
+        d20 = (2 * xcol * dP - lfacs * P) / lrootfacs
         res.append((d20, d22, d2m2))
 
     return res
 
 
+def legendre_funcs_block(lmax, xvals, m=[0, 2], lfacs=None, lfacs2=None, lrootfacs=None):
+    """
+    Vectorized version of :func:`legendre_funcs`, returning 2D arrays of Legendre and d_{mn} functions
+    for all L up to lmax (second index) at each of an array of x values (first index).
+    Memory use scales as len(xvals)*lmax, so for many x values call in blocks (as done internally).
+
+    :param lmax: maximum L
+    :param xvals: array of cos(theta) values at which to evaluate
+    :param m: m values to calculate d_{m,n}, etc as relevant
+    :param lfacs: optional pre-computed L(L+1) float array
+    :param lfacs2: optional pre-computed (L+2)*(L-1) float array
+    :param lrootfacs: optional pre-computed sqrt(lfacs*lfacs2) array
+    :return: (P,dP),(d11,dm11), (d20, d22, d2m2) as requested, each a 2D array [ix, L-L_min],
+        where P starts at L=0, but spin functions start at L=Lmin
+    """
+    x = np.atleast_1d(np.asarray(xvals, dtype=np.float64))
+    allP, alldP = _legendre_P_dP(lmax, x)
+    return _spin_funcs(lmax, x, allP, alldP, m, lfacs, lfacs2, lrootfacs)
+
+
+def _legendre_sub_blocks(lmax, nx, narrays=8, block_bytes=None):
+    # Partition of range(nx) into the sub-blocks used for the spin functions, as used by _legendre_func_blocks
+    return list(_x_blocks(nx, _block_size(lmax, block_bytes or _cache_block_bytes, narrays)))
+
+
+def _legendre_func_blocks(lmax, xvals, m, lfacs=None, lfacs2=None, lrootfacs=None, narrays=8, block_bytes=None,
+                          sub_blocks=None):
+    # Generator over blocks of xvals, yielding slice, legendre_funcs_block(lmax, xvals[slice], m, ...).
+    # The recursion runs over large blocks, the spin functions in sub-blocks sized so that about narrays
+    # arrays of that size (including those the caller builds from them) fit in cache (or block_bytes if given).
+    # Alternatively sub_blocks can be a list of consecutive slices of xvals to use (e.g. a subset of those from
+    # _legendre_sub_blocks); results for each sub-block do not depend on how the rest of xvals is split up.
+    if sub_blocks is None:
+        sub_blocks = _legendre_sub_blocks(lmax, len(xvals), narrays, block_bytes)
+    if not sub_blocks:
+        return
+    nx = sub_blocks[-1].stop - sub_blocks[0].start
+    nrec = -(-nx // _block_size(lmax, _recursion_block_bytes, 2))
+    for i in range(nrec):
+        subs = sub_blocks[i * len(sub_blocks) // nrec:(i + 1) * len(sub_blocks) // nrec]
+        if not subs:
+            continue
+        start = subs[0].start
+        x = np.asarray(xvals[start:subs[-1].stop], dtype=np.float64)
+        allP, alldP = _legendre_P_dP(lmax, x)
+        for sub in subs:
+            local = slice(sub.start - start, sub.stop - start)
+            yield sub, _spin_funcs(lmax, x[local], allP[local], alldP[local], m, lfacs, lfacs2, lrootfacs)
+
+
+def legendre_funcs(lmax, x, m=[0, 2], lfacs=None, lfacs2=None, lrootfacs=None):
+    """
+    Utility function to return array of Legendre and d_{mn} functions for all L up to lmax.
+    Note that d_{mn} arrays start at L_min = max(m,n), so returned arrays are different sizes.
+    To evaluate at many x values use :func:`legendre_funcs_block`.
+
+    :param lmax: maximum L
+    :param x: scalar value of cos(theta) at which to evaluate
+    :param m: m values to calculate d_{m,n}, etc as relevant
+    :param lfacs: optional pre-computed L(L+1) float array
+    :param lfacs2: optional pre-computed (L+2)*(L-1) float array
+    :param lrootfacs: optional pre-computed sqrt(lfacs*lfacs2) array
+    :return: (P,dP),(d11,dm11), (d20, d22, d2m2) as requested, where P starts at L=0, but spin functions start at L=Lmin
+    """
+    return [tuple(f[0] for f in funcs) for funcs in legendre_funcs_block(lmax, [x], m, lfacs, lfacs2, lrootfacs)]
+
+
 def cl2corr(cls, xvals, lmax=None):
     """
     Get the correlation function from the power spectra, evaluated at points cos(theta) = xvals.
@@ -139,12 +379,11 @@ def cl2corr(cls, xvals, lmax=None):
     lfacs = lfacs[2:]
     lfacs2 = (ls + 2) * (ls - 1)
     lrootfacs = np.sqrt(lfacs * lfacs2)
-    for i, x in enumerate(xvals):
-        (P, _), (d20, d22, d2m2) = legendre_funcs(lmax, x, [0, 2], lfacs, lfacs2, lrootfacs)
-        corrs[i, 0] = np.dot(ct, P)  # T
-        corrs[i, 1] = np.dot(cp, d22)  # Q+U
-        corrs[i, 2] = np.dot(cm, d2m2)  # Q-U
-        corrs[i, 3] = np.dot(cc, d20)  # cross
+    for sl, ((P, _), (d20, d22, d2m2)) in _legendre_func_blocks(lmax, xvals, [0, 2], lfacs, lfacs2, lrootfacs):
+        corrs[sl, 0] = P.dot(ct)  # T
+        corrs[sl, 1] = d22.dot(cp)  # Q+U
+        corrs[sl, 2] = d2m2.dot(cm)  # Q-U
+        corrs[sl, 3] = d20.dot(cc)  # cross
 
     return corrs
 
@@ -187,14 +426,15 @@ def corr2cl(corrs, xvals, weights, lmax):
     lfacs2 = (ls + 2) * (ls - 1)
     lrootfacs = np.sqrt(lfacs * lfacs2)
     cls = np.zeros((lmax + 1, 4))
-    for i, (x, weight) in enumerate(zip(xvals, weights)):
-        (P, _), (d20, d22, d2m2) = legendre_funcs(lmax, x, [0, 2], lfacs, lfacs2, lrootfacs)
-        cls[:, 0] += (weight * corrs[i, 0]) * P
-        T2 = (corrs[i, 1] * weight / 2) * d22
-        T4 = (corrs[i, 2] * weight / 2) * d2m2
+    weights = np.asarray(weights)
+    for sl, ((P, _), (d20, d22, d2m2)) in _legendre_func_blocks(lmax, xvals, [0, 2], lfacs, lfacs2, lrootfacs):
+        weight = weights[sl]
+        cls[:, 0] += P.T.dot(weight * corrs[sl, 0])
+        T2 = d22.T.dot(corrs[sl, 1] * weight / 2)
+        T4 = d2m2.T.dot(corrs[sl, 2] * weight / 2)
         cls[2:, 1] += T2 + T4
         cls[2:, 2] += T2 - T4
-        cls[2:, 3] += (weight * corrs[i, 3]) * d20
+        cls[2:, 3] += d20.T.dot(weight * corrs[sl, 3])
 
     cls[1, :] *= 2
     cls[2:, :] = (cls[2:, :].T * lfacs).T
@@ -202,6 +442,148 @@ def corr2cl(corrs, xvals, weights, lmax):
     return cls
 
 
+class CorrelationTransform(object):
+    """
+    Planned transform between power spectra and correlation functions evaluated at Gauss-Legendre points.
+    The Legendre and d_{2n} kernel matrices for all the points are calculated once on construction,
+    so each subsequent :meth:`cl2corr` or :meth:`corr2cl` is a single matrix product, optionally
+    for a whole stack of spectra at once.
+    Kernels use npoints*(lmax+1) doubles for each of P, d20, d22, d2m2, so plans can be large;
+    use :func:`get_correlation_transform` to share plans via a memory-bounded cache.
+
+    :ivar lmax: maximum L
+    :ivar xvals: Gauss-Legendre cos(theta) values
+    :ivar weights: Gauss-Legendre integration weights
+    :ivar spins: spins for which kernels are stored, 0 for temperature, 2 for polarization
+    """
+
+    def __init__(self, lmax, npoints=None, sampling_factor=1, spins=(0, 2)):
+        """
+        :param lmax: maximum L
+        :param npoints: number of Gauss-Legendre points; default int(sampling_factor * lmax) + 1
+        :param sampling_factor: sets npoints if npoints is not given
+        :param spins: spins to calculate kernels for, subset of (0, 2); spectra for other spins are ignored
+        """
+        if npoints is None: npoints = int(sampling_factor * lmax) + 1
+        self.spins = tuple(sorted(set(spins)))
+        if not set(self.spins) <= {0, 2}:
+            raise ValueError('spins must be a subset of (0, 2)')
+        self.lmax = lmax
+        self.xvals, self.weights = _cached_gauss_legendre(npoints)
+        ls = np.arange(0, lmax + 1, dtype=np.float64)
+        lfacs = ls * (ls + 1)
+        lfacs[0] = 1
+        self._facs = (2 * ls + 1) / (4 * np.pi) * 2 * np.pi / lfacs
+        self._lfacs = lfacs[2:]
+        lfacs2 = (ls[2:] + 2) * (ls[2:] - 1)
+        lrootfacs = np.sqrt(self._lfacs * lfacs2)
+        self.P = np.empty((npoints, lmax + 1)) if 0 in self.spins else None
+        if 2 in self.spins:
+            self.d20, self.d22, self.d2m2 = [np.empty((npoints, lmax - 1)) for _ in range(3)]
+        else:
+            self.d20 = self.d22 = self.d2m2 = None
+        for sl, funcs in _legendre_func_blocks(lmax, self.xvals, self.spins, self._lfacs, lfacs2, lrootfacs):
+            funcs = list(funcs)
+            if 0 in self.spins:
+                self.P[sl] = funcs.pop(0)[0]
+            if 2 in self.spins:
+                self.d20[sl], self.d22[sl], self.d2m2[sl] = funcs.pop(0)
+
+    @property
+    def npoints(self):
+        return len(self.xvals)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the kernel matrices in bytes
+        """
+        return sum(k.nbytes for k in [self.P, self.d20, self.d22, self.d2m2] if k is not None)
+
+    def cl2corr(self, cls):
+        """
+        Get correlation functions at the Gauss-Legendre points from power spectra, as :func:`cl2corr`.
+
+        :param cls: array cls[L, ix], or stack cls[i, L, ix] of several sets of spectra, with L starting at zero
+            and ix=0,1,2,3 in order TT, EE, BB, TE. Should include l(l+1)/2pi factors and L at least up to lmax.
+        :return: array corrs[i_x, ix] or stack corrs[i, i_x, ix], where ix=0,1,2,3 are T, Q+U, Q-U and cross
+        """
+        cls = np.asarray(cls)
+        single = cls.ndim == 2
+        if cls.shape[-2] <= self.lmax:
+            raise ValueError('cls must extend to at least L=%s' % self.lmax)
+        cls = (cls[np.newaxis] if single else cls)[:, :self.lmax + 1, :] * self._facs[:, np.newaxis]
+        corrs = np.zeros((cls.shape[0], self.npoints, 4))
+        if 0 in self.spins:
+            corrs[:, :, 0] = cls[:, :, 0].dot(self.P.T)
+        if 2 in self.spins:
+            cls = cls[:, 2:, :]
+            corrs[:, :, 1] = (cls[:, :, 1] + cls[:, :, 2]).dot(self.d22.T)
+            corrs[:, :, 2] = (cls[:, :, 1] - cls[:, :, 2]).dot(self.d2m2.T)
+            corrs[:, :, 3] = cls[:, :, 3].dot(self.d20.T)
+        return corrs[0] if single else corrs
+
+    def corr2cl(self, corrs):
+        """
+        Get power spectra from correlation functions at the Gauss-Legendre points, as :func:`corr2cl`.
+
+        :param corrs: array corrs[i_x, ix], or stack corrs[i, i_x, ix], where ix=0,1,2,3 are T, Q+U, Q-U and cross
+        :return: array cls[L, ix], or stack cls[i, L, ix], where L starts at zero and ix=0,1,2,3
+            in order TT, EE, BB, TE. They include l(l+1)/2pi factors.
+        """
+        corrs = np.asarray(corrs)
+        single = corrs.ndim == 2
+        corrs = (corrs[np.newaxis] if single else corrs) * self.weights[:, np.newaxis]
+        cls = np.zeros((corrs.shape[0], self.lmax + 1, 4))
+        if 0 in self.spins:
+            cls[:, :, 0] = corrs[:, :, 0].dot(self.P)
+        if 2 in self.spins:
+            T2 = corrs[:, :, 1].dot(self.d22) / 2
+            T4 = corrs[:, :, 2].dot(self.d2m2) / 2
+            cls[:, 2:, 1] = T2 + T4
+            cls[:, 2:, 2] = T2 - T4
+            cls[:, 2:, 3] = corrs[:, :, 3].dot(self.d20)
+        cls[:, 1, :] *= 2
+        cls[:, 2:, :] *= self._lfacs[:, np.newaxis]
+        return cls[0] if single else cls
+
+
+# Plans are shared via an LRU cache holding at most correlation_transform_cache_bytes of kernels
+correlation_transform_cache_bytes = 2 ** 30
+_correlation_transform_cache = OrderedDict()
+
+
+def get_correlation_transform(lmax, npoints=None, sampling_factor=1, spins=(0, 2)):
+    """
+    Get a :class:`CorrelationTransform` plan, re-using a cached one with the same (lmax, npoints, spins) if available.
+    Least recently used plans are dropped when the total size exceeds correlation_transform_cache_bytes
+    (plans larger than that are returned but not cached).
+
+    :param lmax: maximum L
+    :param npoints: number of Gauss-Legendre points; default int(sampling_factor * lmax) + 1
+    :param sampling_factor: sets npoints if npoints is not given
+    :param spins: spins to calculate kernels for, subset of (0, 2)
+    :return: :class:`CorrelationTransform` instance
+    """
+    if npoints is None: npoints = int(sampling_factor * lmax) + 1
+    key = (lmax, npoints, tuple(sorted(set(spins))))
+    plan = _correlation_transform_cache.pop(key, None)
+    if plan is None:
+        plan = CorrelationTransform(lmax, npoints, spins=spins)
+    if plan.nbytes <= correlation_transform_cache_bytes:
+        _correlation_transform_cache[key] = plan
+        while sum(p.nbytes for p in _correlation_transform_cache.values()) > correlation_transform_cache_bytes:
+            _correlation_transform_cache.popitem(last=False)
+    return plan
+
+
+def clear_correlation_transform_cache():
+    """
+    Free all cached :class:`CorrelationTransform` plans
+    """
+    _correlation_transform_cache.clear()
+
+
 def lensing_correlations(clpp, xvals, lmax=None):
     """
     Get the sigma^2(x) and C_{gl,2}(x) functions from the lensing power spectrum
@@ -215,17 +597,12 @@ def lensing_correlations(clpp, xvals, lmax=None):
     ls = np.arange(1, lmax + 1, dtype=np.float64)
     cldd = clpp[1:] / (ls * (ls + 1))
     cphil3 = (2 * ls + 1) * cldd / 2  # (2*l+1)l(l+1)/4pi C_phi_phi
+    xvals = np.asarray(xvals)
     sigmasq = np.zeros(xvals.shape)
     Cg2 = np.zeros(xvals.shape)
-    llp1 = ls * (ls + 1)
-    for i, x in enumerate(xvals):
-        P, dP = legendreP(lmax, x)
-        fac1 = 1 - x
-        fac2 = 1 + x
-        d_11 = fac1 * dP[1:] / llp1 + P[1:]
-        d_m11 = fac2 * dP[1:] / llp1 - P[1:]
-        sigmasq[i] = np.dot(1 - d_11, cphil3)
-        Cg2[i] = np.dot(d_m11, cphil3)
+    for sl, ((d_11, d_m11),) in _legendre_func_blocks(lmax, xvals, [1], narrays=3):
+        sigmasq[sl] = (1 - d_11).dot(cphil3)
+        Cg2[sl] = d_m11.dot(cphil3)
     return sigmasq, Cg2
 
 
@@ -244,8 +621,18 @@ def lensing_R(clpp, lmax=None):
     return np.sum(cphil3)
 
 
+def _apodized_weights(weights, imin, sl, theta_max, apodize_point_width):
+    # integration weights for points imin + [sl], apodized near theta_max if set
+    i = np.arange(sl.start, sl.stop)
+    weight = np.array(weights[imin + sl.start:imin + sl.stop], dtype=np.float64)
+    if theta_max is not None:
+        apod = i < apodize_point_width * 4
+        weight[apod] *= 1 - np.exp(-((i[apod] + 1.) / apodize_point_width) ** 2 / 2)
+    return weight
+
+
 def lensed_correlations(cls, clpp, xvals, weights=None, lmax=None, delta=False, theta_max=None,
-                        apodize_point_width=10):
+                        apodize_point_width=10, n_workers=1):
     """
     Get the lensed correlation function from the unlensed power spectra, evaluated at points cos(theta) = xvals.
     Use roots of Legendre polynomials (np.polynomial.legendre.leggauss) for accurate back integration with corr2cl.
@@ -264,6 +651,9 @@ def lensed_correlations(cls, clpp, xvals, weights=None, lmax=None, delta=False,
     :param lmax: optional maximum L to use from the cls arrays
     :param delta: if true, calculate the difference between lensed and unlensed (default False)
     :param theta_max: maximum angle (in radians) to keep in the correlation functions
+    :param apodize_point_width: if theta_max is set, apodize around the cut using half Gaussian of width
+        apodize_point_width points
+    :param n_workers: number of threads to share the x values between (results are identical for any n_workers)
     :return: 2D array of corrs[i, ix], where ix=0,1,2,3 are T, Q+U, Q-U and cross;
         if weights is not None, then return corrs, lensed_cls
     """
@@ -291,8 +681,6 @@ def lensed_correlations(cls, clpp, xvals, weights=None, lmax=None, delta=False,
     rootfac2 = np.sqrt((ls[1:] + 3) * (ls[1:] - 2))
     rootrat = lfacs2[1:] / rootfac1[1:] / rootfac2
     rootfac3 = np.sqrt((ls[2:] - 3) * (ls[2:] + 4))
-    if weights is not None:
-        lensedcls = np.zeros((lmax + 1, 4))
     if delta:
         delta_diff = 1
     else:
@@ -304,80 +692,150 @@ def lensed_correlations(cls, clpp, xvals, weights=None, lmax=None, delta=False,
     else:
         imin = 0
 
-    corrs = np.zeros((len(xvals[imin:]), 4))
-
-    for i, x in enumerate(xvals[imin:]):
-        (P, dP), (d11, dm11), (d20, d22, d2m2) = legendre_funcs(lmax, x, [0, 1, 2], lfacs, lfacs2,
-                                                                lrootfacs)
-        sigma2 = np.dot(1 - d11, cphil3)
-        Cg2 = np.dot(dm11, cphil3)
+    xs = xvals[imin:]
+    corrs = np.zeros((len(xs), 4))
 
-        c2fac = lfacsall[1:] * Cg2 / 2
-        c2fac2 = c2fac[1:] ** 2
-        fac = np.exp(-lfacsall * sigma2 / 2)
-        difffac = fac - delta_diff
-        f = ct * fac
-        # T (don't really need the term second order Cg2 here, but include for consistency)
-        corrs[i, 0] = np.dot(ct * difffac, P) + np.dot(f[1:], c2fac * (dm11 + c2fac * P[1:] / 4)) \
-                      + np.dot(f[2:], c2fac2 * d2m2) / 4
-        sinth = np.sqrt(1 - x ** 2)
-        sinfac = 4 / sinth
-        fac1 = 1 - x
-        fac2 = 1 + x
-        d1m2 = sinth / rootfac1 * (dP[2:] - 2 / fac1 * dm11[1:])
-        d12 = sinth / rootfac1 * (dP[2:] - 2 / fac2 * d11[1:])
-        d1m3 = (-(x + 0.5) * sinfac * d1m2[1:] / rootfac2 - rootrat * dm11[2:])
-        d2m3 = (-fac2 * d2m2[1:] * sinfac - rootfac1[1:] * d1m2[1:]) / rootfac2
-        d3m3 = (-(x + 1.5) * d2m3 * sinfac - rootfac1[1:] * d1m3) / rootfac2
-        d13 = ((x - 0.5) * sinfac * d12[1:] / rootfac2 - rootrat * d11[2:])
-        d04 = ((-lfacs[2:] + (18 * x ** 2 + 6) / sinth ** 2) * d20[2:] -
-               6 * x * lfacs2[2:] * dP[4:] / lrootfacs[2:]) / (rootfac2[1:] * rootfac3)
-        d2m4 = (-(6 * x + 4) / sinth * d2m3[1:] - rootfac2[1:] * d2m2[2:]) / rootfac3
-        d4m4 = (-7 / 5.0 * (lfacs2[2:] - 6) * d2m2[2:] +
-                12 / 5.0 * (-lfacs2[2:] + (9 * x + 26) / fac1) * d3m3[1:]) / (lfacs2[2:] - 12)
-        # + (second order Cg2 terms are needed for <1% accuracy on BB)
-        f = cp * fac[2:]
-        corrs[i, 1] = np.dot(cp * difffac[2:], d22) + np.dot(f[1:], c2fac[2:] * d13) \
-                      + (np.dot(f, c2fac2 * d22) + np.dot(f[2:], c2fac2[2:] * d04)) / 4
-        # -
-        f = cm * fac[2:]
-        corrs[i, 2] = np.dot(cm * difffac[2:], d2m2) + (np.dot(f, c2fac[1:] * dm11[1:])
-                                                        + np.dot(f[1:], c2fac[2:] * d3m3)) / 2 \
-                      + (np.dot(f, c2fac2 * (2 * d2m2 + P[2:])) + np.dot(f[2:], c2fac2[2:] * d4m4)) / 8
+    # Contributions to the lensed cls are summed within a fixed set of chunks of x values and then over the chunks
+    # in order, so the result does not depend on how the chunks are shared between workers
+    sub_blocks = _legendre_sub_blocks(lmax, len(xs), narrays=16)
+    nchunks = min(len(sub_blocks), _max_reduction_chunks)
+    chunks = [sub_blocks[i * len(sub_blocks) // nchunks:(i + 1) * len(sub_blocks) // nchunks] for i in range(nchunks)]
 
-        # cross
-        f = cc * fac[2:]
-        corrs[i, 3] = np.dot(cc * difffac[2:], d20) + (np.dot(f, c2fac[1:] * d11[1:])
-                                                       + np.dot(f[1:], c2fac[2:] * d1m3)) / 2 \
-                      + (3 * np.dot(f, c2fac2 * d20) + np.dot(f[2:], c2fac2[2:] * d2m4)) / 8
+    def lens_chunks(chunk_list):
+        # fill in corrs for x values in the given chunks, returning each chunk's contribution to the lensed cls
+        subs = [sub for chunk in chunk_list for sub in chunk]
+        chunk_index = dict((sub.start, i) for i, chunk in enumerate(chunk_list) for sub in chunk)
         if weights is not None:
-            weight = weights[i + imin]
-            if theta_max is not None and i < apodize_point_width * 4:
-                weight *= 1 - np.exp(-((i + 1.) / apodize_point_width) ** 2 / 2)
-
-            lensedcls[:, 0] += (weight * corrs[i, 0]) * P
-            T2 = (corrs[i, 1] * weight / 2) * d22
-            T4 = (corrs[i, 2] * weight / 2) * d2m2
-            lensedcls[2:, 1] += T2 + T4
-            lensedcls[2:, 2] += T2 - T4
-            lensedcls[2:, 3] += (weight * corrs[i, 3]) * d20
+            chunk_cls_list = [np.zeros((lmax + 1, 4)) for _ in chunk_list]
+        else:
+            chunk_cls_list = []
+        for sl, ((P, dP), (d11, dm11), (d20, d22, d2m2)) in \
+                _legendre_func_blocks(lmax, xs, [0, 1, 2], lfacs, lfacs2, lrootfacs, sub_blocks=subs):
+            x = xs[sl, np.newaxis]
+            sigma2 = (1 - d11).dot(cphil3)[:, np.newaxis]
+            Cg2 = dm11.dot(cphil3)[:, np.newaxis]
+
+            c2fac = lfacsall[1:] * Cg2 / 2
+            c2fac2 = c2fac[:, 1:] ** 2
+            fac = np.exp(-lfacsall * sigma2 / 2)
+            difffac = fac - delta_diff
+            f = ct * fac
+            # T (don't really need the term second order Cg2 here, but include for consistency)
+            corrs[sl, 0] = _rowdot(ct * difffac, P) + _rowdot(f[:, 1:], c2fac * (dm11 + c2fac * P[:, 1:] / 4)) \
+                           + _rowdot(f[:, 2:], c2fac2 * d2m2) / 4
+            sinth = np.sqrt(1 - x ** 2)
+            sinfac = 4 / sinth
+            fac1 = 1 - x
+            fac2 = 1 + x
+            d1m2 = sinth / rootfac1 * (dP[:, 2:] - 2 / fac1 * dm11[:, 1:])
+            d12 = sinth / rootfac1 * (dP[:, 2:] - 2 / fac2 * d11[:, 1:])
+            d1m3 = (-(x + 0.5) * sinfac * d1m2[:, 1:] / rootfac2 - rootrat * dm11[:, 2:])
+            d2m3 = (-fac2 * d2m2[:, 1:] * sinfac - rootfac1[1:] * d1m2[:, 1:]) / rootfac2
+            d3m3 = (-(x + 1.5) * d2m3 * sinfac - rootfac1[1:] * d1m3) / rootfac2
+            d13 = ((x - 0.5) * sinfac * d12[:, 1:] / rootfac2 - rootrat * d11[:, 2:])
+            d04 = ((-lfacs[2:] + (18 * x ** 2 + 6) / sinth ** 2) * d20[:, 2:] -
+                   6 * x * lfacs2[2:] * dP[:, 4:] / lrootfacs[2:]) / (rootfac2[1:] * rootfac3)
+            d2m4 = (-(6 * x + 4) / sinth * d2m3[:, 1:] - rootfac2[1:] * d2m2[:, 2:]) / rootfac3
+            d4m4 = (-7 / 5.0 * (lfacs2[2:] - 6) * d2m2[:, 2:] +
+                    12 / 5.0 * (-lfacs2[2:] + (9 * x + 26) / fac1) * d3m3[:, 1:]) / (lfacs2[2:] - 12)
+            # + (second order Cg2 terms are needed for <1% accuracy on BB)
+            f = cp * fac[:, 2:]
+            corrs[sl, 1] = _rowdot(cp * difffac[:, 2:], d22) + _rowdot(f[:, 1:], c2fac[:, 2:] * d13) \
+                           + (_rowdot(f, c2fac2 * d22) + _rowdot(f[:, 2:], c2fac2[:, 2:] * d04)) / 4
+            # -
+            f = cm * fac[:, 2:]
+            corrs[sl, 2] = _rowdot(cm * difffac[:, 2:], d2m2) + (_rowdot(f, c2fac[:, 1:] * dm11[:, 1:])
+                                                                 + _rowdot(f[:, 1:], c2fac[:, 2:] * d3m3)) / 2 \
+                           + (_rowdot(f, c2fac2 * (2 * d2m2 + P[:, 2:])) + _rowdot(f[:, 2:], c2fac2[:, 2:] * d4m4)) / 8
+
+            # cross
+            f = cc * fac[:, 2:]
+            corrs[sl, 3] = _rowdot(cc * difffac[:, 2:], d20) + (_rowdot(f, c2fac[:, 1:] * d11[:, 1:])
+                                                                + _rowdot(f[:, 1:], c2fac[:, 2:] * d1m3)) / 2 \
+                           + (3 * _rowdot(f, c2fac2 * d20) + _rowdot(f[:, 2:], c2fac2[:, 2:] * d2m4)) / 8
+            if weights is not None:
+                weight = _apodized_weights(weights, imin, sl, theta_max, apodize_point_width)
+                chunk_cls = chunk_cls_list[chunk_index[sl.start]]
+                chunk_cls[:, 0] += P.T.dot(weight * corrs[sl, 0])
+                T2 = d22.T.dot(corrs[sl, 1] * weight / 2)
+                T4 = d2m2.T.dot(corrs[sl, 2] * weight / 2)
+                chunk_cls[2:, 1] += T2 + T4
+                chunk_cls[2:, 2] += T2 - T4
+                chunk_cls[2:, 3] += d20.T.dot(weight * corrs[sl, 3])
+
+        return chunk_cls_list
+
+    if n_workers > 1 and nchunks > 1:
+        n_workers = min(n_workers, nchunks)
+        pool = ThreadPool(n_workers)
+        try:
+            results = pool.map(lens_chunks, [chunks[i * nchunks // n_workers:(i + 1) * nchunks // n_workers]
+                                             for i in range(n_workers)])
+        finally:
+            pool.close()
+        chunk_cls_list = [chunk_cls for result in results for chunk_cls in result]
+    else:
+        chunk_cls_list = lens_chunks(chunks)
 
     if weights is not None:
+        lensedcls = np.zeros((lmax + 1, 4))
+        for chunk_cls in chunk_cls_list:
+            lensedcls += chunk_cls
         lensedcls[1, :] *= 2
         lensedcls[2:, :] = (lensedcls[2:, :].T * lfacs).T
         return corrs, lensedcls
     else:
         return corrs
 
+
+def fejer_points(npoints):
+    """
+    Points and weights for Fejer's second quadrature rule on [-1,1], which uses the uniform-in-theta points
+    x = cos(i*pi/(npoints+1)), i=1..npoints, and is exact for polynomials of degree < npoints.
+    The weights are integrals of the Chebyshev interpolant, calculated in O(npoints log npoints) using an FFT
+    (Waldvogel 2006, BIT Numerical Mathematics 46, 195). Only the weights use the FFT: lensed correlations and
+    spectra on these points are calculated in O(lmax*npoints), as for the other grids.
+
+    :param npoints: number of points
+    :return: xvals, weights (with xvals increasing)
+    """
+    n = npoints + 1
+    odd = np.arange(1, n, 2, dtype=np.float64)
+    moments = np.concatenate((2 / odd / (odd - 2), [1 / odd[-1]], np.zeros(n - len(odd))))
+    weights = np.fft.ifft(-moments[:-1] - moments[:0:-1]).real[1:]
+    theta = np.arange(1, npoints + 1) * np.pi / n
+    return np.cos(theta[::-1]), weights[::-1]
+
+
+def _lensing_grid(lmax, sampling_factor, leggaus=True, cache=True):
+    npoints = int(sampling_factor * lmax) + 1
+    if leggaus == 'fejer':
+        xvals, weights = fejer_points(npoints)
+    elif leggaus:
+        xvals, weights = _cached_gauss_legendre(npoints, cache)
+    else:
+        theta = np.arange(1, npoints + 1) * np.pi / (npoints + 1)
+        xvals = np.cos(theta[::-1])
+        weights = np.pi / npoints * np.sin(theta)
+    return xvals, weights
+
+
 def lensed_cls(cls, clpp, lmax=None, lmax_lensed=None, sampling_factor=1.4, delta_cls=False,
-               theta_max=np.pi / 32, apodize_point_width=10, leggaus=True, cache=True):
+               theta_max=np.pi / 32, apodize_point_width=10, leggaus=True, cache=True, n_workers=1):
     """
     Get the lensed power spectra from the unlensed power spectra and the lensing potential power.
     Uses the non-perturbative curved-sky results from Eqs 9.12 and 9.16-9.18 of astro-ph/0601594, to second order in C_{gl,2}.
 
-    Correlations are calculated for Gauss-Legendre integration if leggaus=True; this slows it by several seconds,
-    but will be must faster on subsequent calls with the same lmax*sampling_factor.
+    Correlations are calculated for Gauss-Legendre integration if leggaus=True; the first call for a given
+    lmax*sampling_factor may take a little longer to calculate the points, which are then cached
+    in memory and on disk (see gauss_legendre_cache_dir).
+    If cache is True, the x-dependent lensing kernels are also calculated once and then re-used by later calls
+    with the same settings (see :func:`get_lensing_operator`), as long as they fit in lensing_operator_cache_bytes
+    (e.g. for the default theta_max, but not usually for theta_max=None).
     If Gauss-Legendre is not used, sampling_factor needs to be about 2 times larger for same accuracy.
+    Alternatively leggaus='fejer' uses the same uniform points as leggaus=False but with Fejer quadrature weights,
+    which is more accurate for sampling_factor >~ 2.5 (but not for smaller values). The cost per point is the same
+    for all grids, so Gauss-Legendre with the default sampling_factor is usually the fastest for a given accuracy.
 
     For a reference implementation with the full integral range and no apodization set theta_max=None.
 
@@ -396,22 +854,24 @@ def lensed_cls(cls, clpp, lmax=None, lmax_lensed=None, sampling_factor=1.4, delt
     :param theta_max: maximum angle (in radians) to keep in the correlation functions; default: pi/32
     :param apodize_point_width: if theta_max is set, apodize around the cut using half Gaussian of approx
         width apodize_point_width/lmax*pi
-    :param leggaus: whether to use Gauss-Legendre integration (default True)
-    :param cache: if leggaus = True, set cache to save the x values and weights between calls (most of the time)
+    :param leggaus: whether to use Gauss-Legendre integration (default True), or 'fejer' for uniform points
+        with Fejer quadrature weights
+    :param cache: if leggaus = True, set cache to save the x values and weights between calls and processes;
+        also whether to cache the lensing kernels
+    :param n_workers: number of threads to use for the correlation function calculation (if kernels are not cached)
     :return: 2D array of cls[L, ix], with L starting at zero and ix=0,1,2,3 in order TT, EE, BB, TE.
         cls include l(l+1)/2pi factors.
     """
     if lmax is None: lmax = cls.shape[0] - 1
-    npoints = int(sampling_factor * lmax) + 1
-    if leggaus:
-        xvals, weights = _cached_gauss_legendre(npoints, cache)
-    else:
-        theta = np.arange(1, npoints + 1) * np.pi / (npoints + 1)
-        xvals = np.cos(theta[::-1])
-        weights = np.pi / npoints * np.sin(theta)
+    if cache:
+        op = get_lensing_operator(lmax, sampling_factor, theta_max, apodize_point_width, leggaus, build=False)
+        if op is not None:
+            return op(cls, clpp, delta_cls, lmax_lensed)
+    xvals, weights = _lensing_grid(lmax, sampling_factor, leggaus, cache)
     _, lensedcls = lensed_correlations(cls, clpp, xvals, weights, lmax, delta=True,
                                        theta_max=theta_max,
-                                       apodize_point_width=int(apodize_point_width * sampling_factor))
+                                       apodize_point_width=int(apodize_point_width * sampling_factor),
+                                       n_workers=n_workers)
     if not delta_cls:
         lensedcls += cls[:lmax + 1, :]
     if lmax_lensed is not None:
@@ -420,8 +880,477 @@ def lensed_cls(cls, clpp, lmax=None, lmax_lensed=None, sampling_factor=1.4, delt
         return lensedcls
 
 
+def _lensing_kernel_blocks(lmax, xvals, narrays=24, block_bytes=None):
+    """
+    Generator yielding (slice, kernels) for blocks of xvals, where kernels are the x-dependent arrays needed to get
+    the lensed correlations of any set of spectra using _lensed_correlations_from_kernels.
+
+    The lensed correlations are linear in the unlensed spectra, with each term the product of an L-dependent
+    coefficient, exp(-L(L+1)sigma^2/2), and a power of C_{gl,2} multiplying some combination of the d functions.
+    Those combinations of d functions depend only on x, so are calculated once here and can be shared by many spectra.
+    """
+    ls = np.arange(0, lmax + 1, dtype=np.float64)
+    lfacsall = ls * (ls + 1)
+    ls = ls[2:]
+    lfacs = lfacsall[2:]
+    lfacs2 = (ls + 2) * (ls - 1)
+    lrootfacs = np.sqrt(lfacs * lfacs2)
+    rootfac1 = np.sqrt(lfacs2)
+    rootfac2 = np.sqrt((ls[1:] + 3) * (ls[1:] - 2))
+    rootrat = lfacs2[1:] / rootfac1[1:] / rootfac2
+    rootfac3 = np.sqrt((ls[2:] - 3) * (ls[2:] + 4))
+
+    for sl, ((P, dP), (d11, dm11), (d20, d22, d2m2)) in \
+            _legendre_func_blocks(lmax, xvals, [0, 1, 2], lfacs, lfacs2, lrootfacs, narrays, block_bytes):
+        x = xvals[sl, np.newaxis]
+        sinth = np.sqrt(1 - x ** 2)
+        sinfac = 4 / sinth
+        fac1 = 1 - x
+        fac2 = 1 + x
+        d1m2 = sinth / rootfac1 * (dP[:, 2:] - 2 / fac1 * dm11[:, 1:])
+        d12 = sinth / rootfac1 * (dP[:, 2:] - 2 / fac2 * d11[:, 1:])
+        d1m3 = (-(x + 0.5) * sinfac * d1m2[:, 1:] / rootfac2 - rootrat * dm11[:, 2:])
+        d2m3 = (-fac2 * d2m2[:, 1:] * sinfac - rootfac1[1:] * d1m2[:, 1:]) / rootfac2
+        d3m3 = (-(x + 1.5) * d2m3 * sinfac - rootfac1[1:] * d1m3) / rootfac2
+        d13 = ((x - 0.5) * sinfac * d12[:, 1:] / rootfac2 - rootrat * d11[:, 2:])
+        d04 = ((-lfacs[2:] + (18 * x ** 2 + 6) / sinth ** 2) * d20[:, 2:] -
+               6 * x * lfacs2[2:] * dP[:, 4:] / lrootfacs[2:]) / (rootfac2[1:] * rootfac3)
+        d2m4 = (-(6 * x + 4) / sinth * d2m3[:, 1:] - rootfac2[1:] * d2m2[:, 2:]) / rootfac3
+        d4m4 = (-7 / 5.0 * (lfacs2[2:] - 6) * d2m2[:, 2:] +
+                12 / 5.0 * (-lfacs2[2:] + (9 * x + 26) / fac1) * d3m3[:, 1:]) / (lfacs2[2:] - 12)
+
+        # Kernels multiplying C_{gl,2} and C_{gl,2}^2, with T arrays starting at L=0 and polarization at L=2
+        T1 = np.zeros(P.shape)
+        T1[:, 1:] = lfacsall[1:] * dm11
+        T2 = np.zeros(P.shape)
+        T2[:, 1:] = P[:, 1:]
+        T2[:, 2:] += d2m2
+        T2 *= lfacsall ** 2
+        plus1 = np.zeros(d22.shape)
+        plus1[:, 1:] = lfacs[1:] * d13
+        plus2 = d22.copy()
+        plus2[:, 2:] += d04
+        plus2 *= lfacs ** 2
+        minus1 = dm11[:, 1:].copy()
+        minus1[:, 1:] += d3m3
+        minus1 *= lfacs
+        minus2 = 2 * d2m2 + P[:, 2:]
+        minus2[:, 2:] += d4m4
+        minus2 *= lfacs ** 2
+        cross1 = d11[:, 1:].copy()
+        cross1[:, 1:] += d1m3
+        cross1 *= lfacs
+        cross2 = 3 * d20
+        cross2[:, 2:] += d2m4
+        cross2 *= lfacs ** 2
+        yield sl, (1 - d11, dm11, ((P, T1, T2), (d22, plus1, plus2), (d2m2, minus1, minus2), (d20, cross1, cross2)))
+
+
+# Powers of C_{gl,2} multiplying the kernels in each of the T, Q+U, Q-U and cross correlations
+_lensing_kernel_cgl_facs = ((1 / 2., 1 / 16.), (1 / 2., 1 / 16.), (1 / 4., 1 / 32.), (1 / 4., 1 / 32.))
+
+
+def _lensing_coefficients(cls_stack, clpp_stack, lmax):
+    # L-dependent coefficients of the stacked spectra as used by _lensed_correlations_from_kernels
+    ls = np.arange(0, lmax + 1, dtype=np.float64)
+    lfacs = ls * (ls + 1)
+    lfacs[0] = 1
+    cldd = clpp_stack[:, 1:lmax + 1] / lfacs[1:]
+    cphil3 = (2 * ls[1:] + 1) * cldd / 2  # (2*l+1)l(l+1)/4pi C_phi_phi
+    facs = (2 * ls + 1) / (4 * np.pi) * 2 * np.pi / lfacs
+    ct = facs * cls_stack[:, :lmax + 1, 0]
+    # For polarization, all arrays start at 2
+    cp = facs[2:] * (cls_stack[:, 2:lmax + 1, 1] + cls_stack[:, 2:lmax + 1, 2])
+    cm = facs[2:] * (cls_stack[:, 2:lmax + 1, 1] - cls_stack[:, 2:lmax + 1, 2])
+    cc = facs[2:] * cls_stack[:, 2:lmax + 1, 3]
+    return cphil3, (ct, cp, cm, cc)
+
+
+def _lensed_correlations_from_kernels(kernels, cphil3, coeffs, delta=False):
+    # lensed correlations corrs[i, j, ix] for spectrum i at the j-th x value of the kernel block
+    one_minus_d11, dm11, comps = kernels
+    lmax = one_minus_d11.shape[1]
+    nx = one_minus_d11.shape[0]
+    lfacsall = np.arange(0, lmax + 1, dtype=np.float64)
+    lfacsall *= lfacsall + 1
+    sigma2 = cphil3.dot(one_minus_d11.T)
+    Cg2 = cphil3.dot(dm11.T)
+    fac = np.exp(-lfacsall * (sigma2[:, :, np.newaxis] / 2))
+    if delta:
+        difffac = fac - 1
+    else:
+        difffac = fac
+    corrs = np.empty((cphil3.shape[0], nx, 4))
+    for ix, (c, (K0, K1, K2), (fac1, fac2)) in enumerate(zip(coeffs, comps, _lensing_kernel_cgl_facs)):
+        lmin = lmax + 1 - c.shape[1]
+        corr = np.einsum('ijl,jl->ij', c[:, np.newaxis, :] * difffac[:, :, lmin:], K0)
+        cfac = c[:, np.newaxis, :] * fac[:, :, lmin:]
+        corr += Cg2 * fac1 * np.einsum('ijl,jl->ij', cfac, K1)
+        corr += Cg2 ** 2 * fac2 * np.einsum('ijl,jl->ij', cfac, K2)
+        corrs[:, :, ix] = corr
+    return corrs
+
+
+def lensed_cls_batch(cls_stack, clpp_stack, lmax=None, lmax_lensed=None, sampling_factor=1.4, delta_cls=False,
+                     theta_max=np.pi / 32, apodize_point_width=10, leggaus=True, cache=True):
+    """
+    Get the lensed power spectra for a stack of unlensed power spectra and lensing potential power spectra,
+    equivalent to calling :func:`lensed_cls` for each set of spectra in turn but much faster for large stacks.
+
+    The x-dependent geometric factors (d functions and their combinations) are calculated once
+    for each block of x values and shared by all spectra, so the per-spectrum cost is only the lensing smoothing factors
+    and a few matrix-vector products at each x.
+
+    :param cls_stack: 3D array of unlensed cls[i, L, ix] for spectrum i, with L starting at zero and
+        ix=0,1,2,3 in order TT, EE, BB, TE. cls should include l(l+1)/2pi factors.
+    :param clpp_stack: 2D array of [l(l+1)]^2 C_phi_phi/2/pi lensing potential power spectra clpp[i, L]
+        (zero based), or a single 1D array to use the same lensing potential for all the spectra
+    :param lmax: optional maximum L to use from the cls arrays
+    :param lmax_lensed: optional maximum L for the returned cl array (lmax_lensed <= lmax)
+    :param sampling_factor: npoints = int(sampling_factor*lmax)+1
+    :param delta_cls: if true, return the difference between lensed and unlensed (optional, default False)
+    :param theta_max: maximum angle (in radians) to keep in the correlation functions; default: pi/32
+    :param apodize_point_width: if theta_max is set, apodize around the cut using half Gaussian of approx
+        width apodize_point_width/lmax*pi
+    :param leggaus: whether to use Gauss-Legendre integration (default True), or 'fejer' for uniform points
+        with Fejer quadrature weights
+    :param cache: if leggaus = True, set cache to save the x values and weights between calls and processes
+    :return: 3D array of cls[i, L, ix], with L starting at zero and ix=0,1,2,3 in order TT, EE, BB, TE.
+        cls include l(l+1)/2pi factors.
+    """
+    cls_stack, clpp_stack = _lensing_stacks(cls_stack, clpp_stack)
+    if lmax is None: lmax = cls_stack.shape[1] - 1
+    xvals, weights = _lensing_grid(lmax, sampling_factor, leggaus, cache)
+    apodize_point_width = int(apodize_point_width * sampling_factor)
+    if theta_max is not None:
+        imin = np.searchsorted(xvals, np.cos(theta_max))
+    else:
+        imin = 0
+    xs = xvals[imin:]
+    cphil3, coeffs = _lensing_coefficients(cls_stack, clpp_stack, lmax)
+
+    lensedcls = np.zeros((cls_stack.shape[0], lmax + 1, 4))
+    # the kernels take about 24 arrays of size lmax, plus about three temporary arrays for each spectrum;
+    # blocks larger than cache are faster overall as most of the work is then in matrix products
+    for sl, kernels in _lensing_kernel_blocks(lmax, xs, narrays=24 + 3 * cls_stack.shape[0],
+                                              block_bytes=_recursion_block_bytes):
+        _add_lensed_cls(lensedcls, kernels, cphil3, coeffs,
+                        _apodized_weights(weights, imin, sl, theta_max, apodize_point_width))
+    return _lensed_cls_result(lensedcls, cls_stack, delta_cls, lmax_lensed)
+
+
+def _lensing_stacks(cls_stack, clpp_stack):
+    cls_stack = np.asarray(cls_stack)
+    if cls_stack.ndim != 3:
+        raise ValueError('cls_stack must be a 3D array cls[i, L, ix]')
+    clpp_stack = np.asarray(clpp_stack)
+    if clpp_stack.ndim == 1:
+        clpp_stack = np.broadcast_to(clpp_stack, (cls_stack.shape[0], clpp_stack.shape[0]))
+    elif clpp_stack.shape[0] != cls_stack.shape[0]:
+        raise ValueError('clpp_stack must have one lensing potential spectrum for each set of cls')
+    return cls_stack, clpp_stack
+
+
+def _add_lensed_cls(lensedcls, kernels, cphil3, coeffs, weights):
+    # add the contribution of a block of x values with given integration weights to the lensing
+    # change in lensedcls[i, L, ix] (before L factors are applied by _lensed_cls_result)
+    corrs = _lensed_correlations_from_kernels(kernels, cphil3, coeffs, delta=True)
+    corrs *= weights[:, np.newaxis]
+    P, d22, d2m2, d20 = [comp[0] for comp in kernels[2]]
+    lensedcls[:, :, 0] += corrs[:, :, 0].dot(P)
+    T2 = corrs[:, :, 1].dot(d22) / 2
+    T4 = corrs[:, :, 2].dot(d2m2) / 2
+    lensedcls[:, 2:, 1] += T2 + T4
+    lensedcls[:, 2:, 2] += T2 - T4
+    lensedcls[:, 2:, 3] += corrs[:, :, 3].dot(d20)
+
+
+def _lensed_cls_result(lensedcls, cls_stack, delta_cls=False, lmax_lensed=None):
+    lmax = lensedcls.shape[1] - 1
+    ls = np.arange(2, lmax + 1, dtype=np.float64)
+    lensedcls[:, 1, :] *= 2
+    lensedcls[:, 2:, :] *= (ls * (ls + 1))[:, np.newaxis]
+    if not delta_cls:
+        lensedcls += cls_stack[:, :lmax + 1, :]
+    if lmax_lensed is not None:
+        return lensedcls[:, :lmax_lensed + 1, :]
+    else:
+        return lensedcls
+
+
+class LensingOperator(object):
+    """
+    Operator to get lensed CMB power spectra for fixed lmax, sampling, theta_max and apodization, giving the
+    same results as :func:`lensed_cls` and :func:`lensed_cls_batch`.
+    All the x-dependent d function combinations are calculated once on construction, so each call only has
+    to calculate the parts that depend on the spectra. Useful when lensing many spectra with the same settings,
+    e.g. in a likelihood or emulator. Operators can be saved and loaded (without pickle) to share them with workers.
+
+    Kernels use 14*len(xvals)*(lmax+1) values, with len(xvals) about lmax*sampling_factor*theta_max/pi.
+    They can be stored as float32 to halve the memory, at the cost of reduced accuracy (especially for BB).
+
+    :ivar lmax: maximum L
+    :ivar sampling_factor: number of integration points is int(sampling_factor*lmax)+1
+    :ivar theta_max: maximum angle of the correlation functions (None for all)
+    :ivar apodize_point_width: apodization width in number of points at the default sampling_factor
+    :ivar leggaus: whether Gauss-Legendre integration points are used (or 'fejer' for Fejer quadrature)
+    :ivar xvals: cos(theta) values of the integration points used
+    :ivar weights: (apodized) integration weights at xvals
+    """
+
+    _kernel_names = ['one_minus_d11', 'dm11', 'P', 'T1', 'T2', 'd22', 'plus1', 'plus2',
+                     'd2m2', 'minus1', 'minus2', 'd20', 'cross1', 'cross2']
+    _file_version = 1
+
+    def __init__(self, lmax, sampling_factor=1.4, theta_max=np.pi / 32, apodize_point_width=10, leggaus=True,
+                 dtype=np.float64):
+        """
+        :param lmax: maximum L
+        :param sampling_factor: npoints = int(sampling_factor*lmax)+1
+        :param theta_max: maximum angle (in radians) to keep in the correlation functions; default: pi/32
+        :param apodize_point_width: if theta_max is set, apodize around the cut using half Gaussian of approx
+            width apodize_point_width/lmax*pi
+        :param leggaus: whether to use Gauss-Legendre integration (default True), or 'fejer' for uniform points
+            with Fejer quadrature weights
+        :param dtype: np.float64 or np.float32, type used to store the kernels
+        """
+        self.lmax = lmax
+        self.sampling_factor = sampling_factor
+        self.theta_max = theta_max
+        self.apodize_point_width = apodize_point_width
+        self.leggaus = leggaus
+        xvals, weights = _lensing_grid(lmax, sampling_factor, leggaus)
+        if theta_max is not None:
+            imin = np.searchsorted(xvals, np.cos(theta_max))
+        else:
+            imin = 0
+        self.xvals = np.array(xvals[imin:])
+        self.weights = _apodized_weights(weights, imin, slice(0, len(self.xvals)), theta_max,
+                                         int(apodize_point_width * sampling_factor))
+        self._kernels = []
+        for sl, kernels in _lensing_kernel_blocks(lmax, self.xvals):
+            kernels = self._flat_kernels(kernels)
+            if not self._kernels:
+                self._kernels = [np.empty((len(self.xvals), k.shape[1]), dtype=dtype) for k in kernels]
+            for store, k in zip(self._kernels, kernels):
+                store[sl] = k
+
+    @staticmethod
+    def _flat_kernels(kernels):
+        one_minus_d11, dm11, comps = kernels
+        return [one_minus_d11, dm11] + [k for comp in comps for k in comp]
+
+    def _block_kernels(self, sl):
+        k = [store[sl] for store in self._kernels]
+        return k[0], k[1], tuple(tuple(k[i:i + 3]) for i in range(2, 14, 3))
+
+    @property
+    def dtype(self):
+        return self._kernels[0].dtype if self._kernels else np.dtype(np.float64)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the stored kernels, points and weights in bytes
+        """
+        return sum(k.nbytes for k in self._kernels) + self.xvals.nbytes + self.weights.nbytes
+
+    def __call__(self, cls, clpp, delta_cls=False, lmax_lensed=None):
+        """
+        Get the lensed power spectra, as :func:`lensed_cls`.
+
+        :param cls: 2D array of unlensed cls[L, ix], or stack cls[i, L, ix] of several sets of spectra,
+            with L starting at zero and ix=0,1,2,3 in order TT, EE, BB, TE.
+            cls should include l(l+1)/2pi factors and go to at least lmax.
+        :param clpp: array of [l(l+1)]^2 C_phi_phi/2/pi lensing potential power spectrum (zero based),
+            or stack clpp[i, L] if cls is a stack
+        :param delta_cls: if true, return the difference between lensed and unlensed (optional, default False)
+        :param lmax_lensed: optional maximum L for the returned cl array (lmax_lensed <= lmax)
+        :return: array of lensed cls[L, ix] or stack cls[i, L, ix], with L starting at zero and ix=0,1,2,3
+            in order TT, EE, BB, TE. cls include l(l+1)/2pi factors.
+        """
+        cls = np.asarray(cls)
+        single = cls.ndim == 2
+        if single:
+            cls = cls[np.newaxis]
+        cls, clpp = _lensing_stacks(cls, clpp)
+        if cls.shape[1] <= self.lmax or clpp.shape[1] <= self.lmax:
+            raise ValueError('cls and clpp must extend to at least L=%s' % self.lmax)
+        cphil3, coeffs = _lensing_coefficients(cls, clpp, self.lmax)
+        lensedcls = np.zeros((cls.shape[0], self.lmax + 1, 4))
+        for sl in _x_blocks(len(self.xvals), _block_size(self.lmax, _recursion_block_bytes, 4 + 3 * cls.shape[0])):
+            _add_lensed_cls(lensedcls, self._block_kernels(sl), cphil3, coeffs, self.weights[sl])
+        lensedcls = _lensed_cls_result(lensedcls, cls, delta_cls, lmax_lensed)
+        return lensedcls[0] if single else lensedcls
+
+    def save(self, filename):
+        """
+        Save the operator to a .npz file (which does not use pickle).
+
+        :param filename: file name to save to
+        """
+        np.savez(filename, version=self._file_version, lmax=self.lmax, sampling_factor=self.sampling_factor,
+                 theta_max=np.nan if self.theta_max is None else self.theta_max,
+                 apodize_point_width=self.apodize_point_width, leggaus=str(self.leggaus), xvals=self.xvals,
+                 weights=self.weights, **dict(zip(self._kernel_names, self._kernels)))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load an operator saved by :meth:`save`.
+
+        :param filename: file name of .npz file
+        :return: :class:`LensingOperator` instance
+        """
+        with np.load(filename, allow_pickle=False) as data:
+            if int(data['version']) != cls._file_version:
+                raise ValueError('LensingOperator file %s has unsupported version %s' % (filename, data['version']))
+            op = cls.__new__(cls)
+            op.lmax = int(data['lmax'])
+            op.sampling_factor = float(data['sampling_factor'])
+            op.theta_max = None if np.isnan(data['theta_max']) else float(data['theta_max'])
+            op.apodize_point_width = int(data['apodize_point_width'])
+            op.leggaus = {'True': True, 'False': False}.get(str(data['leggaus']), str(data['leggaus']))
+            op.xvals = data['xvals']
+            op.weights = data['weights']
+            op._kernels = [data[name] for name in cls._kernel_names]
+        return op
+
+
+# Operators used by lensed_cls are shared via an LRU cache holding at most lensing_operator_cache_bytes of kernels
+lensing_operator_cache_bytes = 2 ** 30
+_lensing_operator_cache = OrderedDict()
+
+
+def get_lensing_operator(lmax, sampling_factor=1.4, theta_max=np.pi / 32, apodize_point_width=10, leggaus=True,
+                         build=True):
+    """
+    Get a :class:`LensingOperator`, re-using a cached one with the same settings if available.
+    Least recently used operators are dropped when the total size exceeds lensing_operator_cache_bytes
+    (operators larger than that are returned but not cached).
+
+    :param lmax: maximum L
+    :param sampling_factor: npoints = int(sampling_factor*lmax)+1
+    :param theta_max: maximum angle (in radians) to keep in the correlation functions; default: pi/32
+    :param apodize_point_width: if theta_max is set, apodize around the cut using half Gaussian of approx
+        width apodize_point_width/lmax*pi
+    :param leggaus: whether to use Gauss-Legendre integration (default True), or 'fejer' for uniform points
+        with Fejer quadrature weights
+    :param build: if False, return None instead of calculating an operator that is too large to cache
+    :return: :class:`LensingOperator` instance
+    """
+    key = (lmax, sampling_factor, theta_max, apodize_point_width, leggaus)
+    op = _lensing_operator_cache.pop(key, None)
+    if op is None:
+        if not build:
+            xvals, _ = _lensing_grid(lmax, sampling_factor, leggaus)
+            nx = len(xvals) - (np.searchsorted(xvals, np.cos(theta_max)) if theta_max is not None else 0)
+            if len(LensingOperator._kernel_names) * nx * (lmax + 1) * 8 > lensing_operator_cache_bytes:
+                return None
+        op = LensingOperator(lmax, sampling_factor, theta_max, apodize_point_width, leggaus)
+    if op.nbytes <= lensing_operator_cache_bytes:
+        _lensing_operator_cache[key] = op
+        while sum(o.nbytes for o in _lensing_operator_cache.values()) > lensing_operator_cache_bytes:
+            _lensing_operator_cache.popitem(last=False)
+    return op
+
+
+def clear_lensing_operator_cache():
+    """
+    Free all cached :class:`LensingOperator` kernels
+    """
+    _lensing_operator_cache.clear()
+
+
+def _derivative_ell_blocks(lmax, block_corrs, theta_max=np.pi / 32, apodize_point_width=10, sampling_factor=1.4,
+                           ell_block=None, x_block_bytes=None):
+    # Generator yielding (ells, dcl) for slices ells of ell, where dcl[ix, ell-ells.start, L] is the derivative
+    # of the lensed cls, given block_corrs(x, legendre_funcs) returning the derivatives of the correlation functions
+    # corrs[ix, i, L] at x[i]. The weighted correlation derivatives and d functions (8*(lmax+1) values for each x)
+    # are calculated for chunks of x using at most x_block_bytes (default _derivative_x_block_bytes), summing the
+    # contributions of each chunk, so neither they nor the full dcl array need to be held in memory.
+    # If all x fit in one chunk (e.g. theta_max is set) they are calculated once, otherwise they are re-calculated
+    # for each block of ell.
+    npoints = int(sampling_factor * lmax) + 1
+    xvals, weights = _cached_gauss_legendre(npoints)
+    if theta_max is not None:
+        xmin = np.cos(theta_max)
+        imin = np.searchsorted(xvals, xmin)  # assume xvals sorted
+    else:
+        imin = 0
+    xs = xvals[imin:]
+
+    ls = np.arange(2, lmax + 1, dtype=np.float64)
+    lfacs = ls * (ls + 1)
+    lfacs2 = (ls + 2) * (ls - 1)
+    lrootfacs = np.sqrt(lfacs * lfacs2)
+    x_block_bytes = x_block_bytes or _derivative_x_block_bytes
+
+    def chunk_arrays(chunk):
+        # P, d22, d2m2 and d20 (spin-2 functions zero for ell < 2) and corresponding weighted correlation derivatives
+        dfuncs = np.zeros((4, chunk.stop - chunk.start, lmax + 1))
+        corrs = np.empty(dfuncs.shape)
+        for sl, funcs in _legendre_func_blocks(lmax, xs[chunk], [0, 1, 2], lfacs, lfacs2, lrootfacs, narrays=32):
+            (P, dP), _, (d20, d22, d2m2) = funcs
+            weight = _apodized_weights(weights, imin, slice(chunk.start + sl.start, chunk.start + sl.stop),
+                                       theta_max, apodize_point_width)[:, np.newaxis]
+            corrs[:, sl, :] = block_corrs(xs[chunk][sl, np.newaxis], funcs) * weight
+            dfuncs[0, sl, :] = P
+            dfuncs[1, sl, 2:] = d22
+            dfuncs[2, sl, 2:] = d2m2
+            dfuncs[3, sl, 2:] = d20
+        return dfuncs, corrs
+
+    chunks = list(_x_blocks(len(xs), _block_size(lmax, x_block_bytes, 8)))
+    if len(chunks) == 1:
+        arrays = chunk_arrays(chunks[0])
+    if ell_block is None:
+        # when re-calculating for each ell block, use fewer larger blocks
+        ell_block = _block_size(lmax, _recursion_block_bytes if len(chunks) == 1 else x_block_bytes, 4)
+    for ells in _x_blocks(lmax + 1, ell_block):
+        dcl = np.zeros((4, ells.stop - ells.start, lmax + 1))
+        for chunk in chunks:
+            dfuncs, corrs = arrays if len(chunks) == 1 else chunk_arrays(chunk)
+            dcl[0] += dfuncs[0, :, ells].T.dot(corrs[0])
+            T2 = dfuncs[1, :, ells].T.dot(corrs[1] / 2)
+            T4 = dfuncs[2, :, ells].T.dot(corrs[2] / 2)
+            dcl[1] += T2 + T4
+            dcl[2] += T2 - T4
+            dcl[3] += dfuncs[3, :, ells].T.dot(corrs[3])
+        # put into ell(ell+1)C_ell/2pi units [two pi cancels from correlation integral]
+        ell = np.arange(ells.start, ells.stop, dtype=np.float64)
+        dcl *= np.maximum(ell * (ell + 1), 1)[:, np.newaxis]
+        yield ells, dcl
+
+
+def _collect_derivative_blocks(blocks, lmax, filename=None, project=None):
+    # Assemble (4, lmax+1, lmax+1) derivative array from blocks of ell, optionally contracting the last index
+    # with project, and optionally stored as a memory-mapped .npy file
+    shape = (4, lmax + 1)
+    if project is not None:
+        project = np.asarray(project)
+        if project.shape[0] < lmax + 1:
+            raise ValueError('project must have at least lmax+1 rows, one for each L')
+        project = project[:lmax + 1]
+        shape += project.shape[1:]
+    else:
+        shape += (lmax + 1,)
+    if filename:
+        result = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64, shape=shape)
+    else:
+        result = np.empty(shape)
+    for ells, dcl in blocks:
+        if project is not None:
+            result[:, ells] = np.dot(dcl, project)
+        else:
+            result[:, ells] = dcl
+    if filename:
+        result.flush()
+    return result
+
+
 def lensed_cl_derivatives(cls, clpp, lmax=None, theta_max=np.pi / 32,
-                          apodize_point_width=10, sampling_factor=1.4):
+                          apodize_point_width=10, sampling_factor=1.4, filename=None, project=None):
     """
     Get derivative dcl of lensed ell(ell+1)C_ell/2pi with respect to log(C^phi_L).
     To leading order (and hence not actually accurate), the lensed correction to power spectrum ix
@@ -437,13 +1366,41 @@ def lensed_cl_derivatives(cls, clpp, lmax=None, theta_max=np.pi / 32,
     :param apodize_point_width: if theta_max is set, apodize around the cut using half Gaussian of approx
         width apodize_point_width/lmax*pi
     :param sampling_factor: npoints = int(sampling_factor*lmax)+1
+    :param filename: optional file name to save the result as a memory-mapped .npy file, in which case
+        the returned array is the np.memmap (and the full array is never held in memory)
+    :param project: optional vector or matrix project[L,...] to contract with the L index of the result,
+        returning array of shape (4, lmax+1) + project.shape[1:] without calculating the full array
     :return: array dCL[ix, ell, L], where ix=0,1,2,3 are T, EE, BB, TE and result is d[ell(ell+1)C^ix_ell/2pi]/ d log C^phi_L
 
     """
 
     if lmax is None: lmax = cls.shape[0] - 1
-    npoints = int(sampling_factor * lmax) + 1
-    xvals, weights = _cached_gauss_legendre(npoints)
+    return _collect_derivative_blocks(lensed_cl_derivative_blocks(cls, clpp, lmax, theta_max, apodize_point_width,
+                                                                  sampling_factor), lmax, filename, project)
+
+
+def lensed_cl_derivative_blocks(cls, clpp, lmax=None, theta_max=np.pi / 32, apodize_point_width=10,
+                                sampling_factor=1.4, ell_block=None):
+    """
+    Generator version of :func:`lensed_cl_derivatives`, yielding the derivatives for blocks of ell,
+    so that the full (4, lmax+1, lmax+1) array never needs to be stored.
+
+    :param cls: 2D array of unlensed cls(L,ix), with L starting at zero and ix=0,1,2,3 in order TT, EE, BB, TE.
+        cls should include l(l+1)/2pi factors.
+    :param clpp: array of [l(l+1)]^2 C_phi_phi/2/pi lensing potential power spectrum
+    :param lmax: optional maximum L to use from the cls arrays
+    :param theta_max: maximum angle (in radians) to keep in the correlation functions. If None (or large), the
+        intermediate arrays for all angles may not fit in memory (_derivative_x_block_bytes), in which case they are
+        calculated in chunks and re-calculated for each block of ell, which is much slower
+    :param apodize_point_width: if theta_max is set, apodize around the cut using half Gaussian of approx
+        width apodize_point_width/lmax*pi
+    :param sampling_factor: npoints = int(sampling_factor*lmax)+1
+    :param ell_block: optional number of ell values in each block
+    :return: generator yielding (ells, dcl), where ells is a slice of ell values,
+        and dcl[ix, ell-ells.start, L] is as returned by :func:`lensed_cl_derivatives`
+    """
+
+    if lmax is None: lmax = cls.shape[0] - 1
 
     ls = np.arange(0, lmax + 1, dtype=np.float64)
     lfacs = ls * (ls + 1)
@@ -466,100 +1423,79 @@ def lensed_cl_derivatives(cls, clpp, lmax=None, theta_max=np.pi / 32,
     rootfac2 = np.sqrt((ls[1:] + 3) * (ls[1:] - 2))
     rootrat = lfacs2[1:] / rootfac1[1:] / rootfac2
     rootfac3 = np.sqrt((ls[2:] - 3) * (ls[2:] + 4))
-    dcl = np.zeros((4, lmax + 1, lmax + 1))
-
-    if theta_max is not None:
-        xmin = np.cos(theta_max)
-        imin = np.searchsorted(xvals, xmin)  # assume xvals sorted
-    else:
-        imin = 0
 
-    corrs = np.zeros((4, lmax + 1))
-
-    for i, x in enumerate(xvals[imin:]):
-        (P, dP), (d11, dm11), (d20, d22, d2m2) = legendre_funcs(lmax, x, [0, 1, 2], lfacs, lfacs2,
-                                                                lrootfacs)
-        sigma2 = np.dot(1 - d11, cphil3)
+    def block_corrs(x, funcs):
+        (P, dP), (d11, dm11), (d20, d22, d2m2) = funcs
+        corrs = np.zeros((4, len(x), lmax + 1))
+        sigma2 = (1 - d11).dot(cphil3)[:, np.newaxis]
         dsigma2 = 1 - d11
-        Cg2 = np.dot(dm11, cphil3)
+        Cg2 = dm11.dot(cphil3)[:, np.newaxis]
         dCg2 = dm11
 
         c2fac = lfacsall[1:] * Cg2 / 2
-        c2fac2 = c2fac[1:] ** 2
+        c2fac2 = c2fac[:, 1:] ** 2
         fac = np.exp(-lfacsall * sigma2 / 2)
         f = -lfacsall / 2 * ct * fac
         orderfac = 1  # set to zero to neglect second order in cg2 (doesn't make much difference)
         # T (don't really need the term second order Cg2 here, but include for consistency)
-        corr = np.dot(f[1:], P[1:] + c2fac * (dm11 + orderfac * c2fac * P[1:] / 4)) \
-               + orderfac * np.dot(f[2:], c2fac2 * d2m2) / 4
+        corr = _rowdot(f[:, 1:], P[:, 1:] + c2fac * (dm11 + orderfac * c2fac * P[:, 1:] / 4)) \
+               + orderfac * _rowdot(f[:, 2:], c2fac2 * d2m2) / 4
         f = -f
-        corr2 = np.dot(f[1:], (dm11 + orderfac * 2 * c2fac * P[1:] / 4)) + orderfac * 2 * np.dot(f[2:],
-                                                                                                 c2fac[1:] * d2m2) / 4
-        corrs[0, 1:] = (dsigma2 * corr + dCg2 * corr2) * cphil3
+        corr2 = _rowdot(f[:, 1:], (dm11 + orderfac * 2 * c2fac * P[:, 1:] / 4)) \
+                + orderfac * 2 * _rowdot(f[:, 2:], c2fac[:, 1:] * d2m2) / 4
+        corrs[0, :, 1:] = (dsigma2 * corr[:, np.newaxis] + dCg2 * corr2[:, np.newaxis]) * cphil3
         sinth = np.sqrt(1 - x ** 2)
         sinfac = 4 / sinth
         fac1 = 1 - x
         fac2 = 1 + x
-        d1m2 = sinth / rootfac1 * (dP[2:] - 2 / fac1 * dm11[1:])
-        d12 = sinth / rootfac1 * (dP[2:] - 2 / fac2 * d11[1:])
-        d1m3 = (-(x + 0.5) * sinfac * d1m2[1:] / rootfac2 - rootrat * dm11[2:])
-        d2m3 = (-fac2 * d2m2[1:] * sinfac - rootfac1[1:] * d1m2[1:]) / rootfac2
+        d1m2 = sinth / rootfac1 * (dP[:, 2:] - 2 / fac1 * dm11[:, 1:])
+        d12 = sinth / rootfac1 * (dP[:, 2:] - 2 / fac2 * d11[:, 1:])
+        d1m3 = (-(x + 0.5) * sinfac * d1m2[:, 1:] / rootfac2 - rootrat * dm11[:, 2:])
+        d2m3 = (-fac2 * d2m2[:, 1:] * sinfac - rootfac1[1:] * d1m2[:, 1:]) / rootfac2
         d3m3 = (-(x + 1.5) * d2m3 * sinfac - rootfac1[1:] * d1m3) / rootfac2
-        d13 = ((x - 0.5) * sinfac * d12[1:] / rootfac2 - rootrat * d11[2:])
-        d04 = ((-lfacs[2:] + (18 * x ** 2 + 6) / sinth ** 2) * d20[2:] -
-               6 * x * lfacs2[2:] * dP[4:] / lrootfacs[2:]) / (rootfac2[1:] * rootfac3)
-        d2m4 = (-(6 * x + 4) / sinth * d2m3[1:] - rootfac2[1:] * d2m2[2:]) / rootfac3
-        d4m4 = (-7 / 5.0 * (lfacs2[2:] - 6) * d2m2[2:] +
-                12 / 5.0 * (-lfacs2[2:] + (9 * x + 26) / fac1) * d3m3[1:]) / (lfacs2[2:] - 12)
+        d13 = ((x - 0.5) * sinfac * d12[:, 1:] / rootfac2 - rootrat * d11[:, 2:])
+        d04 = ((-lfacs[2:] + (18 * x ** 2 + 6) / sinth ** 2) * d20[:, 2:] -
+               6 * x * lfacs2[2:] * dP[:, 4:] / lrootfacs[2:]) / (rootfac2[1:] * rootfac3)
+        d2m4 = (-(6 * x + 4) / sinth * d2m3[:, 1:] - rootfac2[1:] * d2m2[:, 2:]) / rootfac3
+        d4m4 = (-7 / 5.0 * (lfacs2[2:] - 6) * d2m2[:, 2:] +
+                12 / 5.0 * (-lfacs2[2:] + (9 * x + 26) / fac1) * d3m3[:, 1:]) / (lfacs2[2:] - 12)
         # + (second order Cg2 terms are needed for <1% accuracy on BB)
-        f = -lfacsall[2:] / 2 * cp * fac[2:]
-        corr = np.dot(f, d22) + np.dot(f[1:], c2fac[2:] * d13) \
-               + orderfac * (np.dot(f, c2fac2 * d22) + np.dot(f[2:], c2fac2[2:] * d04)) / 4
-        f = lfacsall[2:] / 2 * cp * fac[2:]
-        corr2 = np.dot(f[1:], d13) + orderfac * 2 * (np.dot(f, c2fac[1:] * d22) + np.dot(f[2:], c2fac[3:] * d04)) / 4
-        corrs[1, 1:] = (dsigma2 * corr + dCg2 * corr2) * cphil3
+        f = -lfacsall[2:] / 2 * cp * fac[:, 2:]
+        corr = _rowdot(f, d22) + _rowdot(f[:, 1:], c2fac[:, 2:] * d13) \
+               + orderfac * (_rowdot(f, c2fac2 * d22) + _rowdot(f[:, 2:], c2fac2[:, 2:] * d04)) / 4
+        f = lfacsall[2:] / 2 * cp * fac[:, 2:]
+        corr2 = _rowdot(f[:, 1:], d13) + orderfac * 2 * (_rowdot(f, c2fac[:, 1:] * d22)
+                                                         + _rowdot(f[:, 2:], c2fac[:, 3:] * d04)) / 4
+        corrs[1, :, 1:] = (dsigma2 * corr[:, np.newaxis] + dCg2 * corr2[:, np.newaxis]) * cphil3
         # -
-        f = -lfacsall[2:] / 2 * cm * fac[2:]
-        corr = np.dot(f, d2m2) + (np.dot(f, c2fac[1:] * dm11[1:])
-                                  + np.dot(f[1:], c2fac[2:] * d3m3)) / 2 \
-               + orderfac * (np.dot(f, c2fac2 * (2 * d2m2 + P[2:])) + np.dot(f[2:], c2fac2[2:] * d4m4)) / 8
+        f = -lfacsall[2:] / 2 * cm * fac[:, 2:]
+        corr = _rowdot(f, d2m2) + (_rowdot(f, c2fac[:, 1:] * dm11[:, 1:])
+                                   + _rowdot(f[:, 1:], c2fac[:, 2:] * d3m3)) / 2 \
+               + orderfac * (_rowdot(f, c2fac2 * (2 * d2m2 + P[:, 2:])) + _rowdot(f[:, 2:], c2fac2[:, 2:] * d4m4)) / 8
         f = -f
-        corr2 = (np.dot(f, dm11[1:]) + np.dot(f[1:], d3m3)) / 2 \
-                + orderfac * 2 * (np.dot(f, c2fac[1:] * (2 * d2m2 + P[2:])) + np.dot(f[2:], c2fac[3:] * d4m4)) / 8
+        corr2 = (_rowdot(f, dm11[:, 1:]) + _rowdot(f[:, 1:], d3m3)) / 2 \
+                + orderfac * 2 * (_rowdot(f, c2fac[:, 1:] * (2 * d2m2 + P[:, 2:]))
+                                  + _rowdot(f[:, 2:], c2fac[:, 3:] * d4m4)) / 8
 
-        corrs[2, 1:] = (dsigma2 * corr + dCg2 * corr2) * cphil3
+        corrs[2, :, 1:] = (dsigma2 * corr[:, np.newaxis] + dCg2 * corr2[:, np.newaxis]) * cphil3
 
         # cross
-        f = -lfacsall[2:] / 2 * cc * fac[2:]
-        corr = np.dot(f, d20) + (np.dot(f, c2fac[1:] * d11[1:])
-                                 + np.dot(f[1:], c2fac[2:] * d1m3)) / 2 \
-               + orderfac * (3 * np.dot(f, c2fac2 * d20) + np.dot(f[2:], c2fac2[2:] * d2m4)) / 8
+        f = -lfacsall[2:] / 2 * cc * fac[:, 2:]
+        corr = _rowdot(f, d20) + (_rowdot(f, c2fac[:, 1:] * d11[:, 1:])
+                                  + _rowdot(f[:, 1:], c2fac[:, 2:] * d1m3)) / 2 \
+               + orderfac * (3 * _rowdot(f, c2fac2 * d20) + _rowdot(f[:, 2:], c2fac2[:, 2:] * d2m4)) / 8
         f = -f
-        corr2 = (np.dot(f, d11[1:]) + np.dot(f[1:], d1m3)) / 2 \
-                + orderfac * 2 * (3 * np.dot(f, c2fac[1:] * d20) + np.dot(f[2:], c2fac[3:] * d2m4)) / 8
-
-        corrs[3, 1:] = (dsigma2 * corr + dCg2 * corr2) * cphil3
+        corr2 = (_rowdot(f, d11[:, 1:]) + _rowdot(f[:, 1:], d1m3)) / 2 \
+                + orderfac * 2 * (3 * _rowdot(f, c2fac[:, 1:] * d20) + _rowdot(f[:, 2:], c2fac[:, 3:] * d2m4)) / 8
 
-        weight = weights[i + imin]
-        if theta_max is not None and i < apodize_point_width * 4:
-            weight *= 1 - np.exp(-((i + 1.) / apodize_point_width) ** 2 / 2)
-
-        dcl[0, :, :] += np.outer(P, (weight * corrs[0, :]))
-        T2 = np.outer(d22, (corrs[1, :] * weight / 2))
-        T4 = np.outer(d2m2, (corrs[2, :] * weight / 2))
-        dcl[1, 2:, :] += T2 + T4
-        dcl[2, 2:, :] += T2 - T4
-        dcl[3, 2:, :] += np.outer(d20, (weight * corrs[3, :]))
+        corrs[3, :, 1:] = (dsigma2 * corr[:, np.newaxis] + dCg2 * corr2[:, np.newaxis]) * cphil3
+        return corrs
 
-    # put into ell(ell+1)C_ell/2pi units [two pi cancels from correlation integral]
-    dcl[:, 1, :] *= 2
-    for i in range(dcl.shape[0]):
-        dcl[i, 2:, :] = (dcl[i, 2:, :].T * lfacs).T
-    return dcl
+    return _derivative_ell_blocks(lmax, block_corrs, theta_max, apodize_point_width, sampling_factor, ell_block)
 
 
 def lensed_cl_derivative_unlensed(clpp, lmax=None, theta_max=np.pi / 32,
-                                  apodize_point_width=10, sampling_factor=1.4):
+                                  apodize_point_width=10, sampling_factor=1.4, filename=None, project=None):
     """
     Get derivative dcl of lensed minus unlensed power ell(ell+1)Delta C_ell/2pi with respect to L(L+1)C^unlens_L/2pi
 
@@ -574,14 +1510,40 @@ def lensed_cl_derivative_unlensed(clpp, lmax=None, theta_max=np.pi / 32,
     :param apodize_point_width: if theta_max is set, apodize around the cut using half Gaussian of approx
         width apodize_point_width/lmax*pi
     :param sampling_factor: npoints = int(sampling_factor*lmax)+1
+    :param filename: optional file name to save the result as a memory-mapped .npy file, in which case
+        the returned array is the np.memmap (and the full array is never held in memory)
+    :param project: optional vector or matrix project[L,...] to contract with the L index of the result,
+        returning array of shape (4, lmax+1) + project.shape[1:] without calculating the full array
     :return: array dCL[ix, ell, L], where ix=0,1,2,3 are TT, EE, BB, TE and result is
          d[ell(ell+1)Delta C^ix_ell/2pi]/ d C^{unlens,j}_L where j[ix] are TT, EE, EE, TE
 
     """
 
     if lmax is None: lmax = clpp.shape[0] - 1
-    npoints = int(sampling_factor * lmax) + 1
-    xvals, weights = _cached_gauss_legendre(npoints)
+    return _collect_derivative_blocks(lensed_cl_derivative_unlensed_blocks(clpp, lmax, theta_max, apodize_point_width,
+                                                                           sampling_factor), lmax, filename, project)
+
+
+def lensed_cl_derivative_unlensed_blocks(clpp, lmax=None, theta_max=np.pi / 32, apodize_point_width=10,
+                                         sampling_factor=1.4, ell_block=None):
+    """
+    Generator version of :func:`lensed_cl_derivative_unlensed`, yielding the derivatives for blocks of ell,
+    so that the full (4, lmax+1, lmax+1) array never needs to be stored.
+
+    :param clpp: array of [l(l+1)]^2 C_phi_phi/2/pi lensing potential power spectrum
+    :param lmax: optional maximum L to use from the cls arrays
+    :param theta_max: maximum angle (in radians) to keep in the correlation functions. If None (or large), the
+        intermediate arrays for all angles may not fit in memory (_derivative_x_block_bytes), in which case they are
+        calculated in chunks and re-calculated for each block of ell, which is much slower
+    :param apodize_point_width: if theta_max is set, apodize around the cut using half Gaussian of approx
+        width apodize_point_width/lmax*pi
+    :param sampling_factor: npoints = int(sampling_factor*lmax)+1
+    :param ell_block: optional number of ell values in each block
+    :return: generator yielding (ells, dcl), where ells is a slice of ell values,
+        and dcl[ix, ell-ells.start, L] is as returned by :func:`lensed_cl_derivative_unlensed`
+    """
+
+    if lmax is None: lmax = clpp.shape[0] - 1
 
     ls = np.arange(0, lmax + 1, dtype=np.float64)
     lfacs = ls * (ls + 1)
@@ -604,79 +1566,57 @@ def lensed_cl_derivative_unlensed(clpp, lmax=None, theta_max=np.pi / 32,
     rootfac2 = np.sqrt((ls[1:] + 3) * (ls[1:] - 2))
     rootrat = lfacs2[1:] / rootfac1[1:] / rootfac2
     rootfac3 = np.sqrt((ls[2:] - 3) * (ls[2:] + 4))
-    dcl = np.zeros((4, lmax + 1, lmax + 1))
 
-    if theta_max is not None:
-        xmin = np.cos(theta_max)
-        imin = np.searchsorted(xvals, xmin)  # assume xvals sorted
-    else:
-        imin = 0
-
-    corr = np.zeros((4, lmax + 1))
-
-    for i, x in enumerate(xvals[imin:]):
-        (P, dP), (d11, dm11), (d20, d22, d2m2) = legendre_funcs(lmax, x, [0, 1, 2], lfacs, lfacs2,
-                                                                lrootfacs)
-        sigma2 = np.dot(1 - d11, cphil3)
-        Cg2 = np.dot(dm11, cphil3)
+    def block_corrs(x, funcs):
+        (P, dP), (d11, dm11), (d20, d22, d2m2) = funcs
+        corr = np.zeros((4, len(x), lmax + 1))
+        sigma2 = (1 - d11).dot(cphil3)[:, np.newaxis]
+        Cg2 = dm11.dot(cphil3)[:, np.newaxis]
 
         c2fac = lfacsall[1:] * Cg2 / 2
-        c2fac2 = c2fac[1:] ** 2
+        c2fac2 = c2fac[:, 1:] ** 2
         fac = np.exp(-lfacsall * sigma2 / 2)
         difffac = fac - 1
         f = ct * fac
         # T (don't really need the term second order Cg2 here, but include for consistency)
-        corr[0, :] = ct * difffac * P
-        corr[0, 1:] += f[1:] * c2fac * (dm11 + c2fac * P[1:] / 4)
-        corr[0, 2:] += f[2:] * c2fac2 * d2m2 / 4
+        corr[0, :, :] = ct * difffac * P
+        corr[0, :, 1:] += f[:, 1:] * c2fac * (dm11 + c2fac * P[:, 1:] / 4)
+        corr[0, :, 2:] += f[:, 2:] * c2fac2 * d2m2 / 4
 
         sinth = np.sqrt(1 - x ** 2)
         sinfac = 4 / sinth
         fac1 = 1 - x
         fac2 = 1 + x
-        d1m2 = sinth / rootfac1 * (dP[2:] - 2 / fac1 * dm11[1:])
-        d12 = sinth / rootfac1 * (dP[2:] - 2 / fac2 * d11[1:])
-        d1m3 = (-(x + 0.5) * sinfac * d1m2[1:] / rootfac2 - rootrat * dm11[2:])
-        d2m3 = (-fac2 * d2m2[1:] * sinfac - rootfac1[1:] * d1m2[1:]) / rootfac2
+        d1m2 = sinth / rootfac1 * (dP[:, 2:] - 2 / fac1 * dm11[:, 1:])
+        d12 = sinth / rootfac1 * (dP[:, 2:] - 2 / fac2 * d11[:, 1:])
+        d1m3 = (-(x + 0.5) * sinfac * d1m2[:, 1:] / rootfac2 - rootrat * dm11[:, 2:])
+        d2m3 = (-fac2 * d2m2[:, 1:] * sinfac - rootfac1[1:] * d1m2[:, 1:]) / rootfac2
         d3m3 = (-(x + 1.5) * d2m3 * sinfac - rootfac1[1:] * d1m3) / rootfac2
-        d13 = ((x - 0.5) * sinfac * d12[1:] / rootfac2 - rootrat * d11[2:])
-        d04 = ((-lfacs[2:] + (18 * x ** 2 + 6) / sinth ** 2) * d20[2:] -
-               6 * x * lfacs2[2:] * dP[4:] / lrootfacs[2:]) / (rootfac2[1:] * rootfac3)
-        d2m4 = (-(6 * x + 4) / sinth * d2m3[1:] - rootfac2[1:] * d2m2[2:]) / rootfac3
-        d4m4 = (-7 / 5.0 * (lfacs2[2:] - 6) * d2m2[2:] +
-                12 / 5.0 * (-lfacs2[2:] + (9 * x + 26) / fac1) * d3m3[1:]) / (lfacs2[2:] - 12)
+        d13 = ((x - 0.5) * sinfac * d12[:, 1:] / rootfac2 - rootrat * d11[:, 2:])
+        d04 = ((-lfacs[2:] + (18 * x ** 2 + 6) / sinth ** 2) * d20[:, 2:] -
+               6 * x * lfacs2[2:] * dP[:, 4:] / lrootfacs[2:]) / (rootfac2[1:] * rootfac3)
+        d2m4 = (-(6 * x + 4) / sinth * d2m3[:, 1:] - rootfac2[1:] * d2m2[:, 2:]) / rootfac3
+        d4m4 = (-7 / 5.0 * (lfacs2[2:] - 6) * d2m2[:, 2:] +
+                12 / 5.0 * (-lfacs2[2:] + (9 * x + 26) / fac1) * d3m3[:, 1:]) / (lfacs2[2:] - 12)
         # + (second order Cg2 terms are needed for <1% accuracy on BB)
 
-        f = cp * fac[2:]
-        corr[1, 2:] = cp * difffac[2:] * d22 + f * c2fac2 * d22 / 4
-        corr[1, 3:] += f[1:] * c2fac[2:] * d13
-        corr[1, 4:] += f[2:] * c2fac2[2:] * d04 / 4
+        f = cp * fac[:, 2:]
+        corr[1, :, 2:] = cp * difffac[:, 2:] * d22 + f * c2fac2 * d22 / 4
+        corr[1, :, 3:] += f[:, 1:] * c2fac[:, 2:] * d13
+        corr[1, :, 4:] += f[:, 2:] * c2fac2[:, 2:] * d04 / 4
 
         # -
-        f = cm * fac[2:]
-        corr[2, 2:] = cm * difffac[2:] * d2m2 + f * c2fac[1:] * dm11[1:] / 2 + f * c2fac2 * (2 * d2m2 + P[2:]) / 8
-        corr[2, 3:] += f[1:] * c2fac[2:] * d3m3 / 2
-        corr[2, 4:] += f[2:] * c2fac2[2:] * d4m4 / 8
+        f = cm * fac[:, 2:]
+        corr[2, :, 2:] = cm * difffac[:, 2:] * d2m2 + f * c2fac[:, 1:] * dm11[:, 1:] / 2 \
+                         + f * c2fac2 * (2 * d2m2 + P[:, 2:]) / 8
+        corr[2, :, 3:] += f[:, 1:] * c2fac[:, 2:] * d3m3 / 2
+        corr[2, :, 4:] += f[:, 2:] * c2fac2[:, 2:] * d4m4 / 8
 
         # cross
-        f = cc * fac[2:]
-        corr[3, 2:] = cc * difffac[2:] * d20 + f * c2fac[1:] * d11[1:] / 2 + 3 / 8. * f * c2fac2 * d20
-        corr[3, 3:] += f[1:] * c2fac[2:] * d1m3 / 2
-        corr[3, 4:] += f[2:] * c2fac2[2:] * d2m4 / 8
-
-        weight = weights[i + imin]
-        if theta_max is not None and i < apodize_point_width * 4:
-            weight *= 1 - np.exp(-((i + 1.) / apodize_point_width) ** 2 / 2)
-
-        dcl[0, :, :] += np.outer(P, (weight * corr[0, :]))
-        T2 = np.outer(d22, (corr[1, :] * weight / 2))
-        T4 = np.outer(d2m2, (corr[2, :] * weight / 2))
-        dcl[1, 2:, :] += T2 + T4
-        dcl[2, 2:, :] += T2 - T4
-        dcl[3, 2:, :] += np.outer(d20, (weight * corr[3, :]))
-
-    # put into ell(ell+1)C_ell/2pi units [two pi cancels from correlation integral]
-    dcl[:, 1, :] *= 2
-    for i in range(dcl.shape[0]):
-        dcl[i, 2:, :] = (dcl[i, 2:, :].T * lfacs).T
-    return dcl
+        f = cc * fac[:, 2:]
+        corr[3, :, 2:] = cc * difffac[:, 2:] * d20 + f * c2fac[:, 1:] * d11[:, 1:] / 2 + 3 / 8. * f * c2fac2 * d20
+        corr[3, :, 3:] += f[:, 1:] * c2fac[:, 2:] * d1m3 / 2
+        corr[3, :, 4:] += f[:, 2:] * c2fac2[:, 2:] * d2m4 / 8
+        return corr
+
+    return _derivative_ell_blocks(lmax, block_corrs, theta_max, apodize_point_width, sampling_factor, ell_block)
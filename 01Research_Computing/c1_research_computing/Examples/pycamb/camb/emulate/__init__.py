@@ -0,0 +1,20 @@
+"""
+Fast emulation of CAMB outputs (e.g. CMB power spectra or the matter power spectrum) over a range of parameters.
+
+Training sets are calculated in parallel from Latin hypercube samples of the parameters, the outputs are
+compressed with principal components, and the principal component coefficients are fitted with a polynomial
+or small neural network. Trained emulators are saved as .npz files and evaluated with plain numpy, e.g.::
+
+    from camb import emulate
+    names = ['H0', 'ombh2', 'omch2', 'As', 'ns', 'tau']
+    ranges = [[60, 80], [0.020, 0.024], [0.10, 0.14], [1.8e-9, 2.4e-9], [0.92, 1.0], [0.04, 0.1]]
+    func = emulate.CMBSpectra(lmax=2500)
+    X, Y = emulate.generate_training_set(func, names, ranges, 1000, processes=8)
+    emulator = emulate.Emulator(names, ranges, n_components=30).fit(X, Y)
+    X_test, Y_test = emulate.generate_training_set(func, names, ranges, 100, seed=1, processes=8)
+    print(emulator.validate(X_test, Y_test)['max'])
+    emulator.save('cmb_emulator.npz')
+"""
+
+from .sampling import latin_hypercube, generate_training_set, CMBSpectra, MatterPower
+from .models import Emulator, PCA, PolynomialRegressor, MLPRegressor
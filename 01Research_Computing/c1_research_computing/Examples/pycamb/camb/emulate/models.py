@@ -0,0 +1,330 @@
+"""
+Emulator models: PCA compression of the outputs and regression of the PCA coefficients on the parameters.
+All evaluation is plain numpy matrix products, vectorized over samples.
+"""
+
+import itertools
+import time
+import numpy as np
+import six
+from ..baseconfig import CAMBError
+
+
+class PCA(object):
+    """
+    Principal component compression of a set of output vectors.
+
+    :param n_components: number of components to keep
+    """
+
+    def __init__(self, n_components=20):
+        self.n_components = n_components
+
+    def fit(self, Y):
+        """
+        Find the principal components of the (transformed) outputs.
+
+        :param Y: array of outputs, shape (nsamples, noutputs)
+        :return: coefficients of the training outputs, shape (nsamples, n_components)
+        """
+        self.mean = np.mean(Y, axis=0)
+        _, sv, vt = np.linalg.svd(Y - self.mean, full_matrices=False)
+        n = min(self.n_components, len(sv))
+        self.components = vt[:n]
+        self.explained_variance_ratio = sv[:n] ** 2 / np.sum(sv ** 2)
+        return self.transform(Y)
+
+    def transform(self, Y):
+        return np.dot(Y - self.mean, self.components.T)
+
+    def inverse_transform(self, coeffs):
+        return self.mean + np.dot(coeffs, self.components)
+
+    def get_arrays(self):
+        return {'mean': self.mean, 'components': self.components,
+                'explained_variance_ratio': self.explained_variance_ratio}
+
+    def set_arrays(self, arrays):
+        self.mean = arrays['mean']
+        self.components = arrays['components']
+        self.explained_variance_ratio = arrays['explained_variance_ratio']
+        self.n_components = self.components.shape[0]
+
+
+class PolynomialRegressor(object):
+    """
+    Polynomial chaos regression: least-squares fit of a sum of products of Legendre polynomials of
+    the parameters (scaled to [-1, 1]), with total degree up to degree.
+
+    :param degree: maximum total polynomial degree
+    :param ridge: ridge regularization of the least-squares fit (relative to the number of samples)
+    """
+    kind = 'polynomial'
+
+    def __init__(self, degree=4, ridge=0.):
+        self.degree = degree
+        self.ridge = ridge
+
+    def _set_indices(self, nparams):
+        # multi-indices of polynomial orders for each parameter with total degree <= degree
+        indices = [np.bincount(np.array(c, dtype=int), minlength=nparams)
+                   for d in range(self.degree + 1)
+                   for c in itertools.combinations_with_replacement(range(nparams), d)]
+        self.indices = np.array(indices, dtype=int).reshape(-1, nparams)
+
+    def features(self, x):
+        """
+        Polynomial basis functions.
+
+        :param x: scaled parameters, shape (nsamples, nparams)
+        :return: array of basis function values, shape (nsamples, nfeatures)
+        """
+        legendre = np.empty((x.shape[0], x.shape[1], self.degree + 1))
+        legendre[:, :, 0] = 1
+        if self.degree > 0:
+            legendre[:, :, 1] = x
+        for n in range(1, self.degree):
+            legendre[:, :, n + 1] = ((2 * n + 1) * x * legendre[:, :, n] - n * legendre[:, :, n - 1]) / (n + 1)
+        return np.prod(legendre[:, np.arange(x.shape[1]), self.indices], axis=2)
+
+    def fit(self, x, y):
+        self._set_indices(x.shape[1])
+        F = self.features(x)
+        if F.shape[1] > F.shape[0]:
+            raise CAMBError('Need at least %s training samples for polynomial degree %s' % (F.shape[1], self.degree))
+        if self.ridge:
+            F = np.vstack((F, np.sqrt(self.ridge * x.shape[0]) * np.eye(F.shape[1])))
+            y = np.vstack((y, np.zeros((F.shape[1], y.shape[1]))))
+        self.coeffs = np.linalg.lstsq(F, y, rcond=None)[0]
+        return self
+
+    def predict(self, x):
+        return np.dot(self.features(x), self.coeffs)
+
+    def get_arrays(self):
+        return {'degree': np.array(self.degree), 'indices': self.indices, 'coeffs': self.coeffs}
+
+    def set_arrays(self, arrays):
+        self.degree = int(arrays['degree'])
+        self.indices = arrays['indices']
+        self.coeffs = arrays['coeffs']
+
+
+class MLPRegressor(object):
+    """
+    Small fully-connected neural network with tanh activations, trained by full-batch Adam optimization
+    of the mean squared error.
+
+    :param hidden: tuple of numbers of units in each hidden layer
+    :param iterations: number of training iterations
+    :param learning_rate: Adam learning rate
+    :param seed: random seed for the initial weights
+    """
+    kind = 'mlp'
+
+    def __init__(self, hidden=(64, 64), iterations=5000, learning_rate=1e-3, seed=None):
+        self.hidden = tuple(hidden)
+        self.iterations = iterations
+        self.learning_rate = learning_rate
+        self.seed = seed
+
+    def _forward(self, x):
+        activations = [x]
+        for W, b in zip(self.weights[:-1], self.biases[:-1]):
+            activations.append(np.tanh(np.dot(activations[-1], W) + b))
+        return activations, np.dot(activations[-1], self.weights[-1]) + self.biases[-1]
+
+    def fit(self, x, y):
+        rand = np.random.RandomState(self.seed)
+        sizes = (x.shape[1],) + self.hidden + (y.shape[1],)
+        self.weights = [rand.normal(scale=np.sqrt(1. / n_in), size=(n_in, n_out))
+                        for n_in, n_out in zip(sizes[:-1], sizes[1:])]
+        self.biases = [np.zeros(n_out) for n_out in sizes[1:]]
+        weights = self.weights + self.biases
+        m = [np.zeros_like(w) for w in weights]
+        v = [np.zeros_like(w) for w in weights]
+        beta1, beta2, eps = 0.9, 0.999, 1e-8
+        for it in range(1, self.iterations + 1):
+            activations, out = self._forward(x)
+            delta = 2 * (out - y) / y.size
+            grad_w = []
+            grad_b = []
+            for i in range(len(self.weights) - 1, -1, -1):
+                grad_w.insert(0, np.dot(activations[i].T, delta))
+                grad_b.insert(0, np.sum(delta, axis=0))
+                if i:
+                    delta = np.dot(delta, self.weights[i].T) * (1 - activations[i] ** 2)
+            step = self.learning_rate * np.sqrt(1 - beta2 ** it) / (1 - beta1 ** it)
+            for w, g, mi, vi in zip(weights, grad_w + grad_b, m, v):
+                mi *= beta1
+                mi += (1 - beta1) * g
+                vi *= beta2
+                vi += (1 - beta2) * g ** 2
+                w -= step * mi / (np.sqrt(vi) + eps)
+        return self
+
+    def predict(self, x):
+        return self._forward(x)[1]
+
+    def get_arrays(self):
+        arrays = {'hidden': np.array(self.hidden, dtype=int)}
+        for i, (W, b) in enumerate(zip(self.weights, self.biases)):
+            arrays['W%s' % i] = W
+            arrays['b%s' % i] = b
+        return arrays
+
+    def set_arrays(self, arrays):
+        self.hidden = tuple(int(n) for n in arrays['hidden'])
+        nlayers = len(self.hidden) + 1
+        self.weights = [arrays['W%s' % i] for i in range(nlayers)]
+        self.biases = [arrays['b%s' % i] for i in range(nlayers)]
+
+
+_regressors = dict((cls.kind, cls) for cls in [PolynomialRegressor, MLPRegressor])
+
+
+class Emulator(object):
+    """
+    Emulator for a vector of outputs (e.g. CMB power spectra) as a function of a set of parameters.
+
+    Outputs are optionally transformed to log (for outputs that are positive in all training samples),
+    standardized, and compressed with :class:`PCA`. The PCA coefficients are then fitted as a function
+    of the parameters by a :class:`PolynomialRegressor` or :class:`MLPRegressor`.
+
+    e.g.::
+
+        func = CMBSpectra(lmax=2500)
+        X, Y = generate_training_set(func, names, ranges, 500)
+        emulator = Emulator(names, ranges).fit(X, Y)
+        emulator.save('cmb_emulator.npz')
+        cls = emulator.predict(params_array)
+
+    :param param_names: list of names of the parameters
+    :param ranges: array of [min, max] for each parameter
+    :param n_components: number of PCA components
+    :param regressor: 'polynomial', 'mlp', or a regressor instance
+    :param log_outputs: if True, emulate the log of outputs that are always positive in the training set
+    :param regressor_args: arguments for the regressor class
+    """
+
+    def __init__(self, param_names, ranges, n_components=20, regressor='polynomial', log_outputs=True,
+                 **regressor_args):
+        self.param_names = list(param_names)
+        self.ranges = np.atleast_2d(np.asarray(ranges, dtype=np.float64))
+        if self.ranges.shape != (len(self.param_names), 2):
+            raise CAMBError('ranges must be [min, max] for each parameter')
+        self.pca = PCA(n_components)
+        if isinstance(regressor, six.string_types):
+            if regressor not in _regressors:
+                raise CAMBError('Unknown regressor %s' % regressor)
+            regressor = _regressors[regressor](**regressor_args)
+        self.regressor = regressor
+        self.log_outputs = log_outputs
+
+    def _scale_params(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.shape[1] != len(self.param_names):
+            raise CAMBError('Expected values for %s parameters' % len(self.param_names))
+        return 2 * (X - self.ranges[:, 0]) / (self.ranges[:, 1] - self.ranges[:, 0]) - 1
+
+    def _transform_outputs(self, Y):
+        Y = np.array(Y, dtype=np.float64)
+        Y[:, self.log_mask] = np.log(Y[:, self.log_mask])
+        return (Y - self.output_mean) / self.output_scale
+
+    def fit(self, X, Y):
+        """
+        Train the emulator.
+
+        :param X: array of parameter values, shape (nsamples, nparams)
+        :param Y: array of outputs, shape (nsamples, noutputs)
+        :return: self
+        """
+        Y = np.asarray(Y, dtype=np.float64)
+        self.log_mask = np.all(Y > 0, axis=0) if self.log_outputs else np.zeros(Y.shape[1], dtype=bool)
+        Y = np.array(Y)
+        Y[:, self.log_mask] = np.log(Y[:, self.log_mask])
+        self.output_mean = np.mean(Y, axis=0)
+        self.output_scale = np.std(Y, axis=0)
+        self.output_scale[self.output_scale == 0] = 1
+        coeffs = self.pca.fit((Y - self.output_mean) / self.output_scale)
+        self.coeff_scale = np.std(coeffs, axis=0)
+        self.coeff_scale[self.coeff_scale == 0] = 1
+        self.regressor.fit(self._scale_params(X), coeffs / self.coeff_scale)
+        return self
+
+    def predict(self, X):
+        """
+        Predict outputs for one or more sets of parameters.
+
+        :param X: array of parameter values, shape (nparams,) or (nsamples, nparams)
+        :return: array of outputs, shape (noutputs,) or (nsamples, noutputs)
+        """
+        single = np.ndim(X) == 1
+        coeffs = self.regressor.predict(self._scale_params(X)) * self.coeff_scale
+        Y = self.pca.inverse_transform(coeffs) * self.output_scale + self.output_mean
+        Y[:, self.log_mask] = np.exp(Y[:, self.log_mask])
+        return Y[0] if single else Y
+
+    def validate(self, X, Y):
+        """
+        Compare emulator predictions with directly calculated outputs, e.g. for a test set from
+        :func:`.sampling.generate_training_set` not used for training.
+
+        Errors are relative to the root-mean-square of each output over the test samples (so for positive
+        outputs that do not vary much they are approximately fractional errors).
+
+        :param X: array of parameter values, shape (nsamples, nparams)
+        :param Y: array of directly calculated outputs, shape (nsamples, noutputs)
+        :return: dictionary of results: 'max_error' and 'rms_error' for each output, 'max' and 'rms' over all
+            outputs, 'pca_error' (max error from the PCA compression alone), and 'time_per_sample' in seconds
+        """
+        Y = np.asarray(Y, dtype=np.float64)
+        start = time.time()
+        predicted = self.predict(X)
+        time_per_sample = (time.time() - start) / Y.shape[0]
+        norm = np.sqrt(np.mean(Y ** 2, axis=0))
+        norm[norm == 0] = 1
+        errors = np.abs(predicted - Y) / norm
+        compressed = self.pca.inverse_transform(self.pca.transform(self._transform_outputs(Y)))
+        compressed = compressed * self.output_scale + self.output_mean
+        compressed[:, self.log_mask] = np.exp(compressed[:, self.log_mask])
+        return {'max_error': np.max(errors, axis=0), 'rms_error': np.sqrt(np.mean(errors ** 2, axis=0)),
+                'max': np.max(errors), 'rms': np.sqrt(np.mean(errors ** 2)),
+                'pca_error': np.max(np.abs(compressed - Y) / norm), 'time_per_sample': time_per_sample}
+
+    def save(self, filename):
+        """
+        Save the trained emulator to a numpy .npz file.
+
+        :param filename: file name
+        """
+        arrays = {'param_names': np.array(self.param_names), 'ranges': self.ranges,
+                  'regressor': np.array(self.regressor.kind), 'log_mask': self.log_mask,
+                  'output_mean': self.output_mean, 'output_scale': self.output_scale,
+                  'coeff_scale': self.coeff_scale}
+        for prefix, obj in [('pca_', self.pca), ('regressor_', self.regressor)]:
+            for key, value in obj.get_arrays().items():
+                arrays[prefix + key] = value
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load an emulator saved with :meth:`save`.
+
+        :param filename: file name
+        :return: :class:`Emulator` instance
+        """
+        with np.load(filename, allow_pickle=False) as data:
+            arrays = dict((key, data[key]) for key in data.files)
+        emulator = cls([str(name) for name in arrays['param_names']], arrays['ranges'],
+                       regressor=str(arrays['regressor']))
+        for key in ['log_mask', 'output_mean', 'output_scale', 'coeff_scale']:
+            setattr(emulator, key, arrays[key])
+        for prefix, obj in [('pca_', emulator.pca), ('regressor_', emulator.regressor)]:
+            obj.set_arrays(dict((key[len(prefix):], value) for key, value in arrays.items()
+                                if key.startswith(prefix)))
+        return emulator
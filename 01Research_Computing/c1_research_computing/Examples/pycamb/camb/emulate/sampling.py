@@ -0,0 +1,132 @@
+"""
+Sampling of parameter space and generation of emulator training sets from CAMB calculations.
+"""
+
+import numpy as np
+from .. import grid
+from ..baseconfig import CAMBError
+
+def latin_hypercube(nsamples, ranges, seed=None):
+    """
+    Latin hypercube sample of parameters: each parameter range is divided into nsamples equal intervals,
+    and each interval is sampled exactly once, with random pairing of the intervals for different parameters.
+
+    :param nsamples: number of samples
+    :param ranges: array of [min, max] for each parameter, shape (nparams, 2)
+    :param seed: optional random seed, or numpy RandomState instance
+    :return: array of parameter values, shape (nsamples, nparams)
+    """
+    ranges = np.atleast_2d(np.asarray(ranges, dtype=np.float64))
+    rand = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+    nparams = ranges.shape[0]
+    u = (np.array([rand.permutation(nsamples) for _ in range(nparams)]).T +
+         rand.uniform(size=(nsamples, nparams))) / nsamples
+    return ranges[:, 0] + u * (ranges[:, 1] - ranges[:, 0])
+
+
+class CMBSpectra(object):
+    """
+    Picklable function returning CMB power spectra (:meth:`.camb.CAMBdata.get_cmb_power_spectra`) for a dictionary
+    of parameter values, as a single vector of the requested spectra for L=2..lmax, concatenated in order.
+    Parameters are set using :func:`.camb.set_params`, with fixed_params for any values not being varied.
+
+    :param lmax: maximum L of the output
+    :param spectra: names of spectra to output, from TT, EE, BB, TE
+    :param spectrum: which set of spectra to use (e.g. 'total', 'unlensed_scalar')
+    :param fixed_params: other parameter values for :func:`.camb.set_params`
+    """
+
+    def __init__(self, lmax=2500, spectra=('TT', 'EE', 'TE'), spectrum='total', **fixed_params):
+        grid.check_cmb_spectra(spectra)
+        self.lmax = lmax
+        self.spectra = tuple(spectra)
+        self.spectrum = spectrum
+        self.fixed_params = fixed_params
+
+    @property
+    def ls(self):
+        """
+        L values of each output (repeated for each spectrum)
+        """
+        return np.tile(np.arange(2, self.lmax + 1), len(self.spectra))
+
+    def __call__(self, values):
+        from .. import camb
+        pars = dict(self.fixed_params)
+        pars.update(values)
+        results = camb.get_results(grid.output_params(pars, self.lmax))
+        try:
+            return grid.output_spectra(results, self.lmax, self.spectra, self.spectrum)['cls'].ravel()
+        finally:
+            results.free()
+
+
+class MatterPower(object):
+    """
+    Picklable function returning the matter power spectrum (:meth:`.camb.CAMBdata.get_matter_power_spectrum`)
+    for a dictionary of parameter values, as a vector of P(k/h) at npoints log-spaced values of k/h
+    for each redshift (highest redshift first).
+
+    :param redshifts: list of redshifts
+    :param minkh: minimum k/h
+    :param maxkh: maximum k/h
+    :param npoints: number of k/h points
+    :param nonlinear: if True output the non-linear spectrum
+    :param fixed_params: other parameter values for :func:`.camb.set_params`
+    """
+
+    def __init__(self, redshifts=(0.,), minkh=1e-4, maxkh=1., npoints=200, nonlinear=False, **fixed_params):
+        self.redshifts = list(redshifts)
+        self.minkh = minkh
+        self.maxkh = maxkh
+        self.npoints = npoints
+        self.nonlinear = nonlinear
+        self.fixed_params = fixed_params
+
+    @property
+    def kh(self):
+        """
+        k/h values of the output for each redshift
+        """
+        return np.exp(np.linspace(np.log(self.minkh), np.log(self.maxkh), self.npoints))
+
+    def __call__(self, values):
+        from .. import camb
+        pars = dict(self.fixed_params)
+        pars.update(values)
+        results = camb.get_results(grid.output_params(pars, redshifts=self.redshifts, maxkh=self.maxkh,
+                                                      nonlinear=self.nonlinear))
+        try:
+            return grid.output_spectra(results, matter_power=True, minkh=self.minkh, maxkh=self.maxkh,
+                                       npoints=self.npoints)['pk'].ravel()
+        finally:
+            results.free()
+
+
+def generate_training_set(func, param_names, ranges, nsamples, seed=None, samples=None, **kwargs):
+    """
+    Calculate outputs for a Latin hypercube sample of parameters in parallel, using :func:`.grid.run_grid`.
+    Samples for which the calculation fails are dropped.
+
+    :param func: picklable function of a dictionary of parameter values returning a vector,
+        e.g. a :class:`CMBSpectra` or :class:`MatterPower` instance
+    :param param_names: list of names of the parameters being varied
+    :param ranges: array of [min, max] for each parameter
+    :param nsamples: number of samples
+    :param seed: random seed for the sample
+    :param samples: optional array of parameter values to use instead of a new Latin hypercube sample
+    :param kwargs: other arguments for :func:`.grid.run_grid`, e.g. processes
+    :return: X, Y: parameter values (nsamples, nparams) and outputs (nsamples, noutputs)
+    """
+    if samples is None:
+        samples = latin_hypercube(nsamples, ranges, seed)
+    samples = np.atleast_2d(samples)
+    params_list = (dict(zip(param_names, (float(v) for v in values))) for values in samples)
+    outputs = [None] * len(samples)
+    for res in grid.run_grid(params_list, func, ordered=False, **kwargs):
+        if res.error is None:
+            outputs[res.index] = np.asarray(res.result)
+    good = [i for i, out in enumerate(outputs) if out is not None]
+    if not good:
+        raise CAMBError('All training set calculations failed')
+    return samples[good], np.array([outputs[i] for i in good])
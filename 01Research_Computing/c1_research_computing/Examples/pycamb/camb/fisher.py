@@ -0,0 +1,219 @@
+"""
+Fisher matrices from finite-difference derivatives of CAMB CMB power spectra and matter power spectra
+with respect to the arguments of :func:`.camb.set_params`. e.g.::
+
+    fisher = Fisher({'H0': 67.5, 'ombh2': 0.022, 'omch2': 0.122, 'tau': 0.055, 'As': 2.1e-9, 'ns': 0.965},
+                    steps={'H0': 0.3, 'ombh2': 1e-4}, lmax=2000, processes=8)
+    F = fisher.fisher_matrix(['H0', 'ombh2', 'omch2', 'As', 'ns'], cov)
+
+All the perturbed models needed are calculated in parallel worker processes using :func:`.grid.run_grid`.
+Primordial power spectrum parameters (As, ns, r, ...) only need one transfer function calculation for all their
+steps, with spectra from :meth:`.camb.CAMBdata.power_spectra_from_transfer`. Results for each model are cached,
+so adding a parameter later only calculates the models for its own steps.
+"""
+
+import numpy as np
+from collections import OrderedDict
+from . import grid
+from .baseconfig import CAMBError
+
+primordial_params = ('As', 'ns', 'nrun', 'nrunrun', 'r', 'nt', 'ntrun', 'pivot_scalar', 'pivot_tensor')
+
+# finite difference stencils: (offsets in units of the step, weights)
+stencils = {3: ([-1, 1], [-1. / 2, 1. / 2]),
+            5: ([-2, -1, 1, 2], [1. / 12, -2. / 3, 2. / 3, -1. / 12])}
+
+class FisherOutputs(object):
+    """
+    Picklable function calculating the outputs used by :class:`Fisher` for one set of non-primordial parameter
+    values and any number of sets of primordial power parameters, re-using the transfer functions.
+
+    :param lmax: maximum L of the CMB spectra
+    :param spectra: names of CMB spectra, from TT, EE, BB, TE (empty for no CMB output)
+    :param spectrum: which set of CMB spectra to use (e.g. 'total', 'unlensed_scalar')
+    :param redshifts: redshifts for the matter power spectrum (None for no matter power output)
+    :param minkh: minimum k/h of the matter power spectrum
+    :param maxkh: maximum k/h of the matter power spectrum
+    :param npoints: number of log-spaced k/h points
+    :param nonlinear: if True output the non-linear matter power spectrum
+    """
+
+    def __init__(self, lmax=2500, spectra=('TT', 'EE', 'TE'), spectrum='total', redshifts=None, minkh=1e-4,
+                 maxkh=1., npoints=200, nonlinear=False):
+        grid.check_cmb_spectra(spectra)
+        if not spectra and redshifts is None:
+            raise CAMBError('No CMB spectra or matter power redshifts')
+        self.lmax = lmax
+        self.spectra = tuple(spectra)
+        self.spectrum = spectrum
+        self.redshifts = None if redshifts is None else list(redshifts)
+        self.minkh = minkh
+        self.maxkh = maxkh
+        self.npoints = npoints
+        self.nonlinear = nonlinear
+
+    def __call__(self, job):
+        """
+        :param job: tuple of (dictionary of parameter values for :func:`.camb.set_params`, list of dictionaries
+            of primordial parameter values to update them with)
+        :return: list of output dictionaries for each set of primordial parameters, with arrays 'cls'
+            CL[spectrum_index, L-2] and/or 'pk' PK[z_index, k_index]
+        """
+        from . import camb, initialpower
+        values, power_sets = job
+        cp = grid.output_params(values, self.lmax if self.spectra else None, self.redshifts, self.maxkh,
+                                self.nonlinear)
+        powers = []
+        for power in power_sets:
+            power_pars = dict((name, value) for name, value in values.items() if name in primordial_params)
+            power_pars.update(power)
+            powers.append(initialpower.InitialPowerParams().set_params(**power_pars))
+        cp.WantTensors = cp.WantTensors or any(power.has_tensors() for power in powers)
+        results = camb.get_transfer_functions(cp)
+        try:
+            outputs = []
+            for power in powers:
+                results.power_spectra_from_transfer(power)
+                outputs.append(grid.output_spectra(results, self.lmax, self.spectra, self.spectrum,
+                                                   self.redshifts is not None, self.minkh, self.maxkh,
+                                                   self.npoints, have_power_spectra=True))
+        finally:
+            results.free()
+        return outputs
+
+
+class Fisher(object):
+    """
+    Finite-difference derivatives and Fisher matrices of CMB and matter power spectra around fiducial parameters.
+
+    :param fiducial: dictionary of fiducial parameter values for :func:`.camb.set_params`
+        (including any fixed parameters that are not varied)
+    :param steps: dictionary of step sizes for the varied parameters; parameters not included use
+        rel_step times the fiducial value
+    :param rel_step: default relative step size
+    :param stencil: number of points in the central difference stencil, 3 (+-h) or 5 (+-h, +-2h)
+    :param processes: number of worker processes (default: number of CPUs)
+    :param grid_args: dictionary of other arguments for :func:`.grid.run_grid`, e.g. initializer
+    :param output_args: arguments for :class:`FisherOutputs`, e.g. lmax, spectra, redshifts
+    """
+
+    def __init__(self, fiducial, steps=None, rel_step=0.01, stencil=3, processes=None, grid_args=None,
+                 **output_args):
+        if stencil not in stencils:
+            raise CAMBError('stencil must be one of %s' % list(stencils))
+        self.fiducial = dict(fiducial)
+        self.steps = dict(steps or {})
+        self.rel_step = rel_step
+        self.stencil = stencil
+        self.processes = processes
+        self.grid_args = dict(grid_args or {})
+        self.outputs = FisherOutputs(**output_args)
+        self._cache = {}
+
+    def step(self, name):
+        """
+        Step size for parameter name.
+
+        :param name: parameter name
+        :return: step size
+        """
+        if name in self.steps:
+            return self.steps[name]
+        if name not in self.fiducial:
+            raise CAMBError('Parameter %s has no fiducial value' % name)
+        if not self.fiducial[name]:
+            raise CAMBError('Parameter %s has zero fiducial value, so needs an explicit step' % name)
+        return self.rel_step * abs(self.fiducial[name])
+
+    def _point(self, name=None, offset=0):
+        values = dict(self.fiducial)
+        if name is not None:
+            values[name] = values.get(name, 0) + offset * self.step(name)
+        return values
+
+    @staticmethod
+    def _key(values):
+        return tuple(sorted(values.items()))
+
+    def _calculate(self, points):
+        # calculate outputs for the points not already cached, grouping primordial steps into one job
+        jobs = OrderedDict()
+        for values in points:
+            key = self._key(values)
+            if key in self._cache:
+                continue
+            slow = dict((name, value) for name, value in values.items() if name not in primordial_params)
+            fiducial_power = dict((name, value) for name, value in self.fiducial.items() if name in primordial_params)
+            slow.update(fiducial_power)
+            power = dict((name, value) for name, value in values.items() if name in primordial_params)
+            job = jobs.setdefault(self._key(slow), (slow, [], []))
+            if key not in job[2]:
+                job[1].append(power)
+                job[2].append(key)
+        if not jobs:
+            return
+        job_list = list(jobs.values())
+        results = grid.map_grid([job[:2] for job in job_list], self.outputs, processes=self.processes,
+                                **self.grid_args)
+        for job, outputs in zip(job_list, results):
+            for key, output in zip(job[2], outputs):
+                self._cache[key] = dict((name, np.array(value)) for name, value in output.items())
+
+    def fiducial_outputs(self):
+        """
+        Outputs for the fiducial parameters.
+
+        :return: dictionary with arrays 'cls' CL[spectrum_index, L-2] and/or 'pk' PK[z_index, k_index]
+        """
+        values = self._point()
+        self._calculate([values])
+        return self._cache[self._key(values)]
+
+    def derivatives(self, params):
+        """
+        Finite-difference derivatives of the outputs, calculating any models not already cached.
+
+        :param params: list of parameter names
+        :return: ordered dictionary of derivative output dictionaries (as :meth:`fiducial_outputs`) for each name
+        """
+        offsets, weights = stencils[self.stencil]
+        points = dict((name, [self._point(name, offset) for offset in offsets]) for name in params)
+        self._calculate([values for name in params for values in points[name]])
+        derivs = OrderedDict()
+        for name in params:
+            outputs = [self._cache[self._key(values)] for values in points[name]]
+            derivs[name] = dict((output, sum(weight * out[output] for weight, out in zip(weights, outputs)) /
+                                 self.step(name)) for output in outputs[0])
+        return derivs
+
+    def data_vector(self, outputs, names=('cls', 'pk')):
+        """
+        Flatten outputs into a single vector, as used for covariances in :meth:`fisher_matrix`:
+        cls for L=2..lmax for each spectrum in turn, followed by pk for each redshift in turn.
+
+        :param outputs: output dictionary, e.g. from :meth:`fiducial_outputs` or :meth:`derivatives`
+        :param names: which outputs to include
+        :return: vector of values
+        """
+        return np.concatenate([np.ravel(outputs[name]) for name in names if name in outputs])
+
+    def fisher_matrix(self, params, cov, names=('cls', 'pk')):
+        """
+        Fisher matrix F_ij = dD/dp_i C^{-1} dD/dp_j for the data vector D (see :meth:`data_vector`).
+
+        :param params: list of parameter names
+        :param cov: covariance matrix of the data vector, or a vector of variances if diagonal
+        :param names: which outputs to include in the data vector
+        :return: Fisher matrix, ordered as params
+        """
+        derivs = self.derivatives(params)
+        D = np.array([self.data_vector(derivs[name], names) for name in params])
+        cov = np.asarray(cov, dtype=np.float64)
+        if cov.shape[0] != D.shape[1]:
+            raise CAMBError('Covariance size %s does not match data vector size %s' % (cov.shape[0], D.shape[1]))
+        if cov.ndim == 1:
+            inv_cov_D = D / cov
+        else:
+            inv_cov_D = np.linalg.solve(cov, D.T).T
+        F = np.dot(D, inv_cov_D.T)
+        return (F + F.T) / 2
@@ -0,0 +1,303 @@
+"""
+Run CAMB for many sets of parameters using a pool of worker processes.
+
+CAMB's Fortran state is global, so calculations cannot run in parallel threads, but each worker process has its own
+copy of the library. A function of the parameters is called in the workers for each set of parameters, and the
+results are streamed back (in order, or as they complete). Large numpy arrays in the results are passed back as
+memory-mapped .npy files rather than copied through the pipe.
+
+e.g.::
+
+    from camb import grid
+    for res in grid.run_grid(params_list, grid.cmb_power_spectra, processes=8):
+        if res.error:
+            print('parameters %s failed: %s' % (res.index, res.error))
+        else:
+            cls = res.result['total']
+
+The function must be picklable (defined at module level), and global settings that are not stored in CAMBparams
+(e.g. accuracy settings) must be set by an initializer function in each worker.
+"""
+
+import functools
+import numpy as np
+import os
+import shutil
+import tempfile
+import traceback
+from collections import namedtuple
+from multiprocessing import Pool, cpu_count
+import six
+from six.moves import queue
+from .baseconfig import CAMBError
+
+GridResult = namedtuple('GridResult', ['index', 'result', 'error'])
+GridResult.__doc__ = """
+Result of a calculation for one set of parameters.
+
+:ivar index: index of the parameters in the input list or iterator
+:ivar result: return value of the function (None if there was an error)
+:ivar error: None, or string with the exception and traceback if the calculation failed
+"""
+
+
+cmb_spectra_index = {'TT': 0, 'EE': 1, 'BB': 2, 'TE': 3}
+
+
+def check_cmb_spectra(spectra):
+    """
+    Check names of CMB spectra, as used by :func:`output_spectra`.
+
+    :param spectra: list of names of CMB spectra, from TT, EE, BB, TE
+    """
+    for name in spectra:
+        if name not in cmb_spectra_index:
+            raise CAMBError('Unknown CMB spectrum %s' % name)
+
+
+def output_params(values, lmax=None, redshifts=None, maxkh=1., nonlinear=False):
+    """
+    Get parameters for calculating the outputs of :func:`output_spectra`.
+
+    :param values: dictionary of parameter values for :func:`.camb.set_params`
+    :param lmax: maximum L of the CMB spectra, if not set in values (None for no CMB output)
+    :param redshifts: redshifts for the matter power spectrum (None for no matter power output)
+    :param maxkh: maximum k/h of the matter power spectrum
+    :param nonlinear: if True calculate the non-linear matter power spectrum
+    :return: :class:`.model.CAMBparams` instance
+    """
+    from . import camb, model
+
+    pars = dict(values)
+    if lmax is not None:
+        pars.setdefault('lmax', lmax)
+    cp = camb.set_params(**pars)
+    if redshifts is not None:
+        cp.set_matter_power(redshifts=list(redshifts), kmax=maxkh, silent=True)
+        cp.NonLinear = model.NonLinear_both if nonlinear else model.NonLinear_none
+    return cp
+
+
+def output_spectra(results, lmax=2500, spectra=(), spectrum='total', matter_power=False, minkh=1e-4, maxkh=1.,
+                   npoints=200, have_power_spectra=False):
+    """
+    Get CMB and/or matter power spectra as arrays, e.g. for emulators and Fisher matrices.
+
+    :param results: :class:`.camb.CAMBdata` instance, calculated with parameters from :func:`output_params`
+    :param lmax: maximum L of the CMB spectra
+    :param spectra: names of CMB spectra, from TT, EE, BB, TE (empty for no CMB output)
+    :param spectrum: which set of CMB spectra to use (e.g. 'total', 'unlensed_scalar')
+    :param matter_power: if True also get the matter power spectrum
+    :param minkh: minimum k/h of the matter power spectrum
+    :param maxkh: maximum k/h of the matter power spectrum
+    :param npoints: number of log-spaced k/h points
+    :param have_power_spectra: set to True if already computed power spectra
+        (e.g. using :meth:`.camb.CAMBdata.power_spectra_from_transfer`)
+    :return: dictionary with arrays 'cls' CL[spectrum_index, L-2] and/or 'pk' PK[z_index, k_index]
+    """
+    output = {}
+    if spectra:
+        cls = results.get_cmb_power_spectra(lmax=lmax, spectra=[spectrum])[spectrum]
+        output['cls'] = np.array([cls[2:, cmb_spectra_index[name]] for name in spectra])
+    if matter_power:
+        output['pk'] = results.get_matter_power_spectrum(minkh, maxkh, npoints,
+                                                         have_power_spectra=have_power_spectra)[2]
+    return output
+
+
+def cmb_power_spectra(params):
+    """
+    Default function for :func:`run_grid`: calculate results and get CMB power spectra.
+
+    :param params: :class:`.model.CAMBparams` instance
+    :return: dictionary of CMB power spectra, as :meth:`.camb.CAMBdata.get_cmb_power_spectra`
+    """
+    from . import camb
+
+    results = camb.get_results(params)
+    try:
+        return results.get_cmb_power_spectra()
+    finally:
+        results.free()
+
+
+class _MappedArray(object):
+    # placeholder for an array saved to a file by a worker
+
+    def __init__(self, filename):
+        self.filename = filename
+
+
+_worker_settings = {}
+
+
+def _set_omp_threads(omp_threads):
+    from .baseconfig import camblib
+    if getattr(camblib, '_lib', None) is not None:
+        from . import ThreadNum
+        ThreadNum.value = omp_threads
+    else:
+        # don't load the library for functions that may not use it; OpenMP reads this when it is loaded
+        os.environ['OMP_NUM_THREADS'] = str(omp_threads)
+
+
+def _init_worker(omp_threads, mmap_dir, mmap_min_bytes, initializer, initargs):
+    # errors are returned as the result of each job, as the pool would re-start failed workers indefinitely
+    _worker_settings.update(mmap_dir=mmap_dir, mmap_min_bytes=mmap_min_bytes, count=0, init_error=None)
+    try:
+        if omp_threads:
+            _set_omp_threads(omp_threads)
+        if initializer is not None:
+            initializer(*initargs)
+    except Exception:
+        _worker_settings['init_error'] = 'Worker initialization failed: ' + traceback.format_exc()
+
+
+def _to_shared(obj):
+    if isinstance(obj, np.ndarray) and obj.dtype != object and obj.nbytes >= _worker_settings['mmap_min_bytes']:
+        _worker_settings['count'] += 1
+        filename = os.path.join(_worker_settings['mmap_dir'],
+                                'camb_grid_%s_%s.npy' % (os.getpid(), _worker_settings['count']))
+        np.save(filename, obj)
+        return _MappedArray(filename)
+    elif isinstance(obj, dict):
+        return dict((key, _to_shared(value)) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return type(obj)(_to_shared(value) for value in obj)
+    return obj
+
+
+def _from_shared(obj, keep_files):
+    if isinstance(obj, _MappedArray):
+        arr = np.load(obj.filename, mmap_mode='r')
+        if not keep_files and os.name == 'posix':
+            # the mapping remains valid after the file is removed
+            os.remove(obj.filename)
+        return arr
+    elif isinstance(obj, dict):
+        return dict((key, _from_shared(value, keep_files)) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return type(obj)(_from_shared(value, keep_files) for value in obj)
+    return obj
+
+
+def _run_chunk(func, chunk_index, jobs):
+    if _worker_settings['init_error']:
+        return chunk_index, [GridResult(index, None, _worker_settings['init_error']) for index, _ in jobs]
+    results = []
+    for index, params in jobs:
+        try:
+            results.append(GridResult(index, _to_shared(func(params)), None))
+        except Exception:
+            results.append(GridResult(index, None, traceback.format_exc()))
+    return chunk_index, results
+
+
+def _chunk_failed(done, chunk_index, jobs, e):
+    # error outside func, e.g. failure to pickle the results, so no results for any job in the chunk
+    done.put((chunk_index, [GridResult(index, None, repr(e)) for index, _ in jobs]))
+
+
+def run_grid(params_list, func=cmb_power_spectra, processes=None, chunksize=1, ordered=True,
+             max_runs_per_worker=None, max_pending=None, omp_threads=1, mmap_dir=None, mmap_min_bytes=2 ** 16,
+             initializer=None, initargs=()):
+    """
+    Generator calculating func(params) for each set of parameters using a pool of worker processes,
+    yielding :class:`GridResult` tuples.
+
+    Jobs are submitted in chunks of chunksize sets of parameters, with at most max_pending chunks submitted at
+    once, so params_list can be a long (or infinite) iterator. Errors in func are caught and returned in the
+    error field of the result, without stopping the other calculations. Errors passing parameters or results
+    between processes (e.g. unpicklable results) are also returned as errors, for all jobs in the chunk
+    (in Python 3).
+
+    :param params_list: list or iterator of :class:`.model.CAMBparams` instances (or anything func accepts;
+        must be picklable)
+    :param func: picklable function of the parameters to call in the workers, by default
+        :func:`cmb_power_spectra`
+    :param processes: number of worker processes (default: number of CPUs)
+    :param chunksize: number of sets of parameters sent to a worker at once
+    :param ordered: if True yield results in the order of params_list, otherwise as they complete
+    :param max_runs_per_worker: if set, replace worker processes after this many calculations
+        (rounded to a whole number of chunks), e.g. to bound memory use
+    :param max_pending: maximum number of chunks submitted but not returned (default 2*processes)
+    :param omp_threads: number of OpenMP threads to use in each worker (0 to use CAMB's default)
+    :param mmap_dir: directory for memory-mapped result arrays; if set, files are not deleted after use.
+        If None, a temporary directory is used and removed after the run.
+    :param mmap_min_bytes: numpy arrays in results larger than this are returned as read-only memory-mapped
+        arrays rather than pickled
+    :param initializer: optional function to call in each worker when started, e.g. to set accuracy settings.
+        If it raises an exception, all jobs run by that worker return the error
+    :param initargs: arguments for initializer
+    :return: generator of :class:`GridResult`
+    """
+    if not processes:
+        processes = cpu_count()
+    max_pending = max_pending or 2 * processes
+    keep_files = mmap_dir is not None
+    if not keep_files:
+        mmap_dir = tempfile.mkdtemp(prefix='camb_grid_')
+    maxtasksperchild = max(1, max_runs_per_worker // chunksize) if max_runs_per_worker else None
+    pool = Pool(processes, _init_worker, (omp_threads, mmap_dir, mmap_min_bytes, initializer, initargs),
+                maxtasksperchild=maxtasksperchild)
+    done = queue.Queue()
+    jobs = enumerate(params_list)
+    try:
+        submitted = 0
+        returned = 0
+        finished = {}
+        exhausted = False
+        while True:
+            while not exhausted and submitted - returned < max_pending:
+                chunk = []
+                for job in jobs:
+                    chunk.append(job)
+                    if len(chunk) == chunksize:
+                        break
+                if len(chunk) < chunksize:
+                    exhausted = True
+                if chunk:
+                    if six.PY3:
+                        # e.g. failure to pickle the results
+                        pool.apply_async(_run_chunk, (func, submitted, chunk), callback=done.put,
+                                         error_callback=functools.partial(_chunk_failed, done, submitted, chunk))
+                    else:
+                        pool.apply_async(_run_chunk, (func, submitted, chunk), callback=done.put)
+                    submitted += 1
+            if returned == submitted:
+                break
+            chunk_index, results = done.get()
+            if ordered:
+                finished[chunk_index] = results
+                results = []
+                while returned in finished:
+                    results += finished.pop(returned)
+                    returned += 1
+            else:
+                returned += 1
+            for result in results:
+                yield result._replace(result=_from_shared(result.result, keep_files))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if not keep_files:
+            shutil.rmtree(mmap_dir, ignore_errors=True)
+
+
+def map_grid(params_list, func=cmb_power_spectra, raise_errors=True, **kwargs):
+    """
+    Calculate func(params) for each set of parameters using a pool of worker processes, see :func:`run_grid`.
+
+    :param params_list: list or iterator of :class:`.model.CAMBparams` instances
+    :param func: picklable function of the parameters
+    :param raise_errors: if True, raise an exception if any calculation fails, otherwise failed results are None
+    :param kwargs: other arguments for :func:`run_grid`
+    :return: list of results in the order of params_list
+    """
+    results = []
+    for res in run_grid(params_list, func, ordered=True, **kwargs):
+        if res.error and raise_errors:
+            raise CAMBError('Calculation %s failed: %s' % (res.index, res.error))
+        results.append(res.result)
+    return results
@@ -84,3 +84,140 @@ class InitialPowerParams(CAMB_Structure):
         :return: True of non-zero tensor amplitude
         """
         return self.rat[0]
+
+    def primordial_power(self, k, ix=0, curv=0.):
+        """
+        Power law primordial power spectrum with running, calculated in python (same as the CAMB Fortran
+        ScalarPower and TensorPower functions for the first spectrum).
+
+        :param k: wavenumber k (Mpc^{-1}), scalar or array
+        :param ix: 0 for scalar (comoving curvature) power, 2 for tensor power
+        :param curv: curvature K of the background (for tensors in open models)
+        :return: power at k, same shape as k
+        """
+        res = primordial_power_batch([self], k, ix, curv)[0]
+        return res if np.ndim(k) else float(res)
+
+    def scalar_power(self, k):
+        """
+        Scalar (comoving curvature) power spectrum, see :meth:`primordial_power`.
+
+        :param k: wavenumber k (Mpc^{-1}), scalar or array
+        :return: power at k
+        """
+        return self.primordial_power(k, 0)
+
+    def tensor_power(self, k, curv=0.):
+        """
+        Tensor power spectrum, see :meth:`primordial_power`.
+
+        :param k: wavenumber k (Mpc^{-1}), scalar or array
+        :param curv: curvature K of the background (for open models)
+        :return: power at k
+        """
+        return self.primordial_power(k, 2, curv)
+
+
+class SplinedInitialPower(object):
+    """
+    General tabulated primordial power spectrum, which can be used in place of
+    :class:`InitialPowerParams` in :func:`primordial_power_batch` and
+    :meth:`.camb.CAMBdata.get_power_spectra_batch`. The spline in log k, log P is made once on construction.
+
+    :param ks: array of k values (Mpc^{-1}), increasing
+    :param PK: array of scalar power spectrum values at ks
+    :param PK_tensor: optional array of tensor power spectrum values at ks
+    """
+
+    def __init__(self, ks, PK, PK_tensor=None):
+        from scipy.interpolate import InterpolatedUnivariateSpline
+        ks = np.asarray(ks, dtype=np.float64)
+        if ks.ndim != 1 or np.any(np.diff(ks) <= 0) or ks[0] <= 0:
+            raise CAMBError('ks must be a positive increasing array')
+        self.logk = np.log(ks)
+        self._splines = {0: InterpolatedUnivariateSpline(self.logk, np.log(PK))}
+        if PK_tensor is not None:
+            self._splines[2] = InterpolatedUnivariateSpline(self.logk, np.log(PK_tensor))
+
+    def has_tensors(self):
+        """
+        Do these settings have non-zero tensors?
+
+        :return: True if a tensor spectrum was given
+        """
+        return 2 in self._splines
+
+    def primordial_power(self, k, ix=0, curv=0.):
+        """
+        Interpolated primordial power spectrum. Values are extrapolated outside the range of the table.
+
+        :param k: wavenumber k (Mpc^{-1}), scalar or array
+        :param ix: 0 for scalar power, 2 for tensor power
+        :param curv: not used
+        :return: power at k, same shape as k
+        """
+        if ix not in (0, 2):
+            raise CAMBError('Unknown primordial power index %s' % ix)
+        if ix not in self._splines:
+            return np.zeros(np.shape(k)) if np.ndim(k) else 0.
+        res = np.exp(self._splines[ix](np.log(np.ravel(k)))).reshape(np.shape(k))
+        return res if np.ndim(k) else float(res)
+
+    def scalar_power(self, k):
+        return self.primordial_power(k, 0)
+
+    def tensor_power(self, k, curv=0.):
+        return self.primordial_power(k, 2)
+
+
+def _power_law_arrays(powers):
+    # parameters of the first spectrum of each InitialPowerParams as column vectors
+    names = ['an', 'n_run', 'n_runrun', 'ant', 'nt_run', 'rat', 'ScalarPowerAmp', 'TensorPowerAmp']
+    pars = dict((name, np.array([getattr(p, name)[0] for p in powers])[:, np.newaxis]) for name in names)
+    for name in ['k_0_scalar', 'k_0_tensor', 'tensor_parameterization']:
+        pars[name] = np.array([getattr(p, name) for p in powers])[:, np.newaxis]
+    return pars
+
+
+def _scalar_power_law(pars, lnrat):
+    return pars['ScalarPowerAmp'] * np.exp(
+        lnrat * (pars['an'] - 1 + lnrat * (pars['n_run'] / 2 + pars['n_runrun'] / 6 * lnrat)))
+
+
+def primordial_power_batch(powers, k, ix=0, curv=0.):
+    """
+    Primordial power spectra for many sets of initial power parameters at once.
+    Power law spectra are calculated with numpy broadcasting over (parameter set, k) with no loop over sets.
+
+    :param powers: list of :class:`InitialPowerParams` or :class:`SplinedInitialPower` instances
+    :param k: wavenumber k (Mpc^{-1}), scalar or array
+    :param ix: 0 for scalar (comoving curvature) power, 2 for tensor power
+    :param curv: curvature K of the background (for tensors in open models)
+    :return: array P[i, ...] for each set i, and each k
+    """
+    if ix not in (0, 2):
+        raise CAMBError('Unknown primordial power index %s' % ix)
+    shape = np.shape(k)
+    k = np.asarray(k, dtype=np.float64).reshape(-1)
+    res = np.empty((len(powers), k.shape[0]))
+    power_law = np.array([isinstance(p, InitialPowerParams) for p in powers], dtype=bool)
+    for i in np.nonzero(~power_law)[0]:
+        res[i] = powers[i].primordial_power(k, ix, curv)
+    if np.any(power_law):
+        pars = _power_law_arrays([p for p, is_law in zip(powers, power_law) if is_law])
+        if ix == 0:
+            res[power_law] = _scalar_power_law(pars, np.log(k / pars['k_0_scalar']))
+        else:
+            lnrat = np.log(k / pars['k_0_tensor'])
+            k_dep = np.exp(lnrat * (pars['ant'] + pars['nt_run'] / 2 * lnrat))
+            param = pars['tensor_parameterization']
+            amp = np.where(param == tensor_param_indeptilt, pars['rat'] * pars['ScalarPowerAmp'],
+                           np.where(param == tensor_param_rpivot,
+                                    pars['rat'] * _scalar_power_law(pars, np.log(pars['k_0_tensor'] /
+                                                                                 pars['k_0_scalar'])),
+                                    pars['TensorPowerAmp']))
+            tensors = amp * k_dep
+            if curv < 0:
+                tensors *= np.tanh(np.pi / 2 * np.sqrt(-k ** 2 / curv - 3))
+            res[power_law] = tensors
+    return res.reshape((len(powers),) + shape)
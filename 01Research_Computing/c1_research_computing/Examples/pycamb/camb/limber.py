@@ -0,0 +1,162 @@
+"""
+Limber approximation angular power spectra of tracers of the matter density, e.g. galaxy counts
+or weak lensing convergence in tomographic redshift bins,
+
+    C_L^{ij} = int dchi W_i(chi) W_j(chi) / chi^2 P(k=(L+1/2)/chi, z(chi))
+
+All tracer windows are sampled on a common grid in comoving distance chi, so the spectra for all
+pairs of tracers and all L are calculated with a few matrix products. e.g.::
+
+    results = camb.get_results(pars)  # with matter power redshifts set by set_matter_power
+    limber = Limber(results)
+    for i, nz in enumerate(bins):
+        limber.add_galaxy('g%s' % i, z, nz, bias=1.2)
+        limber.add_lensing('k%s' % i, z, nz)
+    cls = limber.get_cls(np.arange(10, 2000, 20))
+    cl_g0_k3 = cls[('g0', 'k3')]
+"""
+
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from .baseconfig import CAMBError
+
+
+def _trapz(y, x):
+    return np.sum((y[1:] + y[:-1]) * np.diff(x)) / 2
+
+
+class Limber(object):
+    """
+    Calculator for Limber approximation angular power spectra of many tracers.
+
+    :param results: :class:`.camb.CAMBdata` instance with calculated matter power spectra
+    :param PK: optional :class:`.camb.MatterPowerInterpolator` giving P(z, k) in Mpc^3 as a function of k in
+        Mpc^{-1}; by default made from results (non-linear). Can have a table made by
+        :meth:`~.camb.MatterPowerInterpolator.make_table` for faster evaluation.
+    :param nchi: number of points in chi for the integration
+    :param zmax: maximum redshift (default: maximum redshift of PK)
+    """
+
+    def __init__(self, results, PK=None, nchi=500, zmax=None):
+        if PK is None:
+            PK = results.get_matter_power_interpolator(nonlinear=True, hubble_units=False, k_hunit=False)
+        self.results = results
+        self.PK = PK
+        zmax = zmax or PK.z[-1]
+        chimax = results.comoving_radial_distance(zmax)
+        # mid-point rule, avoiding chi=0
+        self.dchi = chimax / nchi
+        self.chis = (np.arange(nchi) + 0.5) * self.dchi
+        self.zs = results.redshift_at_comoving_radial_distance(self.chis)
+        self.Hs = results.h_of_z(self.zs)
+        self.names = []
+        self.windows = np.empty((0, nchi))
+
+    def add_window(self, name, window):
+        """
+        Add a tracer with a general window function.
+
+        :param name: name of the tracer
+        :param window: array of W(chi) at the points chis, or function of (chi, z) arrays
+        """
+        if name in self.names:
+            raise CAMBError('Tracer %s already added' % name)
+        if callable(window):
+            window = window(self.chis, self.zs)
+        window = np.asarray(window, dtype=np.float64)
+        if window.shape != self.chis.shape:
+            raise CAMBError('window must be sampled at the chis points')
+        self.names.append(name)
+        self.windows = np.vstack((self.windows, window))
+
+    def _n_chi(self, z, nz):
+        # normalized source distribution n(z) dz/dchi on the chi grid
+        nz = np.asarray(nz, dtype=np.float64) / _trapz(nz, z)
+        return np.interp(self.zs, z, nz, left=0, right=0) * self.Hs
+
+    def add_galaxy(self, name, z, nz, bias=1.):
+        """
+        Add galaxy count tracer with redshift distribution n(z) and linear bias, W = b(z) n(z) dz/dchi
+
+        :param name: name of the tracer
+        :param z: array of redshifts
+        :param nz: n(z) at z (need not be normalized)
+        :param bias: constant bias, or array of bias values at z
+        """
+        bias = np.interp(self.zs, z, np.broadcast_to(bias, np.shape(z)))
+        self.add_window(name, bias * self._n_chi(z, nz))
+
+    def add_lensing(self, name, z, nz):
+        """
+        Add weak lensing convergence tracer for sources with redshift distribution n(z),
+        W = 3/2 Omega_m H_0^2 (1+z) chi int dchi' n(chi') (chi' - chi)/chi'
+        (neglecting curvature).
+
+        :param name: name of the tracer
+        :param z: array of redshifts
+        :param nz: n(z) at z (need not be normalized)
+        """
+        n_chi = self._n_chi(z, nz) * self.dchi
+        # integrals from chi to chimax, of n(chi') and n(chi')/chi'
+        int_n = np.cumsum(n_chi[::-1])[::-1] - n_chi / 2
+        int_n_chi = np.cumsum((n_chi / self.chis)[::-1])[::-1] - n_chi / self.chis / 2
+        params = self.results.Params
+        omegam = params.omegab + params.omegac + params.omegan
+        H0 = self.results.h_of_z(0)
+        self.add_window(name, 1.5 * omegam * H0 ** 2 * (1 + self.zs) * self.chis * (int_n - self.chis * int_n_chi))
+
+    def power_matrix(self, ls):
+        """
+        Matrix of integration weights times the matter power at k = (L+1/2)/chi for each L and chi.
+        Values of k outside the range of PK are set to zero.
+
+        :param ls: array of L values
+        :return: array of shape (len(ls), len(chis))
+        """
+        ls = np.asarray(ls, dtype=np.float64)
+        k = (ls[:, np.newaxis] + 0.5) / self.chis
+        inrange = (k >= np.exp(self.PK.logk[0])) & (k <= np.exp(self.PK.logk[-1]))
+        pk = np.zeros(k.shape)
+        pk[inrange] = self.PK.P(np.broadcast_to(self.zs, k.shape)[inrange], k[inrange], grid=False)
+        return pk * (self.dchi / self.chis ** 2)
+
+    def get_cls(self, ls, pairs=None, n_workers=1):
+        """
+        Get Limber C_L for pairs of tracers.
+
+        :param ls: array of L values
+        :param pairs: list of (name1, name2) tracer pairs; default all pairs
+        :param n_workers: number of threads to share the pairs between
+        :return: dictionary of C_L arrays indexed by (name1, name2) pairs
+        """
+        if pairs is None:
+            pairs = [(name1, name2) for i, name1 in enumerate(self.names) for name2 in self.names[i:]]
+        try:
+            indices = np.array([[self.names.index(name) for name in pair] for pair in pairs]).reshape(-1, 2)
+        except ValueError:
+            raise CAMBError('Unknown tracer in pairs %s' % pairs)
+        power = self.power_matrix(ls)
+
+        def pair_cls(ix):
+            return np.dot(self.windows[indices[ix, 0]] * self.windows[indices[ix, 1]], power.T)
+
+        chunks = np.array_split(np.arange(len(pairs)), max(1, min(n_workers, len(pairs))))
+        if len(chunks) > 1:
+            pool = ThreadPool(len(chunks))
+            try:
+                cls = np.vstack(pool.map(pair_cls, chunks))
+            finally:
+                pool.close()
+        else:
+            cls = pair_cls(chunks[0])
+        return dict((tuple(pair), cl) for pair, cl in zip(pairs, cls))
+
+    def get_cl_matrix(self, ls):
+        """
+        Get Limber C_L for all pairs of tracers as a matrix.
+
+        :param ls: array of L values
+        :return: array of shape (len(ls), ntracers, ntracers) ordered as the names list
+        """
+        power = self.power_matrix(ls)
+        return np.matmul(self.windows * power[:, np.newaxis, :], self.windows.T)
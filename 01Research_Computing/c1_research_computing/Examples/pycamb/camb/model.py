@@ -8,6 +8,7 @@ import numpy as np
 from . import bbn
 import logging
 import six
+from collections import OrderedDict
 
 # ---Parameters
 
@@ -154,6 +155,63 @@ numpy_1d = np.ctypeslib.ndpointer(c_double, flags='C_CONTIGUOUS')
 CAMB_primordialpower = camblib.__handles_MOD_camb_primordialpower
 CAMB_primordialpower.restype = c_bool
 
+# H0 values solved from cosmomc_theta by CAMBparams.set_cosmology: exact solutions for repeated parameters,
+# and recent solutions indexed by (ombh2, omch2, mnu, omk, nnu) to start the search for nearby parameters
+theta_H0_cache_size = 1000
+_theta_H0_solutions = OrderedDict()
+_theta_H0_nearby = OrderedDict()
+_theta_H0_nearby_scales = np.array([1e-3, 1e-2, 0.1, 1e-2, 0.1])
+
+
+def clear_theta_H0_cache():
+    """
+    Clear the cache of H0 values solved from cosmomc_theta in :meth:`CAMBparams.set_cosmology`.
+    """
+    _theta_H0_solutions.clear()
+    _theta_H0_nearby.clear()
+
+
+def _cache_theta_H0(cache, key, value):
+    cache[key] = value
+    if len(cache) > theta_H0_cache_size:
+        cache.popitem(last=False)
+
+
+def _theta_dlnH0(H0, ombh2, omch2, omnuh2, omk, nnu, TCMB, zstar=1090.):
+    # Approximate d ln(theta)/d ln(H0) at fixed physical densities. The sound horizon and recombination redshift
+    # depend only on the physical densities, so the H0 dependence is from the distance to recombination via the
+    # dark energy (and curvature) density, Omega_Lambda h^2 = (1 - Omega_K) h^2 - Omega_m h^2 - Omega_r h^2
+    h2 = (H0 / 100.) ** 2
+    omrh2 = 2.47e-5 * (TCMB / 2.7255) ** 4 * (1 + 0.2271 * nnu)
+    ommh2 = ombh2 + omch2 + omnuh2
+    lnz1, dlnz1 = np.linspace(0, np.log(1 + zstar), 400, retstep=True)
+    z1 = np.exp(lnz1)
+    E2 = ommh2 * z1 ** 3 + omrh2 * z1 ** 4 + omk * h2 * z1 ** 2 + (1 - omk) * h2 - ommh2 - omrh2
+    weights = np.full(z1.size, dlnz1)
+    weights[[0, -1]] /= 2
+    chi = np.dot(weights, z1 / np.sqrt(E2))
+    dchi_dh2 = -0.5 * np.dot(weights, z1 * (1 - omk + omk * z1 ** 2) / E2 ** 1.5)
+    return -2 * h2 * dchi_dh2 / chi
+
+
+def _solve_theta_H0(f, cosmomc_theta, dlnH0, H0, rtol=1e-6, max_iter=8):
+    # Newton step in ln H0 using the analytic slope, then secant steps; None if not converging in range
+    lnH0 = np.log(H0)
+    diff = f(H0)
+    slope = dlnH0 * (diff + cosmomc_theta)
+    for _ in range(max_iter):
+        step = -diff / slope
+        if abs(step) < rtol:
+            return np.exp(lnH0 + step)
+        if not 10 < np.exp(lnH0 + step) < 100:
+            return None
+        new_diff = f(np.exp(lnH0 + step))
+        if new_diff != diff:
+            slope = (new_diff - diff) / step
+        lnH0 += step
+        diff = new_diff
+    return None
+
 
 class TransferParams(CAMB_Structure):
     """
@@ -180,6 +238,8 @@ class TransferParams(CAMB_Structure):
         ("PK_num_redshifts", c_int),
         ("NLL_num_redshifts", c_int)
     ]
+    _derived_fields_ = ('num_redshifts', 'redshifts', 'NLL_redshifts', 'PK_redshifts_index', 'NLL_redshifts_index',
+                        'NLL_num_redshifts')
 
 
 class CAMBparams(CAMB_Structure):
@@ -245,6 +305,7 @@ class CAMBparams(CAMB_Structure):
         ("tau0", c_double),
         ("chi0", c_double)
     ]
+    _derived_fields_ = ('ReionHist', 'flat', 'closed', 'open', 'omegak', 'curv', 'r', 'Ksign', 'tau0', 'chi0')
 
     def validate(self):
         """
@@ -288,15 +349,20 @@ class CAMBparams(CAMB_Structure):
 
     def set_bbn_helium(self, ombh2, delta_nnu, tau_neutron=bbn.tau_n):
         """
-        Set the Helium abundance parameter YHe using BBN consistency (using fitting formula as Planck 2015 papers)
+        Set the Helium abundance parameter YHe using BBN consistency (using fitting formula as Planck 2015 papers,
+        or the table interpolation set by :func:`.bbn.set_default_predictor` if its neutron lifetime is tau_neutron)
 
         :param ombh2: physical density of baryons
         :param delta_nnu: additional relativistic Delta_Neff = N_eff - 3.046
         :param tau_neutron: neutron half life in seconds
         :return: self
         """
-        Yp = bbn.yhe_fit(ombh2, delta_nnu, tau_neutron)
-        self.YHe = bbn.ypBBN_to_yhe(Yp)
+        predictor = bbn.get_default_predictor()
+        if predictor is not None and predictor.tau == tau_neutron:
+            self.YHe = predictor.Y_He(ombh2, delta_nnu)
+        else:
+            Yp = bbn.yhe_fit(ombh2, delta_nnu, tau_neutron)
+            self.YHe = bbn.ypBBN_to_yhe(Yp)
         return self
 
     def set_cosmology(self, H0=67, cosmomc_theta=None, ombh2=0.022, omch2=0.12, omk=0.0,
@@ -312,7 +378,8 @@ class CAMBparams(CAMB_Structure):
         If you require more fine-grained control you can set the neutrino parameters directly rather than using this function.
 
         :param H0: Hubble parameter (in km/s/Mpc)
-        :param cosmomc_theta: The CosmoMC theta parameter. You must set H0=None to solve for H0 given cosmomc_theta
+        :param cosmomc_theta: The CosmoMC theta parameter. You must set H0=None to solve for H0 given cosmomc_theta.
+                Solutions are cached, see :func:`clear_theta_H0_cache`
         :param ombh2: physical density in baryons
         :param omch2:  physical density in cold dark matter
         :param omk: Omega_K curvature parameter
@@ -346,18 +413,36 @@ class CAMBparams(CAMB_Structure):
             if H0 is not None:
                 raise CAMBError('Set H0=None when setting cosmomc_theta.')
 
-            try:
-                from scipy.optimize import brentq
-            except ImportError:
-                raise CAMBError('You need SciPy to set cosmomc_theta.')
-
-            from . import camb
-
-            def f(H0):
-                self.set_cosmology(H0=H0, **kw)
-                return camb.get_background(self, no_thermo=True).cosmomc_theta() - cosmomc_theta
-
-            self.H0 = brentq(f, 10, 100, rtol=1e-4)
+            # dark energy parameters are global
+            key = (cosmomc_theta, tuple(sorted(kw.items())), dll_import(c_double, "lambdageneral", "w_lam").value)
+            H0 = _theta_H0_solutions.get(key)
+            if H0 is None:
+                from . import camb
+
+                def f(H0):
+                    self.set_cosmology(H0=H0, **kw)
+                    return camb.get_background(self, no_thermo=True).cosmomc_theta() - cosmomc_theta
+
+                nearby_key = (ombh2, omch2, mnu, omk, nnu)
+                if _theta_H0_nearby:
+                    dist = np.sum(((np.array(list(_theta_H0_nearby)) - nearby_key) / _theta_H0_nearby_scales) ** 2,
+                                  axis=1)
+                    start = list(_theta_H0_nearby.values())[np.argmin(dist)]
+                else:
+                    start = 67.
+                omnuh2 = (mnu * (standard_neutrino_neff / 3.0) ** 0.75 + meffsterile) / 94.07
+                dlnH0 = _theta_dlnH0(start, ombh2, omch2, omnuh2, omk, nnu, TCMB)
+                H0 = _solve_theta_H0(f, cosmomc_theta, dlnH0, start)
+                if H0 is None:
+                    try:
+                        from scipy.optimize import brentq
+                    except ImportError:
+                        raise CAMBError('You need SciPy to set cosmomc_theta.')
+                    H0 = brentq(f, 10, 100, rtol=1e-6)
+                _cache_theta_H0(_theta_H0_solutions, key, H0)
+                _theta_H0_nearby.pop(nearby_key, None)
+                _cache_theta_H0(_theta_H0_nearby, nearby_key, H0)
+            self.H0 = H0
         else:
             self.H0 = H0
 
@@ -512,7 +597,18 @@ class CAMBparams(CAMB_Structure):
     def tensor_power(self, k):
         return self.primordial_power(k, 2)
 
-    def primordial_power(self, k, ix):
+    def primordial_power(self, k, ix, native=False):
+        """
+        Primordial power spectrum. By default calculated in python by
+        :meth:`.initialpower.InitialPowerParams.primordial_power` (vectorized in k), or by CAMB if native=True.
+
+        :param k: wavenumber k (Mpc^{-1}), scalar or array
+        :param ix: 0 for scalar (comoving curvature) power, 2 for tensor power
+        :param native: if True use the CAMB Fortran function
+        :return: power at k
+        """
+        if not native:
+            return self.InitPower.primordial_power(k, ix, self.curv)
         if np.isscalar(k):
             karr = np.array([float(k)])
         else:
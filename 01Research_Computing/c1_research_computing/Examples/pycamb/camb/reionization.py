@@ -34,6 +34,10 @@ class ReionizationParams(CAMB_Structure):
         ("helium_redshiftstart", c_double)  # helium_redshiftstart  = 5._dl
     ]
 
+    def _canonical_skip(self):
+        # only one of redshift and optical depth is input, the other is calculated
+        return ('redshift',) if self.use_optical_depth else ('optical_depth',)
+
     def set_tau(self, tau, delta_redshift=None):
         """
         Set the optical depth
@@ -0,0 +1,371 @@
+"""
+Compact columnar on-disk storage of results for many sets of parameters, e.g. C_L from
+:meth:`.camb.CAMBdata.get_cmb_power_spectra` or matter power spectra for emulator training sets.
+
+A store is a directory of shards. Each shard holds the results for a number of models as one .npy file per
+output column (arrays with a leading model index), plus a JSON file listing the parameters and parameter hash keys
+of the models. The JSON file is written last, so a shard is only visible once complete, and each writer uses
+unique shard names, so several processes can append to the same store at once. index.json lists all shards,
+and is updated by :meth:`ResultStore.consolidate` (shards not yet listed are also found by the reader).
+
+Results are dictionaries of arrays (nested dictionaries are stored as columns named 'key/subkey'),
+tuples of arrays (columns '0', '1', ...) or a single array (column 'result'). e.g.::
+
+    with ResultStoreWriter('cls_store', shard_size=1000) as writer:
+        for values in params_list:
+            writer.append(values, func(values))
+    store = ResultStore('cls_store')
+    cls = store.column('total')  # array for all models, read from memory-mapped shards
+    model = store[store.index(values)]
+
+or calculate and write in parallel worker processes with :func:`write_grid`.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import time
+import uuid
+import numpy as np
+import six
+from .baseconfig import CAMBError
+
+_index_file = 'index.json'
+_shard_dir = 'shards'
+# shard sequence number in this process, so shards written in the same millisecond sort in order
+_shard_counter = itertools.count()
+
+
+def params_key(params):
+    """
+    Hash key for a set of parameters, the same in different sessions and platforms.
+
+    :param params: dictionary of parameter values, or :class:`.baseconfig.CAMB_Structure` instance
+        (e.g. :class:`.model.CAMBparams`)
+    :return: hex digest string
+    """
+    if hasattr(params, 'canonical_hash'):
+        return params.canonical_hash()
+    return hashlib.sha1(six.b(json.dumps(params, sort_keys=True, default=_json_default))).hexdigest()
+
+
+def _json_default(obj):
+    # numpy scalars and arrays in parameter dictionaries
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def flatten_result(result, prefix=''):
+    """
+    Convert a result to a dictionary of column name and array.
+
+    :param result: dictionary (possibly nested) or tuple of arrays, or an array
+    :param prefix: prefix for column names
+    :return: dictionary of numpy arrays
+    """
+    if isinstance(result, dict):
+        items = result.items()
+    elif isinstance(result, tuple):
+        items = [(str(i), value) for i, value in enumerate(result)]
+    elif prefix:
+        return {prefix[:-1]: np.asarray(result)}
+    else:
+        return {'result': np.asarray(result)}
+    columns = {}
+    for key, value in items:
+        if isinstance(value, (dict, tuple)):
+            columns.update(flatten_result(value, prefix + str(key) + '/'))
+        else:
+            columns[prefix + str(key)] = np.asarray(value)
+    return columns
+
+
+def _write_json(filename, data):
+    # write then rename, so readers never see a partial file
+    tmp = filename + '.%s.tmp' % uuid.uuid4().hex
+    with open(tmp, 'w') as f:
+        json.dump(data, f, default=_json_default)
+    if six.PY3:
+        os.replace(tmp, filename)
+    else:
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp, filename)
+
+
+class ResultStoreWriter(object):
+    """
+    Append results to a :class:`ResultStore` directory (created if needed). Results are buffered in memory
+    and written as a new shard every shard_size models, and when closed.
+
+    :param path: directory of the store
+    :param shard_size: number of models in each shard
+    :param dtypes: optional dictionary of numpy dtypes for columns, e.g. {'total': np.float32} to halve the size
+    """
+
+    def __init__(self, path, shard_size=1000, dtypes=None):
+        self.path = path
+        self.shard_size = shard_size
+        self.dtypes = dtypes or {}
+        self.shard_names = []
+        self._columns = None
+        self._buffer = []
+        shard_dir = os.path.join(path, _shard_dir)
+        if not os.path.isdir(shard_dir):
+            try:
+                os.makedirs(shard_dir)
+            except OSError:
+                # made by another process
+                if not os.path.isdir(shard_dir):
+                    raise
+
+    def append(self, params, result):
+        """
+        Add the result for one set of parameters.
+
+        :param params: dictionary of parameter values (stored in the index), or :class:`.model.CAMBparams`
+            instance (only the hash key is stored)
+        :param result: result arrays, see :func:`flatten_result`
+        """
+        columns = flatten_result(result)
+        shapes = dict((name, value.shape) for name, value in columns.items())
+        if self._columns is None:
+            self._columns = shapes
+        elif shapes != self._columns:
+            raise CAMBError('Result columns or shapes %s do not match previous results %s' % (shapes, self._columns))
+        self._buffer.append((params_key(params), params if isinstance(params, dict) else None, columns))
+        if len(self._buffer) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write any buffered results as a new shard.
+        """
+        if not self._buffer:
+            return
+        name = '%013d_%s_%09d_%s' % (int(time.time() * 1000), os.getpid(), next(_shard_counter),
+                                     uuid.uuid4().hex[:8])
+        shard_dir = os.path.join(self.path, _shard_dir)
+        columns = {}
+        for i, column in enumerate(sorted(self._columns)):
+            arr = np.array([values[column] for _, _, values in self._buffer], dtype=self.dtypes.get(column))
+            filename = '%s.%s.npy' % (name, i)
+            np.save(os.path.join(shard_dir, filename), arr)
+            columns[column] = {'file': filename, 'dtype': arr.dtype.str, 'shape': list(arr.shape[1:])}
+        _write_json(os.path.join(shard_dir, name + '.json'),
+                    {'count': len(self._buffer), 'keys': [key for key, _, _ in self._buffer],
+                     'params': [values for _, values, _ in self._buffer], 'columns': columns})
+        self.shard_names.append(name)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ResultStore(object):
+    """
+    Read a store of results written by :class:`ResultStoreWriter` or :func:`write_grid`. Models are numbered
+    in the order of the shards (oldest first). Shard arrays are memory-mapped, so random access only reads
+    the rows used.
+
+    :param path: directory of the store
+    :param mmap: if True use memory-mapped arrays, otherwise load shards into memory when first used
+    :ivar keys: list of parameter hash keys of the models
+    :ivar params: list of parameter dictionaries of the models (None if not stored)
+    """
+
+    def __init__(self, path, mmap=True):
+        if not os.path.isdir(os.path.join(path, _shard_dir)):
+            raise CAMBError('No result store at %s' % path)
+        self.path = path
+        self.mmap = mmap
+        self.refresh()
+
+    def refresh(self):
+        """
+        Re-read the index, including any shards written since the store was opened.
+        """
+        shard_dir = os.path.join(self.path, _shard_dir)
+        index_file = os.path.join(self.path, _index_file)
+        shards = []
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                shards = json.load(f)['shards']
+        known = set(shard['name'] for shard in shards)
+        for filename in sorted(os.listdir(shard_dir)):
+            if filename.endswith('.json') and filename[:-5] not in known:
+                with open(os.path.join(shard_dir, filename)) as f:
+                    shard = json.load(f)
+                shard['name'] = filename[:-5]
+                shards.append(shard)
+        self.shards = shards
+        self._offsets = np.cumsum([0] + [shard['count'] for shard in shards])
+        self.keys = [key for shard in shards for key in shard['keys']]
+        self.params = [values for shard in shards for values in shard['params']]
+        self._key_index = {}
+        for i, key in enumerate(self.keys):
+            self._key_index.setdefault(key, i)
+        self._arrays = {}
+
+    def consolidate(self):
+        """
+        Write index.json listing all current shards, so they can be opened without reading each shard's index.
+        """
+        self.refresh()
+        _write_json(os.path.join(self.path, _index_file), {'version': 1, 'shards': self.shards})
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    @property
+    def columns(self):
+        """
+        Names of the stored columns
+        """
+        return sorted(self.shards[0]['columns']) if self.shards else []
+
+    def __contains__(self, params):
+        return (params if isinstance(params, six.string_types) else params_key(params)) in self._key_index
+
+    def index(self, params):
+        """
+        Index of the model for given parameters (the first, if stored more than once).
+
+        :param params: dictionary of parameter values, :class:`.model.CAMBparams` instance, or hash key string
+        :return: model index
+        """
+        key = params if isinstance(params, six.string_types) else params_key(params)
+        try:
+            return self._key_index[key]
+        except KeyError:
+            raise KeyError('Parameters not in store: %s' % params)
+
+    def _shard_array(self, shard_index, column):
+        arr = self._arrays.get((shard_index, column))
+        if arr is None:
+            shard = self.shards[shard_index]
+            try:
+                filename = shard['columns'][column]['file']
+            except KeyError:
+                raise CAMBError('Unknown column %s' % column)
+            arr = np.load(os.path.join(self.path, _shard_dir, filename), mmap_mode='r' if self.mmap else None)
+            self._arrays[(shard_index, column)] = arr
+        return arr
+
+    def _locate(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Model index %s out of range' % i)
+        shard_index = int(np.searchsorted(self._offsets, i, side='right')) - 1
+        return shard_index, i - int(self._offsets[shard_index])
+
+    def __getitem__(self, i):
+        """
+        Get the result for one model.
+
+        :param i: model index, or parameters as for :meth:`index`
+        :return: dictionary of arrays for each column (read-only views of the memory-mapped shards)
+        """
+        if not isinstance(i, (int, np.integer)):
+            i = self.index(i)
+        shard_index, row = self._locate(int(i))
+        return dict((column, self._shard_array(shard_index, column)[row]) for column in self.columns)
+
+    def column(self, name, indices=None):
+        """
+        Get a column for all (or selected) models as a single array.
+
+        :param name: column name
+        :param indices: optional array of model indices
+        :return: array with leading dimension the number of models
+        """
+        if not self.shards:
+            raise CAMBError('Store is empty')
+        if indices is None:
+            return np.concatenate([self._shard_array(i, name) for i in range(len(self.shards))])
+        indices = np.asarray(indices, dtype=int)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if np.any((indices < 0) | (indices >= len(self))):
+            raise IndexError('Model indices out of range for %s models' % len(self))
+        shard_indices = np.searchsorted(self._offsets, indices, side='right') - 1
+        first = self._shard_array(0, name)
+        res = np.empty((len(indices),) + first.shape[1:], dtype=first.dtype)
+        for shard_index in np.unique(shard_indices):
+            sel = shard_indices == shard_index
+            res[sel] = self._shard_array(shard_index, name)[indices[sel] - self._offsets[shard_index]]
+        return res
+
+
+class _ShardJob(object):
+    # picklable function calculating results for a chunk of parameters in a worker and writing them as a shard
+
+    def __init__(self, func, path, dtypes):
+        self.func = func
+        self.path = path
+        self.dtypes = dtypes
+
+    def __call__(self, params_chunk):
+        import traceback
+        writer = ResultStoreWriter(self.path, len(params_chunk), self.dtypes)
+        errors = []
+        for i, params in params_chunk:
+            try:
+                result = self.func(params)
+            except Exception:
+                errors.append((i, traceback.format_exc()))
+                continue
+            writer.append(params, result)
+        writer.close()
+        return len(params_chunk) - len(errors), errors
+
+
+def write_grid(path, params_list, func, shard_size=100, dtypes=None, consolidate=True, **kwargs):
+    """
+    Calculate func(params) for each set of parameters in parallel worker processes using :func:`.grid.run_grid`,
+    with each worker writing the results for chunks of shard_size parameters directly to the store
+    (so results are not passed back to the main process). Failed calculations are not stored.
+
+    :param path: directory of the store
+    :param params_list: list or iterator of parameter dictionaries or :class:`.model.CAMBparams` instances
+    :param func: picklable function of the parameters, e.g. :func:`.grid.cmb_power_spectra` or
+        :class:`.emulate.CMBSpectra` instance
+    :param shard_size: number of models in each shard
+    :param dtypes: optional dictionary of numpy dtypes for columns
+    :param consolidate: if True, update index.json when done
+    :param kwargs: other arguments for :func:`.grid.run_grid`, e.g. processes
+    :return: number of results written, list of (index in params_list, error string) for failed calculations
+    """
+    from . import grid
+
+    def chunks():
+        chunk = []
+        for job in enumerate(params_list):
+            chunk.append(job)
+            if len(chunk) == shard_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    ResultStoreWriter(path)  # make directories
+    written = 0
+    errors = []
+    for res in grid.run_grid(chunks(), _ShardJob(func, path, dtypes), ordered=False, **kwargs):
+        if res.error:
+            raise CAMBError('Writing results failed: %s' % res.error)
+        written += res.result[0]
+        errors += res.result[1]
+    if consolidate:
+        ResultStore(path).consolidate()
+    return written, sorted(errors)
@@ -0,0 +1,52 @@
+"""
+Timing of the CAMBdata background functions for arrays of redshifts, compared to a loop over scalar calls.
+Run as e.g.
+
+    python -m camb_tests.background_benchmark --nz 1000 100000 1000000
+"""
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+import camb
+
+
+def time_background(nz, nloop=2000, zmax=10.):
+    """
+    Time the vectorized background functions for nz random redshifts, and the scalar loop for nloop redshifts.
+
+    :param nz: number of redshifts
+    :param nloop: number of redshifts used for timing the scalar loop (time is scaled to nz)
+    :param zmax: maximum redshift
+    :return: dictionary indexed by function name of (vector time, scaled loop time, max fractional difference)
+    """
+    pars = camb.set_params(H0=67.5, ombh2=0.022, omch2=0.122, omk=0.01)
+    data = camb.get_background(pars)
+    z = np.random.RandomState(1).uniform(0, zmax, nz)
+    z2 = z + np.random.RandomState(2).uniform(0, 1, nz)
+    functions = {'h_of_z': (data.h_of_z, (z,)),
+                 'physical_time': (data.physical_time, (z,)),
+                 'conformal_time_a1_a2': (data.conformal_time_a1_a2, (1 / (1 + z2), 1 / (1 + z))),
+                 'angular_diameter_distance2': (data.angular_diameter_distance2, (z, z2)),
+                 'comoving_radial_distance': (data.comoving_radial_distance, (z,))}
+    results = {}
+    for name, (func, args) in functions.items():
+        start = time.time()
+        vec = func(*args)
+        vec_time = time.time() - start
+        nsub = min(nz, nloop)
+        start = time.time()
+        loop = np.array([func(*[arg[i] for arg in args]) for i in range(nsub)])
+        loop_time = (time.time() - start) * nz / nsub
+        results[name] = (vec_time, loop_time, np.max(np.abs(vec[:nsub] / loop - 1)))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the vectorized background functions')
+    parser.add_argument('--nz', type=int, nargs='+', default=[1000, 100000, 1000000])
+    args = parser.parse_args()
+    for nz in args.nz:
+        for name, (vec_time, loop_time, diff) in sorted(time_background(nz).items()):
+            print('%8d redshifts, %-26s: vector %.4fs, scalar loop %.4fs (x%.0f), max difference %.1e'
+                  % (nz, name, vec_time, loop_time, loop_time / vec_time, diff))
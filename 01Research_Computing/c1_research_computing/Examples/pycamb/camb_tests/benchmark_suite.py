@@ -0,0 +1,320 @@
+"""
+Performance regression benchmarks of the main camb calculations, with fixed parameters and random seeds.
+
+Each benchmark runs in a new python process, recording the wall time of each repeat, the peak resident memory
+of the process, and the peak python memory and number of python memory blocks allocated (from tracemalloc,
+in a separate run). Results are appended to a JSON history file, and compared to previous runs: a benchmark is
+flagged as slower if its times are significantly larger than the recent history (one-sided Mann-Whitney U test)
+by more than a minimum fraction.
+
+Benchmarks using the CAMB library are skipped with --no_library (or if the library is not available),
+so the python correlation and lensing functions can be benchmarked anywhere. Run as e.g.
+
+    python -m camb_tests.benchmark_suite --history benchmarks.json
+    python -m camb_tests.benchmark_suite --no_library --repeat 10 --fail
+    python -m camb_tests.benchmark_suite --benchmarks lensed_cls_2500 cl2corr_4000
+
+benchmark_history.json has labelled reference runs of the library-independent benchmarks, which can be used as
+the --history file to check for regressions (on comparable hardware).
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from timeit import default_timer
+
+import numpy as np
+
+seed = 1
+
+
+def _params(lmax=2500):
+    import camb
+    return camb.set_params(H0=67.5, ombh2=0.022, omch2=0.122, mnu=0.06, omk=0, tau=0.055, As=2.1e-9, ns=0.965,
+                           lmax=lmax, lens_potential_accuracy=1 if lmax > 3000 else 0)
+
+
+def _model_cls(lmax):
+    from camb_tests.correlations_benchmark import model_cls
+    return model_cls(lmax)
+
+
+def background():
+    import camb
+    pars = _params()
+    return lambda: camb.get_background(pars)
+
+
+def transfers():
+    import camb
+    pars = _params()
+    return lambda: camb.get_transfer_functions(pars)
+
+
+def cmb_power(lmax):
+    def setup():
+        import camb
+        pars = _params(lmax)
+        return lambda: camb.get_results(pars).get_cmb_power_spectra(lmax=lmax)
+
+    return setup
+
+
+def lensed_cls(lmax):
+    def setup():
+        from camb import correlations
+        cls, clpp = _model_cls(lmax)
+        return lambda: correlations.lensed_cls(cls, clpp)
+
+    return setup
+
+
+def cl2corr(lmax):
+    def setup():
+        from camb import correlations
+        cls, _ = _model_cls(lmax)
+        xvals, _ = np.polynomial.legendre.leggauss(lmax + 1)
+        return lambda: correlations.cl2corr(cls, xvals, lmax)
+
+    return setup
+
+
+def corr2cl(lmax):
+    def setup():
+        from camb import correlations
+        cls, _ = _model_cls(lmax)
+        xvals, weights = np.polynomial.legendre.leggauss(lmax + 1)
+        corrs = correlations.cl2corr(cls, xvals, lmax)
+        return lambda: correlations.corr2cl(corrs, xvals, weights, lmax)
+
+    return setup
+
+
+def matter_power_interpolator():
+    import camb
+    pars = _params()
+    pars.set_matter_power(redshifts=np.linspace(0, 5, 40)[::-1], kmax=10, silent=True)
+    results = camb.get_results(pars)
+    return lambda: results.get_matter_power_interpolator(nonlinear=True)
+
+
+def matter_power_evaluation():
+    import camb
+    pars = _params()
+    pars.set_matter_power(redshifts=np.linspace(0, 5, 40)[::-1], kmax=10, silent=True)
+    PK = camb.get_results(pars).get_matter_power_interpolator(nonlinear=True)
+    rand = np.random.RandomState(seed)
+    z = rand.uniform(0, 5, 100000)
+    k = np.exp(rand.uniform(np.log(1e-3), np.log(5), 100000))
+    return lambda: (PK.P(z, k, grid=False), PK.P(np.linspace(0, 5, 50), np.logspace(-3, 0.5, 500)))
+
+
+# name: (setup function returning the function to time, whether the CAMB library is needed)
+benchmarks = dict([('background', (background, True)),
+                   ('transfers', (transfers, True)),
+                   ('cmb_power_2500', (cmb_power(2500), True)),
+                   ('cmb_power_4000', (cmb_power(4000), True)),
+                   ('lensed_cls_2500', (lensed_cls(2500), False)),
+                   ('lensed_cls_4000', (lensed_cls(4000), False)),
+                   ('lensed_cls_6000', (lensed_cls(6000), False)),
+                   ('cl2corr_4000', (cl2corr(4000), False)),
+                   ('corr2cl_4000', (corr2cl(4000), False)),
+                   ('matter_power_interpolator', (matter_power_interpolator, True)),
+                   ('matter_power_evaluation', (matter_power_evaluation, True))])
+
+
+def _peak_rss():
+    # peak resident memory of this process in bytes (None if not available)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_benchmark(name, repeat=5, trace=True):
+    """
+    Run a benchmark in this process: one untimed call (e.g. to fill caches), repeat timed calls, and a call
+    traced by tracemalloc (python 3.4+) if trace is True.
+
+    :param name: name of the benchmark in benchmarks
+    :param repeat: number of timed calls
+    :param trace: whether to measure python allocations
+    :return: dictionary with list of times (seconds), peak_rss (bytes), and python peak_alloc (bytes) and
+        alloc_blocks (number of memory blocks allocated by the call and
+        still allocated at its end, including the result)
+    """
+    setup, _ = benchmarks[name]
+    func = setup()
+    func()
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        func()
+        times.append(default_timer() - start)
+    res = {'times': times, 'peak_rss': _peak_rss()}
+    if trace:
+        try:
+            import tracemalloc
+        except ImportError:
+            return res
+        tracemalloc.start()
+        try:
+            result = func()
+            res['peak_alloc'] = tracemalloc.get_traced_memory()[1]
+            res['alloc_blocks'] = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+            del result
+        finally:
+            tracemalloc.stop()
+    return res
+
+
+def run_in_process(name, repeat=5, trace=True):
+    """
+    Run a benchmark in a new python process, see :func:`run_benchmark`.
+
+    :return: result dictionary, or dictionary with 'error' string if the benchmark failed
+    """
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root] + [p for p in [env.get('PYTHONPATH')] if p])
+    args = [sys.executable, '-m', 'camb_tests.benchmark_suite', '--run', name, '--repeat', str(repeat)]
+    if not trace:
+        args.append('--no_trace')
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = proc.communicate()
+    if proc.returncode:
+        return {'error': err.decode().strip().split('\n')[-1]}
+    return json.loads(out.decode().strip().split('\n')[-1])
+
+
+def library_available():
+    """
+    :return: True if the CAMB library can be loaded
+    """
+    from camb import baseconfig
+    try:
+        baseconfig.camblib.load()
+    except (ImportError, OSError):
+        return False
+    return True
+
+
+def load_history(filename):
+    if filename and os.path.exists(filename):
+        with open(filename) as f:
+            return json.load(f)
+    return []
+
+
+def compare(result, history, name, alpha=0.01, min_slowdown=0.05, last=5):
+    """
+    Test whether benchmark times are significantly slower than in previous runs.
+
+    :param result: result dictionary from :func:`run_benchmark`
+    :param history: list of previous run dictionaries, as saved in the history file
+    :param name: name of the benchmark
+    :param alpha: significance level for the one-sided Mann-Whitney U test
+    :param min_slowdown: minimum fractional increase in the median time to flag
+    :param last: number of most recent previous runs to compare to
+    :return: (fractional change in median time, p-value, slower flag), or None if there is no history
+    """
+    previous = [run['results'][name]['times'] for run in history if 'times' in run['results'].get(name, {})]
+    if not previous or 'times' not in result:
+        return None
+    from scipy.stats import mannwhitneyu
+    reference = np.concatenate(previous[-last:])
+    times = np.array(result['times'])
+    change = np.median(times) / np.median(reference) - 1
+    if len(times) < 2 or len(reference) < 2:
+        return change, None, False
+    p = mannwhitneyu(times, reference, alternative='greater')[1]
+    return change, p, bool(p < alpha and change > min_slowdown)
+
+
+def run_suite(names=None, repeat=5, no_library=False, trace=True, history_file=None, label=None, **compare_args):
+    """
+    Run benchmarks, compare to the history, and append the results to the history file.
+
+    :param names: list of benchmark names (default: all)
+    :param repeat: number of timed calls of each benchmark
+    :param no_library: if True skip benchmarks that need the CAMB library
+    :param trace: whether to measure python allocations
+    :param history_file: JSON history file name
+    :param label: optional description of the run (e.g. the version being tested) to save in the history
+    :param compare_args: arguments for :func:`compare`
+    :return: run dictionary (as appended to the history), list of names of significantly slower benchmarks
+    """
+    names = names or list(benchmarks)
+    unknown = set(names) - set(benchmarks)
+    if unknown:
+        raise ValueError('Unknown benchmarks %s' % sorted(unknown))
+    no_library = no_library or not library_available()
+    history = load_history(history_file)
+    run = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+           'numpy': np.__version__, 'machine': platform.node(), 'repeat': repeat, 'results': {}}
+    if label:
+        run['label'] = label
+    slower = []
+    for name in names:
+        if no_library and benchmarks[name][1]:
+            run['results'][name] = {'skipped': True}
+            continue
+        result = run_in_process(name, repeat, trace)
+        comparison = compare(result, history, name, **compare_args)
+        if comparison is not None:
+            result['change'], result['p'], result['slower'] = comparison
+            if result['slower']:
+                slower.append(name)
+        run['results'][name] = result
+    if history_file:
+        history.append(run)
+        with open(history_file, 'w') as f:
+            json.dump(history, f, indent=1)
+    return run, slower
+
+
+def _format(name, res):
+    if res.get('skipped'):
+        return '%-26s: skipped (needs CAMB library)' % name
+    if 'error' in res:
+        return '%-26s: failed: %s' % (name, res['error'])
+    s = '%-26s: %9.4fs (median %.4fs)' % (name, min(res['times']), np.median(res['times']))
+    if res.get('peak_rss'):
+        s += ', peak RSS %6.1f MB' % (res['peak_rss'] / 2. ** 20)
+    if 'peak_alloc' in res:
+        s += ', python peak %6.1f MB in %d blocks' % (res['peak_alloc'] / 2. ** 20, res['alloc_blocks'])
+    if 'change' in res:
+        s += ', %+.1f%%' % (100 * res['change'])
+        if res['slower']:
+            s += ' SLOWER (p=%.2g)' % res['p']
+    return s
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time camb calculations and check for slowdowns')
+    parser.add_argument('--benchmarks', nargs='+', default=None, choices=sorted(benchmarks))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--history', default=None, help='JSON file of previous results to compare and append to')
+    parser.add_argument('--label', default=None, help='description of the run to save in the history')
+    parser.add_argument('--no_library', action='store_true', help='skip benchmarks needing the CAMB library')
+    parser.add_argument('--no_trace', action='store_true', help='do not measure python allocations')
+    parser.add_argument('--alpha', type=float, default=0.01, help='significance level for slowdowns')
+    parser.add_argument('--min_slowdown', type=float, default=0.05, help='minimum fractional slowdown to flag')
+    parser.add_argument('--fail', action='store_true', help='non-zero exit status if any benchmark is slower')
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        print(json.dumps(run_benchmark(args.run, args.repeat, not args.no_trace)))
+        sys.exit()
+    run, slower = run_suite(args.benchmarks, args.repeat, args.no_library, not args.no_trace, args.history,
+                            args.label, alpha=args.alpha, min_slowdown=args.min_slowdown)
+    for name, res in run['results'].items():
+        print(_format(name, res))
+    if slower and args.fail:
+        sys.exit('Slower benchmarks: %s' % ', '.join(slower))
@@ -1,17 +1,52 @@
 import os
 import sys
+import shutil
+import tempfile
 import unittest
 import numpy as np
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 try:
     import camb
 except ImportError:
     sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
     import camb
-from camb import model, correlations
+from camb import model, correlations, bbn, initialpower
+
+
+def _model_cls(lmax):
+    # smooth model unlensed CMB spectra cls[L, ix] and lensing potential clpp[L], falling off well before lmax
+    ls = np.arange(lmax + 1)
+    cls = np.zeros((lmax + 1, 4))
+    cls[2:, 0] = 1000 * np.exp(-(ls[2:] / (lmax / 1.5)) ** 2)
+    cls[2:, 1] = 10 * np.exp(-(ls[2:] / (lmax / 2.)) ** 2)
+    cls[2:, 2] = 0.01 * np.exp(-(ls[2:] / (lmax / 2.5)) ** 2)
+    cls[2:, 3] = 0.5 * np.sqrt(cls[2:, 0] * cls[2:, 1])
+    clpp = np.zeros(lmax + 1)
+    clpp[1:] = 1e-7 * ls[1:] ** 2 / (1 + (ls[1:] / 60.) ** 2)
+    return cls, clpp
 
 
 class CambTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # keep the Gauss-Legendre disk cache (also used by worker processes) out of the user's cache directory
+        cls.cache_dir = tempfile.mkdtemp()
+        cls.saved_cache_dir = os.environ.get('CAMB_CACHE_DIR')
+        os.environ['CAMB_CACHE_DIR'] = cls.cache_dir
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.saved_cache_dir is None:
+            del os.environ['CAMB_CACHE_DIR']
+        else:
+            os.environ['CAMB_CACHE_DIR'] = cls.saved_cache_dir
+        shutil.rmtree(cls.cache_dir, ignore_errors=True)
+
     def testBackground(self):
         pars = camb.CAMBparams()
         pars.set_cosmology(H0=68.5, ombh2=0.022, omch2=0.122, YHe=0.2453, mnu=0.07, omk=0)
@@ -46,6 +81,9 @@ class CambTest(unittest.TestCase):
         zs = data.redshift_at_comoving_radial_distance(chis)
         chitest = data.comoving_radial_distance(zs)
         self.assertTrue(np.sum((chitest - chis) ** 2) < 1e-3)
+        z_scalar = data.redshift_at_comoving_radial_distance(chis[50])
+        self.assertIsInstance(z_scalar, float)
+        self.assertAlmostEqual(z_scalar, zs[50], 6)
 
         theta = data.cosmomc_theta()
         self.assertAlmostEqual(theta, 0.0104759965, 5)
@@ -57,9 +95,15 @@ class CambTest(unittest.TestCase):
         # Test BBN consistency, base_plikHM_TT_lowTEB best fit model
         pars.set_cosmology(H0=67.31, ombh2=0.022242, omch2=0.11977, mnu=0.06, omk=0)
         self.assertAlmostEqual(pars.YHe, 0.245336, 5)
+        predictor = bbn.get_predictor()
+        self.assertAlmostEqual(predictor.Y_He(0.022242, 0), 0.245336, 5)
+        self.assertTrue(np.allclose(predictor.DH([0.021, 0.022], [0, 1]),
+                                    [bbn.dh_fit(0.021, 0, bbn.tau_n) * 1e-5, bbn.dh_fit(0.022, 1, bbn.tau_n) * 1e-5]))
         data.calc_background(pars)
         self.assertAlmostEqual(data.cosmomc_theta(), 0.01040862, 7)
         self.assertAlmostEqual(data.get_derived_params()['kd'], 0.14055, 4)
+        # cached redshift spline must be recalculated for the new parameters
+        self.assertAlmostEqual(data.redshift_at_comoving_radial_distance(data.comoving_radial_distance(1.5)), 1.5, 5)
 
         # test massive sterile models as in Planck papers
         pars.set_cosmology(H0=68.0, ombh2=0.022305, omch2=0.11873, mnu=0.06, nnu=3.073, omk=0, meffsterile=0.013)
@@ -81,9 +125,67 @@ class CambTest(unittest.TestCase):
         self.assertAlmostEqual(scal, vec[1], 5)
         pars.set_dark_energy()  # re-set defaults
 
+        # vector background functions, directly and from spline
+        for nz in [4, 2 * camb.camb.background_spline_min_size]:
+            zs = np.linspace(0.1, 1100, nz)
+            ix = [0, nz // 3, nz - 1]
+            self.assertTrue(np.allclose(data.h_of_z(zs)[ix], [data.h_of_z(z) for z in zs[ix]], rtol=1e-6))
+            self.assertTrue(np.allclose(data.physical_time(zs)[ix], [data.physical_time(z) for z in zs[ix]],
+                                        rtol=1e-5))
+            self.assertTrue(np.allclose(data.angular_diameter_distance2(zs[ix], zs[-1]),
+                                        [data.angular_diameter_distance2(z, zs[-1]) for z in zs[ix]], rtol=1e-5))
+        self.assertEqual(data.angular_diameter_distance2([[0.1], [0.5]], [1, 2, 3]).shape, (2, 3))
+        # cached background splines re-used in range, and re-calculated for a new background
+        zs = np.linspace(0.1, 10, 4 * camb.camb.background_spline_min_size)
+        self.assertTrue(np.allclose(data.h_of_z(zs[::2])[-1], data.h_of_z(zs)[-2], rtol=1e-6))
+        data.calc_background(camb.set_params(H0=72, ombh2=0.022, omch2=0.12))
+        self.assertAlmostEqual(data.h_of_z(zs)[-1] / data.h_of_z(zs[-1]), 1, 6)
+        data.calc_background(pars)
+
         # test theta
         pars.set_cosmology(cosmomc_theta=0.0104085, H0=None, ombh2=0.022271, omch2=0.11914, mnu=0.06, omk=0)
         self.assertAlmostEqual(pars.H0, 67.5512, 2)
+        from scipy.optimize import brentq
+        model.clear_theta_H0_cache()
+        for theta, ombh2, omch2, omk in [(0.0104085, 0.022271, 0.11914, 0), (0.0104085, 0.022271, 0.11914, 0),
+                                         (0.01041, 0.0222, 0.12, 0), (0.0103, 0.023, 0.11, -0.02)]:
+            def f(H0):
+                pars.set_cosmology(H0=H0, ombh2=ombh2, omch2=omch2, omk=omk)
+                return camb.get_background(pars, no_thermo=True).cosmomc_theta() - theta
+
+            H0 = brentq(f, 10, 100, rtol=1e-8)
+            pars.set_cosmology(cosmomc_theta=theta, H0=None, ombh2=ombh2, omch2=omch2, omk=omk)
+            self.assertAlmostEqual(pars.H0 / H0, 1, 5)
+
+    def testResultCache(self):
+        pars = camb.set_params(H0=67.5, ombh2=0.022, omch2=0.122)
+        pars.Reion.set_tau(0.06)
+        key = pars.canonical_key()
+        cache = camb.set_result_cache(4)
+        try:
+            data = camb.get_background(pars)
+            self.assertEqual(pars.canonical_key(), key)
+            self.assertTrue(camb.get_background(pars) is data)
+            self.assertEqual(cache.stats()['hits']['background'], 1)
+            DA = data.angular_diameter_distance(1)
+            pars2 = camb.set_params(H0=68, ombh2=0.022, omch2=0.122)
+            self.assertNotEqual(pars2.canonical_hash(), pars.canonical_hash())
+            self.assertNotAlmostEqual(camb.get_background(pars2).angular_diameter_distance(1), DA, 3)
+            self.assertAlmostEqual(camb.get_background(pars).angular_diameter_distance(1), DA, 8)
+            self.assertEqual(cache.stats()['misses']['background'], 2)
+        finally:
+            camb.set_result_cache(None)
+
+        # alternating between models must not return the other model's native power spectra
+        models = [camb.set_params(H0=H0, ombh2=0.022, omch2=0.122, lmax=400) for H0 in [65, 72]]
+        refs = [camb.get_results(p).get_cmb_power_spectra(spectra=['total'])['total'] for p in models]
+        camb.set_result_cache(4)
+        try:
+            for p, ref in list(zip(models, refs)) * 2:
+                cls = camb.get_results(p).get_cmb_power_spectra(spectra=['total'])['total']
+                self.assertTrue(np.allclose(cls, ref, rtol=1e-6))
+        finally:
+            camb.set_result_cache(None)
 
     def testEvolution(self):
         redshifts = [0.4, 31.5]
@@ -97,6 +199,10 @@ class CambTest(unittest.TestCase):
         mtrans = data.get_matter_transfer_data()
         transfer_k = mtrans.transfer_z('delta_cdm', z_index=1)
         transfer_k2 = mtrans.transfer_z('delta_baryon', z_index=0)
+        with data.get_matter_transfer_data(copy=False) as view:
+            self.assertFalse(view.transfer_data.flags.writeable)
+            self.assertTrue(np.array_equal(view.transfer_z('delta_cdm', z_index=1), transfer_k))
+        self.assertEqual(data._views, 0)
 
         kh = mtrans.transfer_z('k/h', z_index=1)
         ev = data.get_redshift_evolution(mtrans.q, redshifts, ['delta_baryon', 'delta_cdm', 'delta_photon'],
@@ -104,6 +210,15 @@ class CambTest(unittest.TestCase):
         self.assertTrue(np.all(np.abs(transfer_k * kh ** 2 * (pars.H0 / 100) ** 2 / ev[:, 0, 1] - 1) < 1e-3))
         ix = 1
         self.assertAlmostEqual(transfer_k2[ix] * kh[ix] ** 2 * (pars.H0 / 100) ** 2, ev[ix, 1, 0], 4)
+        filename = os.path.join(tempfile.gettempdir(), 'camb_test_evolution.npy')
+        try:
+            for n_workers in [1, 2]:
+                ev2 = data.get_redshift_evolution(mtrans.q[:10], redshifts, ['delta_cdm', 'delta_baryon'],
+                                                  lAccuracyBoost=1, k_chunk=3, out=filename, n_workers=n_workers)
+                self.assertTrue(np.allclose(ev2, ev[:10, :, [1, 0]], rtol=1e-6))
+                del ev2
+        finally:
+            os.remove(filename)
 
     def testPowers(self):
         pars = camb.CAMBparams()
@@ -113,6 +228,16 @@ class CambTest(unittest.TestCase):
 
         self.assertAlmostEqual(pars.scalar_power(1), 1.801e-9, 4)
         self.assertAlmostEqual(pars.scalar_power([1, 1.5])[0], 1.801e-9, 4)
+        ks = np.logspace(-5, 1, 50)
+        pars.InitPower.set_params(ns=0.965, As=2e-9, nrun=-0.01, nrunrun=0.005, r=0.1, pivot_tensor=0.002)
+        for ix in [0, 2]:
+            self.assertTrue(np.allclose(pars.primordial_power(ks, ix), pars.primordial_power(ks, ix, native=True),
+                                        rtol=1e-10))
+        splined = initialpower.SplinedInitialPower(ks, pars.scalar_power(ks), pars.tensor_power(ks))
+        batch = initialpower.primordial_power_batch([pars.InitPower, splined], ks[3:-3], 2)
+        self.assertTrue(np.allclose(batch[0], batch[1], rtol=1e-6))
+        self.assertIsInstance(pars.InitPower.scalar_power(0.05), float)
+        pars.InitPower.set_params(ns=0.965, As=2e-9)
 
         pars.set_matter_power(redshifts=[0., 0.17, 3.1])
         pars.NonLinear = model.NonLinear_none
@@ -142,6 +267,30 @@ class CambTest(unittest.TestCase):
         kh, z, pk = results.get_nonlinear_matter_power_spectrum()
         pk_interp = PKnonlin.P(z, kh)
         self.assertTrue(np.sum((pk / pk_interp - 1) ** 2) < 0.005)
+        PK = results.get_matter_power_interpolator()
+        self.assertTrue(np.allclose(PK.P(z, kh), pk, rtol=1e-6))
+        # other RectBivariateSpline methods passed on to the spline
+        self.assertEqual(len(PK.get_knots()), 2)
+        self.assertAlmostEqual(PK.partial_derivative(1, 0)(0.5, np.log(0.1))[0, 0],
+                               PK.spline(0.5, np.log(0.1), dx=1)[0, 0])
+        zs, khs = [0.3, 1.5, 7], [0.02, 0.1, 2]
+        pk_pairs = PK.P(zs, khs, grid=False)
+        self.assertTrue(np.allclose(pk_pairs, np.diag(PK.P(zs, khs))))
+        for method in ['linear', 'cubic']:
+            self.assertTrue(np.allclose(PK.make_table(method=method).P(zs, khs, grid=False), pk_pairs, rtol=2e-3))
+
+        from camb.limber import Limber
+        limber = Limber(results, nchi=300, zmax=5)
+        zs = np.linspace(0, 3, 100)
+        for i, zc in enumerate([0.5, 1]):
+            limber.add_galaxy('g%s' % i, zs, np.exp(-((zs - zc) / 0.1) ** 2 / 2))
+            limber.add_lensing('k%s' % i, zs, np.exp(-((zs - zc) / 0.1) ** 2 / 2))
+        ls = np.arange(20, 1000, 100)
+        cls = limber.get_cls(ls, n_workers=2)
+        self.assertEqual(len(cls), 10)
+        matrix = limber.get_cl_matrix(ls)
+        self.assertTrue(np.allclose(matrix[:, 1, 3], cls[('k0', 'k1')]))
+        self.assertTrue(np.all(cls[('k0', 'k0')] < cls[('k1', 'k1')]))
         camb.set_halofit_version('mead')
         _, _, pk = results.get_nonlinear_matter_power_spectrum(params=pars, var1='delta_cdm', var2='delta_cdm')
         self.assertTrue(np.abs(pk[0][160] / 232.08 - 1) < 1e-3)
@@ -166,3 +315,243 @@ class CambTest(unittest.TestCase):
         corr, xvals, weights = correlations.gauss_legendre_correlation(cls['lensed_scalar'])
         clout = correlations.corr2cl(corr, xvals, weights, 2500)
         self.assertTrue(np.all(np.abs(clout[2:2300, 2] / cls['lensed_scalar'][2:2300, 2] - 1) < 1e-3))
+
+    def testPowerSpectraBatch(self):
+        pars = camb.set_params(H0=67.5, ombh2=0.022, omch2=0.122, As=2e-9, ns=0.965, lmax=1000)
+        pars.WantTensors = True
+        data = camb.get_transfer_functions(pars)
+        ref_cls = data.get_cmb_power_spectra(lmax=800)
+        # approximation is calibrated at the reference point, so must be very accurate nearby (as in fast-slow
+        # sampling), but only roughly for points well away from the reference
+        near = [{'As': 2e-9, 'ns': 0.965}, {'As': 2.02e-9, 'ns': 0.967, 'r': 0.01},
+                {'As': 1.98e-9, 'ns': 0.964, 'nrun': 0.001}]
+        far = [{'As': 2.1e-9, 'ns': 0.96, 'r': 0.1}, {'As': 1.9e-9, 'ns': 0.97, 'nrun': 0.01},
+               {'As': 2.5e-9, 'ns': 0.92, 'nrun': -0.02, 'r': 0.2}]
+        variants = near + far
+        batch = data.get_power_spectra_batch(variants, lmax=800)
+        # native result for the reference parameters restored after calibrating with tensors
+        restored = data.get_cmb_power_spectra(lmax=800)
+        for name in ['total', 'lens_potential']:
+            self.assertTrue(np.allclose(restored[name], ref_cls[name]))
+        exact = data.get_power_spectra_batch(variants[:2], lmax=800, exact=True)
+        for i, variant in enumerate(variants):
+            tol = 1e-4 if variant in near else 2e-3
+            data.power_spectra_from_transfer(camb.InitialPowerParams().set_params(**variant))
+            cls = data.get_cmb_power_spectra(lmax=800)
+            # TT, EE, BB, TE; BB only non-zero (from lensing and tensors) in total
+            for name, cols in [('total', [0, 1, 2, 3]), ('unlensed_scalar', [0, 1, 3]), ('tensor', [0, 1, 2, 3]),
+                               ('lens_potential', [0])]:
+                if i < 2:
+                    self.assertTrue(np.allclose(exact[name][i], cls[name], rtol=1e-10, atol=0))
+                for ix in cols:
+                    expected = cls[name][2:, ix]
+                    self.assertTrue(np.allclose(batch[name][i, 2:, ix], expected, rtol=tol,
+                                                atol=tol * np.max(np.abs(expected))), (variant, name, ix))
+
+    def testGrid(self):
+        from camb import grid
+        params = [camb.set_params(H0=H0, ombh2=0.022, omch2=0.12, lmax=400) for H0 in [65, 70, 75]]
+        cls = grid.map_grid(params, processes=2, mmap_min_bytes=0)
+        self.assertTrue(np.allclose(cls[1]['total'], camb.get_results(params[1]).get_cmb_power_spectra()['total']))
+        params[2].omegab = -1
+        results = list(grid.run_grid(params, processes=2, ordered=False))
+        self.assertEqual(sorted(res.index for res in results), [0, 1, 2])
+        self.assertEqual([res.index for res in results if res.error], [2])
+        # failing worker initializer (int('x') raises ValueError) is returned as errors, not retried
+        results = list(grid.run_grid(params[:2], processes=2, initializer=int, initargs=('x',)))
+        self.assertTrue(all('ValueError' in res.error for res in results))
+        if sys.version_info[0] >= 3:
+            # unpicklable result returned as an error, without stopping the other jobs
+            results = list(grid.run_grid(['1', 'lambda: 0', '2'], eval, processes=2))
+            self.assertEqual([res.result for res in results], [1, None, 2])
+            self.assertEqual([res.index for res in results if res.error], [1])
+
+    def testResultStore(self):
+        from camb import grid, store
+        path = tempfile.mkdtemp()
+        try:
+            params = [camb.set_params(H0=H0, ombh2=0.022, omch2=0.12, lmax=400) for H0 in [65, 70, 75]]
+            params[2].omegab = -1
+            written, errors = store.write_grid(path, params, grid.cmb_power_spectra, shard_size=2, processes=2)
+            self.assertEqual(written, 2)
+            self.assertEqual([i for i, _ in errors], [2])
+            cls = camb.get_results(params[1]).get_cmb_power_spectra()['total']
+            with store.ResultStoreWriter(path, dtypes={'total': np.float32}) as writer:
+                writer.append({'H0': 80}, {'total': np.ones(cls.shape)})
+            results = store.ResultStore(path)
+            self.assertEqual(len(results), 3)
+            self.assertTrue(np.allclose(results[params[1]]['total'], cls))
+            self.assertEqual(results.column('total').shape, (3, cls.shape[0], 4))
+            self.assertTrue(np.all(results[{'H0': 80}]['total'] == 1))
+            self.assertRaises(IndexError, results.column, 'total', [1, 3])
+        finally:
+            shutil.rmtree(path)
+        path = tempfile.mkdtemp()
+        try:
+            # one-model shards, written in the same millisecond, are read in the order written
+            with store.ResultStoreWriter(path, shard_size=1) as writer:
+                for i in range(20):
+                    writer.append({'i': i}, np.array([i]))
+            self.assertTrue(np.array_equal(store.ResultStore(path).column('result')[:, 0], np.arange(20)))
+        finally:
+            shutil.rmtree(path)
+
+    def testEmulator(self):
+        from camb import emulate
+        names = ['H0', 'omch2']
+        ranges = [[65, 75], [0.11, 0.13]]
+        X = emulate.latin_hypercube(20, ranges, seed=1)
+        self.assertTrue(np.all(np.sort(np.floor((X - [65, 0.11]) / [0.5, 0.001]), axis=0).T == np.arange(20)))
+        func = emulate.CMBSpectra(lmax=300, ombh2=0.022)
+        X, Y = emulate.generate_training_set(func, names, ranges, 20, seed=1, processes=2)
+        emulator = emulate.Emulator(names, ranges, n_components=8, degree=3).fit(X, Y)
+        report = emulator.validate([[70, 0.12]], [func({'H0': 70, 'omch2': 0.12})])
+        self.assertLess(report['max'], 5e-3)
+        filename = os.path.join(tempfile.gettempdir(), 'camb_test_emulator.npz')
+        emulator.save(filename)
+        try:
+            self.assertTrue(np.allclose(emulate.Emulator.load(filename).predict(X), emulator.predict(X)))
+        finally:
+            os.remove(filename)
+
+    def testFisher(self):
+        from camb import fisher
+        calc = fisher.Fisher({'H0': 67.5, 'ombh2': 0.022, 'omch2': 0.122, 'As': 2e-9, 'ns': 0.965},
+                             steps={'H0': 0.5}, lmax=500, spectra=['TT'], spectrum='unlensed_scalar', processes=2)
+        cls = calc.fiducial_outputs()['cls']
+        # unlensed C_L are linear in As (lensed are not, as C_phiphi is also proportional to As)
+        derivs = calc.derivatives(['As'])
+        self.assertTrue(np.allclose(derivs['As']['cls'], cls / 2e-9, rtol=1e-5))
+        self.assertEqual(len(calc._cache), 3)
+        F = calc.fisher_matrix(['As', 'ns', 'H0'], (cls.ravel() * 0.01) ** 2)
+        self.assertEqual(len(calc._cache), 7)
+        self.assertTrue(np.all(np.linalg.eigvalsh(F) > 0))
+
+    def testLazyImport(self):
+        from camb_tests import import_benchmark
+        elapsed, loaded = import_benchmark.time_import('import camb.correlations, camb.bbn', repeat=1)
+        self.assertFalse(loaded)
+        elapsed, loaded = import_benchmark.time_import('from camb import CAMBparams', repeat=1)
+        self.assertTrue(loaded)
+
+    def testBenchmarkCompare(self):
+        from camb_tests import benchmark_suite
+        rand = np.random.RandomState(1)
+        history = [{'results': {'cl2corr_4000': {'times': list(1 + 0.01 * rand.rand(5))}}} for _ in range(3)]
+        change, p, slower = benchmark_suite.compare({'times': list(1.2 + 0.01 * rand.rand(5))}, history,
+                                                    'cl2corr_4000')
+        self.assertTrue(slower)
+        self.assertAlmostEqual(change, 0.2, 1)
+        self.assertFalse(benchmark_suite.compare({'times': list(1 + 0.01 * rand.rand(5))}, history,
+                                                 'cl2corr_4000')[2])
+        self.assertIsNone(benchmark_suite.compare({'times': [1.]}, history, 'background'))
+
+    def testLegendreBlocks(self):
+        x = np.array([-0.7, 0.2, 0.9995])
+        (P, dP), (d11, dm11), (d20, d22, d2m2) = correlations.legendre_funcs_block(10, x, [0, 1, 2])
+        self.assertTrue(np.allclose(P[:, 3], (5 * x ** 3 - 3 * x) / 2))
+        self.assertTrue(np.allclose(dP[:, 3], (15 * x ** 2 - 3) / 2))
+        self.assertTrue(np.allclose(d11[:, 0], (1 + x) / 2))
+        self.assertTrue(np.allclose(dm11[:, 0], (1 - x) / 2))
+        self.assertTrue(np.allclose(d22[:, 0], ((1 + x) / 2) ** 2))
+        self.assertTrue(np.allclose(d2m2[:, 0], ((1 - x) / 2) ** 2))
+        self.assertTrue(np.allclose(d20[:, 0], np.sqrt(6) / 4 * (1 - x ** 2)))
+        (P1, dP1), (d20_1, d22_1, d2m2_1) = correlations.legendre_funcs(10, x[2], [0, 2])
+        self.assertTrue(np.allclose(P1, P[2]) and np.allclose(d2m2_1, d2m2[2]))
+
+    def testCorrelationTransform(self):
+        lmax = 300
+        cls, _ = _model_cls(lmax)
+        plan = correlations.get_correlation_transform(lmax, sampling_factor=1.2)
+        self.assertTrue(plan is correlations.get_correlation_transform(lmax, sampling_factor=1.2))
+        corrs = correlations.cl2corr(cls, plan.xvals)
+        self.assertTrue(np.allclose(plan.cl2corr(cls), corrs))
+        self.assertTrue(np.allclose(plan.corr2cl(corrs), correlations.corr2cl(corrs, plan.xvals, plan.weights, lmax)))
+        stack = plan.corr2cl(plan.cl2corr(np.array([cls, 2 * cls])))
+        self.assertTrue(np.allclose(stack[1, 2:lmax - 10, :], 2 * cls[2:lmax - 10, :], atol=1e-8))
+
+    def testLensedClsBatch(self):
+        lmax = 800
+        cls, clpp = _model_cls(lmax)
+        stack = np.array([cls, 1.5 * cls])
+        clpp_stack = np.array([clpp, 0.8 * clpp])
+        batch = correlations.lensed_cls_batch(stack, clpp_stack, delta_cls=True)
+        for i in range(2):
+            lensed = correlations.lensed_cls(stack[i], clpp_stack[i], delta_cls=True)
+            self.assertTrue(np.allclose(batch[i], lensed, rtol=0, atol=1e-10 * np.max(np.abs(lensed))))
+        lensed = correlations.lensed_cls_batch(stack, clpp, theta_max=None)[0]
+        self.assertTrue(np.allclose(lensed, correlations.lensed_cls(cls, clpp, theta_max=None), rtol=1e-10))
+
+    def testLensedCorrelationWorkers(self):
+        lmax = 1000
+        cls, clpp = _model_cls(lmax)
+        xvals, weights = np.polynomial.legendre.leggauss(1401)
+        corrs, lensed = correlations.lensed_correlations(cls, clpp, xvals, weights, delta=True)
+        for n_workers in [2, 5]:
+            corrs2, lensed2 = correlations.lensed_correlations(cls, clpp, xvals, weights, delta=True,
+                                                               n_workers=n_workers)
+            self.assertTrue(np.array_equal(corrs, corrs2) and np.array_equal(lensed, lensed2))
+
+    def testLensedClDerivativeBlocks(self):
+        lmax = 500
+        cls, clpp = _model_cls(lmax)
+        dcl = correlations.lensed_cl_derivatives(cls, clpp)
+        blocks = correlations.lensed_cl_derivative_blocks(cls, clpp, ell_block=64)
+        self.assertTrue(np.allclose(np.concatenate([block for _, block in blocks], axis=1), dcl))
+        # all angles, in chunks of x re-calculated for each block of ell
+        dcl_all = correlations.lensed_cl_derivatives(cls, clpp, theta_max=None)
+        x_block_bytes = correlations._derivative_x_block_bytes
+        correlations._derivative_x_block_bytes = 8 * 8 * (lmax + 1) * 100
+        try:
+            self.assertTrue(np.allclose(correlations.lensed_cl_derivatives(cls, clpp, theta_max=None), dcl_all))
+        finally:
+            correlations._derivative_x_block_bytes = x_block_bytes
+        project = np.vstack([np.ones(lmax + 1), np.arange(lmax + 1) / float(lmax)]).T
+        self.assertTrue(np.allclose(correlations.lensed_cl_derivatives(cls, clpp, project=project), dcl.dot(project)))
+
+    def testGaussLegendreCache(self):
+        for npoints in [40, 41]:
+            xvals, weights = correlations._gauss_legendre_newton(npoints)
+            xref, wref = np.polynomial.legendre.leggauss(npoints)
+            self.assertTrue(np.allclose(xvals, xref, rtol=0, atol=1e-15) and np.allclose(weights, wref, rtol=1e-13))
+        xvals, weights = correlations.fejer_points(41)
+        self.assertAlmostEqual(np.dot(weights, xvals ** 40), 2 / 41., 14)
+        cache_dir = correlations.gauss_legendre_cache_dir
+        correlations.gauss_legendre_cache_dir = tempfile.mkdtemp()
+        try:
+            xvals, weights = correlations._disk_cached_gauss_legendre(41, lambda: (xref, wref))
+            self.assertEqual(len(os.listdir(correlations.gauss_legendre_cache_dir)), 1)
+            xvals, weights = correlations._disk_cached_gauss_legendre(41, None)
+            self.assertTrue(np.array_equal(xvals, xref) and not weights.flags.writeable)
+            # read-only cache (utime fails) is still used, without calculating the points
+            with mock.patch('camb.correlations.os.utime', side_effect=OSError('read-only')):
+                xvals, weights = correlations._disk_cached_gauss_legendre(41, None)
+                self.assertTrue(np.array_equal(xvals, xref))
+        finally:
+            shutil.rmtree(correlations.gauss_legendre_cache_dir)
+            correlations.gauss_legendre_cache_dir = cache_dir
+
+    def testLensingOperator(self):
+        lmax = 600
+        cls, clpp = _model_cls(lmax)
+        op = correlations.LensingOperator(lmax)
+        # without cached kernels, lensed_cls calculates the lensed correlations directly
+        lensed = correlations.lensed_cls(cls, clpp, cache=False)
+        self.assertTrue(np.allclose(op(cls, clpp), lensed, rtol=1e-10))
+        self.assertTrue(np.allclose(correlations.lensed_cls(cls, clpp), lensed, rtol=1e-10))
+        self.assertTrue(correlations.get_lensing_operator(lmax) is correlations.get_lensing_operator(lmax))
+        # kernels too large for the cache are not calculated
+        cache_bytes = correlations.lensing_operator_cache_bytes
+        correlations.lensing_operator_cache_bytes = 2 ** 20
+        try:
+            self.assertIsNone(correlations.get_lensing_operator(lmax, theta_max=None, build=False))
+        finally:
+            correlations.lensing_operator_cache_bytes = cache_bytes
+        fd, filename = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+        try:
+            op.save(filename)
+            op = correlations.LensingOperator.load(filename)
+        finally:
+            os.remove(filename)
+        self.assertTrue(np.allclose(op(np.array([cls, cls]), clpp)[1], lensed, rtol=1e-10))
@@ -0,0 +1,121 @@
+"""
+Timing of the python lensing routines in camb.correlations. These do not need the compiled CAMB library.
+Run as e.g.
+
+    python -m camb_tests.correlations_benchmark --lmax 2500 4000 6000 --nspectra 32
+    python -m camb_tests.correlations_benchmark --accuracy --lmax 2000 6000 10000
+"""
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+from camb import correlations
+
+
+def model_cls(lmax, amp=1.):
+    """
+    Smooth model unlensed CMB and lensing potential spectra, roughly of the shape of the real ones.
+
+    :param lmax: maximum L
+    :param amp: overall scaling of the CMB spectra
+    :return: cls[L, ix], clpp[L] in the units used by :func:`~camb.correlations.lensed_cls`
+    """
+    ls = np.arange(lmax + 1, dtype=np.float64)
+    cls = np.zeros((lmax + 1, 4))
+    damp = np.exp(-(ls[2:] / 1500.) ** 2)
+    cls[2:, 0] = amp * 6000 * damp * (1 + 0.3 * np.cos(ls[2:] / 40.))
+    cls[2:, 1] = amp * 40 * damp * (1 + 0.5 * np.sin(ls[2:] / 45.)) * ls[2:] / (ls[2:] + 100)
+    cls[2:, 2] = amp * 0.01 * np.exp(-(ls[2:] / 1000.) ** 2)
+    cls[2:, 3] = 0.5 * np.sqrt(cls[2:, 0] * cls[2:, 1]) * np.cos(ls[2:] / 50.)
+    clpp = np.zeros(lmax + 1)
+    x = ls[1:] / 60.
+    clpp[1:] = 4e-7 * x ** 2 / (1 + x ** 2) ** 2 * np.sqrt(1 + x)
+    return cls, clpp
+
+
+def _best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def time_lensed_cls_batch(lmax, nspectra=32, repeat=1):
+    """
+    Compare the time per set of spectra for a loop over :func:`~camb.correlations.lensed_cls`
+    and for :func:`~camb.correlations.lensed_cls_batch`.
+    Gauss-Legendre points are calculated (and cached) before timing.
+
+    :param lmax: maximum L
+    :param nspectra: number of sets of spectra in the stack
+    :param repeat: number of repeats, the best time is used
+    :return: dictionary of timings in seconds per set of spectra and maximum fractional difference
+    """
+    models = [model_cls(lmax, 1 + 0.01 * i) for i in range(nspectra)]
+    cls_stack = np.array([cls for cls, _ in models])
+    clpp_stack = np.array([clpp for _, clpp in models])
+    correlations.lensed_cls(cls_stack[0], clpp_stack[0])
+    loop = _best_time(lambda: [correlations.lensed_cls(cls, clpp) for cls, clpp in models], repeat)
+    batch = _best_time(lambda: correlations.lensed_cls_batch(cls_stack, clpp_stack), repeat)
+    lensing = correlations.lensed_cls(cls_stack[0], clpp_stack[0], delta_cls=True)
+    diff = correlations.lensed_cls_batch(cls_stack[:1], clpp_stack[:1], delta_cls=True)[0] - lensing
+    return {'lmax': lmax, 'nspectra': nspectra, 'loop': loop / nspectra, 'batch': batch / nspectra,
+            'max_diff': np.max(np.max(np.abs(diff), axis=0) / np.max(np.abs(lensing), axis=0))}
+
+
+def lensing_accuracy(lmax, sampling_factors=(1.4, 2, 2.8), grids=(True, False, 'fejer'), ref_sampling=3.):
+    """
+    Time and accuracy of :func:`~camb.correlations.lensed_cls` for different integration grids and sampling.
+    Errors are relative to Gauss-Legendre integration with sampling_factor=ref_sampling.
+    Time to calculate the Gauss-Legendre points is not included (as they are cached). The lensing kernels are not
+    cached, so times are for the direct O(lmax*npoints) calculation, with the same cost per point for all grids.
+
+    :param lmax: maximum L
+    :param sampling_factors: list of sampling_factor values to test
+    :param grids: list of leggaus values to test (True for Gauss-Legendre, False for uniform, 'fejer')
+    :param ref_sampling: sampling_factor for the reference result
+    :return: list of dictionaries with time (seconds) and maximum error in the lensing change to each spectrum,
+        relative to the maximum change, for L < 0.9*lmax
+    """
+    cls, clpp = model_cls(lmax)
+    cache_bytes = correlations.lensing_operator_cache_bytes
+    correlations.lensing_operator_cache_bytes = 0
+    try:
+        ref = correlations.lensed_cls(cls, clpp, delta_cls=True, sampling_factor=ref_sampling)
+        lmax_test = int(0.9 * lmax)
+        results = []
+        for sampling_factor in sampling_factors:
+            for leggaus in grids:
+                correlations._lensing_grid(lmax, sampling_factor, leggaus)
+                start = time.time()
+                lensed = correlations.lensed_cls(cls, clpp, delta_cls=True, sampling_factor=sampling_factor,
+                                                 leggaus=leggaus)
+                results.append({'lmax': lmax, 'sampling_factor': sampling_factor, 'leggaus': leggaus,
+                                'time': time.time() - start,
+                                'error': np.max(np.abs(lensed - ref)[:lmax_test], axis=0) /
+                                         np.max(np.abs(ref), axis=0)})
+    finally:
+        correlations.lensing_operator_cache_bytes = cache_bytes
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the python lensed CL calculations')
+    parser.add_argument('--lmax', type=int, nargs='+', default=[2500, 4000, 6000])
+    parser.add_argument('--nspectra', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--accuracy', action='store_true', help='compare accuracy and time of integration grids')
+    args = parser.parse_args()
+    for lmax in args.lmax:
+        if args.accuracy:
+            for res in lensing_accuracy(lmax):
+                print('lmax %5d, sampling %.1f, %-8s: %.3fs, errors TT %.1e, EE %.1e, BB %.1e, TE %.1e'
+                      % ((lmax, res['sampling_factor'], {True: 'GL', False: 'uniform'}.get(res['leggaus'], 'fejer'),
+                          res['time']) + tuple(res['error'])))
+            continue
+        res = time_lensed_cls_batch(lmax, args.nspectra, args.repeat)
+        print('lmax %5d, %d spectra: lensed_cls %.4fs, lensed_cls_batch %.4fs per set (x%.1f), '
+              'max difference %.1e' % (lmax, res['nspectra'], res['loop'], res['batch'],
+                                       res['loop'] / res['batch'], res['max_diff']))
@@ -0,0 +1,66 @@
+"""
+Time taken to import parts of camb in a new python process, and whether the CAMB library is loaded.
+Use --max_time to fail (non-zero exit status) if any import is slower than a given time in seconds. Run as e.g.
+
+    python -m camb_tests.import_benchmark --repeat 5
+    python -m camb_tests.import_benchmark --max_time 0.5
+"""
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+
+default_statements = ['import numpy', 'import camb', 'import camb.correlations', 'import camb.bbn',
+                      'from camb import CAMBparams', 'import camb; camb.set_params(H0=67)']
+
+_timer = """
+import time, sys
+start = time.time()
+%s
+elapsed = time.time() - start
+lib = sys.modules.get('camb.baseconfig')
+print(elapsed, bool(lib is not None and getattr(lib.camblib, '_lib', None) is not None))
+"""
+
+
+def time_import(statement, repeat=3):
+    """
+    Time statement (e.g. an import) run in new python processes.
+
+    :param statement: python code to time
+    :param repeat: number of processes to run, the best time is used
+    :return: time in seconds, and whether the CAMB library was loaded; (None, None) if the statement failed
+    """
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root] + [p for p in [env.get('PYTHONPATH')] if p])
+    times = []
+    loaded = None
+    for _ in range(repeat):
+        proc = subprocess.Popen([sys.executable, '-c', _timer % statement], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env)
+        out, _ = proc.communicate()
+        if proc.returncode:
+            return None, None
+        elapsed, loaded = out.decode().split()
+        times.append(float(elapsed))
+    return min(times), loaded == 'True'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time camb imports in new processes')
+    parser.add_argument('--statements', nargs='+', default=default_statements)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max_time', type=float, default=None, help='fail if any statement takes longer')
+    args = parser.parse_args()
+    slow = False
+    for statement in args.statements:
+        elapsed, loaded = time_import(statement, args.repeat)
+        if elapsed is None:
+            print('%-40s: failed' % statement)
+            continue
+        print('%-40s: %.3fs%s' % (statement, elapsed, ' (CAMB library loaded)' if loaded else ''))
+        slow = slow or args.max_time is not None and elapsed > args.max_time
+    if slow:
+        sys.exit('Import slower than %s seconds' % args.max_time)
@@ -0,0 +1,86 @@
+"""
+Timing of camb.limber for galaxy and lensing tracers in tomographic bins, compared to integrating each
+pair and L separately. Run as e.g.
+
+    python -m camb_tests.limber_benchmark --nbins 10 --nl 100 --n_workers 1 4
+"""
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+import camb
+from camb.limber import Limber
+
+
+def tomographic_bins(nbins, zmin=0.2, zmax=2., width=0.1):
+    """
+    Gaussian redshift distributions for tomographic bins.
+
+    :param nbins: number of bins
+    :param zmin: mean redshift of the first bin
+    :param zmax: mean redshift of the last bin
+    :param width: standard deviation of each bin
+    :return: z, list of n(z) arrays
+    """
+    z = np.linspace(0, zmax + 6 * width, 500)
+    return z, [np.exp(-((z - zc) / width) ** 2 / 2) for zc in np.linspace(zmin, zmax, nbins)]
+
+
+def time_limber(nbins=10, nl=100, lmax=3000, nchi=500, n_workers=(1,), table=False):
+    """
+    Time :meth:`~camb.limber.Limber.get_cls` for all pairs of galaxy and lensing tracers in nbins tomographic bins,
+    and a loop integrating each pair and L separately for a few pairs (time scaled to all pairs).
+
+    :param nbins: number of tomographic bins
+    :param nl: number of L values
+    :param lmax: maximum L
+    :param nchi: number of integration points in chi
+    :param n_workers: list of numbers of threads to time
+    :param table: if True use a cubic lookup table for the matter power
+    :return: dictionary of timings in seconds and maximum fractional difference between the methods
+    """
+    pars = camb.set_params(H0=67.5, ombh2=0.022, omch2=0.122, As=2e-9, ns=0.965)
+    pars.set_matter_power(redshifts=np.linspace(0, 3, 50)[::-1], kmax=20, silent=True)
+    results = camb.get_results(pars)
+    PK = results.get_matter_power_interpolator(nonlinear=True, hubble_units=False, k_hunit=False)
+    if table:
+        PK.make_table(method='cubic')
+    ls = np.linspace(10, lmax, nl)
+    timings = {}
+    start = time.time()
+    limber = Limber(results, PK, nchi=nchi)
+    z, bins = tomographic_bins(nbins)
+    for i, nz in enumerate(bins):
+        limber.add_galaxy('g%s' % i, z, nz)
+        limber.add_lensing('k%s' % i, z, nz)
+    timings['setup'] = time.time() - start
+    for workers in n_workers:
+        start = time.time()
+        cls = limber.get_cls(ls, n_workers=workers)
+        timings['get_cls %s' % workers] = time.time() - start
+    pairs = list(cls.keys())[:3]
+    start = time.time()
+    diff = 0
+    for pair in pairs:
+        W = limber.windows[limber.names.index(pair[0])] * limber.windows[limber.names.index(pair[1])]
+        loop = [np.dot(W, limber.power_matrix([L])[0]) for L in ls]
+        diff = max(diff, np.max(np.abs(np.array(loop) / cls[pair] - 1)))
+    timings['loop'] = (time.time() - start) * len(cls) / len(pairs)
+    timings['pairs'] = len(cls)
+    timings['max_diff'] = diff
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time Limber C_L for tomographic bins')
+    parser.add_argument('--nbins', type=int, default=10)
+    parser.add_argument('--nl', type=int, default=100)
+    parser.add_argument('--nchi', type=int, default=500)
+    parser.add_argument('--n_workers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--table', action='store_true', help='use a lookup table for P(k,z)')
+    args = parser.parse_args()
+    res = time_limber(args.nbins, args.nl, nchi=args.nchi, n_workers=args.n_workers, table=args.table)
+    print('%d bins (%d pairs), %d L: setup %.4fs, pair/L loop %.3fs, max difference %.1e'
+          % (args.nbins, res['pairs'], args.nl, res['setup'], res['loop'], res['max_diff']))
+    for workers in args.n_workers:
+        print('get_cls with %d threads: %.4fs' % (workers, res['get_cls %s' % workers]))
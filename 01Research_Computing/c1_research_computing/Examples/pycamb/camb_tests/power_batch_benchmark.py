@@ -0,0 +1,66 @@
+"""
+Timing of CAMBdata.get_power_spectra_batch for many sets of initial power spectrum parameters, compared to
+calling power_spectra_from_transfer and get_cmb_power_spectra for each set.
+Run as e.g.
+
+    python -m camb_tests.power_batch_benchmark --nvariants 1000 --lmax 2500
+"""
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+import camb
+
+
+def initial_power_variants(nvariants, seed=1):
+    """
+    Random variations of (As, ns, nrun, r) around a fiducial model.
+
+    :param nvariants: number of sets of parameters
+    :param seed: random seed
+    :return: list of dictionaries of arguments for :meth:`.initialpower.InitialPowerParams.set_params`
+    """
+    rand = np.random.RandomState(seed)
+    return [{'As': 2.1e-9 * (1 + 0.02 * rand.randn()), 'ns': 0.965 + 0.005 * rand.randn(),
+             'nrun': 0.005 * rand.randn(), 'r': 0.05 * rand.rand()} for _ in range(nvariants)]
+
+
+def time_power_spectra_batch(nvariants=1000, lmax=2500, nloop=20):
+    """
+    Time the batch and the loop over native calls (for nloop sets, scaled to nvariants).
+
+    :param nvariants: number of sets of initial power parameters
+    :param lmax: maximum L
+    :param nloop: number of sets used for timing the loop
+    :return: batch time, scaled loop time, and maximum fractional differences in total TT, EE, BB and
+        lensing potential for the sets compared
+    """
+    pars = camb.set_params(H0=67.5, ombh2=0.022, omch2=0.122, As=2.1e-9, ns=0.965, lmax=lmax)
+    pars.WantTensors = True
+    data = camb.get_transfer_functions(pars)
+    variants = initial_power_variants(nvariants)
+    start = time.time()
+    batch = data.get_power_spectra_batch(variants, lmax=lmax, spectra=['total', 'lens_potential'])
+    batch_time = time.time() - start
+    nloop = min(nloop, nvariants)
+    diffs = []
+    start = time.time()
+    for i, variant in enumerate(variants[:nloop]):
+        data.power_spectra_from_transfer(camb.InitialPowerParams().set_params(**variant))
+        cls = data.get_cmb_power_spectra(lmax=lmax, spectra=['total', 'lens_potential'])
+        diffs.append([np.max(np.abs(batch['total'][i, 2:, ix] / cls['total'][2:, ix] - 1)) for ix in range(3)] +
+                     [np.max(np.abs(batch['lens_potential'][i, 2:, 0] / cls['lens_potential'][2:, 0] - 1))])
+    loop_time = (time.time() - start) * nvariants / nloop
+    return batch_time, loop_time, np.max(diffs, axis=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time batch power spectra from transfer functions')
+    parser.add_argument('--nvariants', type=int, default=1000)
+    parser.add_argument('--lmax', type=int, default=2500)
+    parser.add_argument('--nloop', type=int, default=20)
+    args = parser.parse_args()
+    batch_time, loop_time, diffs = time_power_spectra_batch(args.nvariants, args.lmax, args.nloop)
+    print('%d variants, lmax %d: batch %.2fs, loop %.2fs (x%.1f); max fractional differences TT %.1e, EE %.1e, '
+          'BB %.1e, PP %.1e' % ((args.nvariants, args.lmax, batch_time, loop_time, loop_time / batch_time)
+                               + tuple(diffs)))
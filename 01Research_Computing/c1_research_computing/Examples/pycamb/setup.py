@@ -111,7 +111,7 @@ setup(name=package_name,
       author_email='http://cosmologist.info/',
       url="http://camb.info/",
       cmdclass={'install': SharedLibrary},
-      packages=['camb', 'camb_tests'],
+      packages=['camb', 'camb.emulate', 'camb_tests'],
       package_data={'camb': [DLLNAME, 'HighLExtrapTemplate_lenspotentialCls.dat']},
       test_suite='camb_tests',
       classifiers=[